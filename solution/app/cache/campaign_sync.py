@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import uuid
+from typing import Iterable
+
+from redis import asyncio as aioredis
+
+from ..db import db_session
+from .invalidation import listen_invalidations, publish_invalidation
+
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'campaigns:invalidate'
+
+
+class CampaignSync:
+    # Keeps the TargetingIndex of every worker in step with the campaigns table. Writers publish the ids of the
+    # campaigns they changed after the commit, every worker re-reads those rows and upserts or drops them.
+    # Without an index (jobs_worker.py) it only publishes.
+
+    def __init__(self, redis: aioredis.Redis, targeting_index=None):
+        self.targeting_index = targeting_index
+        self._redis = redis
+        self._changed: set[uuid.UUID] = set()
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(listen_invalidations(self._redis, INVALIDATION_CHANNEL,
+                                                                self._invalidate_local, self._clear_local)),
+                       asyncio.create_task(self._run())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def invalidate_many(self, campaign_ids: Iterable[uuid.UUID]):
+        campaign_ids = list(campaign_ids)
+        if campaign_ids:
+            await publish_invalidation(self._redis, INVALIDATION_CHANNEL, campaign_ids)
+
+    def _invalidate_local(self, campaign_ids: list[uuid.UUID]):
+        self._changed.update(campaign_ids)
+        self._wakeup.set()
+
+    def _clear_local(self):
+        # messages may have been missed, the whole index is reloaded by the next request
+        self.targeting_index.reset()
+
+    async def _run(self):
+        # one reload at a time, so that an older read of a row is never applied after a newer one
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            campaign_ids, self._changed = self._changed, set()
+            try:
+                async with db_session.session_factory() as session:
+                    await self.targeting_index.reload(session, campaign_ids)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to reload %d campaigns", len(campaign_ids))
+                self._invalidate_local(campaign_ids)
+                await asyncio.sleep(1)
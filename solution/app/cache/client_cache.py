@@ -0,0 +1,104 @@
+import asyncio
+import os
+import uuid
+from typing import Iterable, Optional, Sequence
+
+from redis import asyncio as aioredis
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..db import client_model
+from .invalidation import listen_invalidations, publish_invalidation
+from .lru import LRUCache
+
+
+INVALIDATION_CHANNEL = 'clients:invalidate'
+
+
+class ClientProfile:
+    __slots__ = ('client_id', 'login', 'age', 'location', 'gender')
+
+    def __init__(self, client_id: uuid.UUID, login: str, age: int, location: str, gender: Optional[str]):
+        self.client_id = client_id
+        self.login = login
+        self.age = age
+        self.location = location
+        self.gender = gender
+
+
+class ClientCache:
+    # Read-through cache of client rows. Profiles change only in POST /clients/bulk, which invalidates
+    # the upserted ids on every worker through pub/sub, and in POST /clients/import, which clears the caches.
+
+    def __init__(self, redis: aioredis.Redis, max_size: int = 100000, ttl: float = 300.0):
+        self._redis = redis
+        self._local = LRUCache(max_size, ttl)
+        # bumped on every invalidation, a load that started before it must not be cached
+        self._generation = 0
+        self._listener: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, redis: aioredis.Redis):
+        return cls(redis,
+                   max_size=int(os.getenv('CLIENT_CACHE_SIZE', '100000')),
+                   ttl=float(os.getenv('CLIENT_CACHE_TTL', '300')))
+
+    def start(self):
+        self._listener = asyncio.create_task(listen_invalidations(self._redis, INVALIDATION_CHANNEL,
+                                                                  self._invalidate_local, self._clear_local))
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+
+    def stats(self):
+        return self._local.stats()
+
+    async def get(self, session: AsyncSession, client_id: uuid.UUID) -> Optional[ClientProfile]:
+        result = await self.get_many(session, [client_id])
+        return result.get(client_id)
+
+    async def get_many(self, session: AsyncSession,
+                       client_ids: Sequence[uuid.UUID]) -> dict[uuid.UUID, ClientProfile]:
+        # unknown ids are left out of the result and are not cached
+        result = {}
+        missing = set()
+        for client_id in client_ids:
+            profile = self._local.get(client_id)
+            if profile is None:
+                missing.add(client_id)
+            else:
+                result[client_id] = profile
+        if not missing:
+            return result
+
+        generation = self._generation
+        clients = client_model.Client.__table__
+        rows = await session.execute(select(clients.c.client_id, clients.c.login, clients.c.age,
+                                            clients.c.location, clients.c.gender)
+                                     .where(clients.c.client_id.in_(missing)))
+        for row in rows.all():
+            profile = ClientProfile(*row)
+            if generation == self._generation:
+                self._local.set(profile.client_id, profile)
+            result[profile.client_id] = profile
+        return result
+
+    async def invalidate_many(self, client_ids: Iterable[uuid.UUID]):
+        client_ids = list(client_ids)
+        if not client_ids:
+            return
+        self._invalidate_local(client_ids)
+        await publish_invalidation(self._redis, INVALIDATION_CHANNEL, client_ids)
+
+    async def clear(self):
+        self._clear_local()
+        await publish_invalidation(self._redis, INVALIDATION_CHANNEL, [])
+
+    def _invalidate_local(self, client_ids: list[uuid.UUID]):
+        self._generation += 1
+        self._local.invalidate_many(client_ids)
+
+    def _clear_local(self):
+        self._generation += 1
+        self._local.clear()
@@ -0,0 +1,46 @@
+import asyncio
+import logging
+import uuid
+from typing import Callable, Iterable
+
+from redis import asyncio as aioredis
+
+
+logger = logging.getLogger(__name__)
+
+
+# Messages are concatenated raw 16-byte UUIDs, so one publish can invalidate a whole bulk upsert.
+# An empty message drops every entry.
+
+async def publish_invalidation(redis: aioredis.Redis, channel: str, ids: Iterable[uuid.UUID]):
+    await redis.publish(channel, b''.join(id_.bytes for id_ in ids))
+
+
+def decode_ids(data: bytes):
+    return [uuid.UUID(bytes=data[i:i + 16]) for i in range(0, len(data), 16)]
+
+
+async def listen_invalidations(redis: aioredis.Redis, channel: str,
+                               on_invalidate: Callable[[list[uuid.UUID]], None],
+                               on_clear: Callable[[], None]):
+    # on_clear also runs every time the subscription becomes active,
+    # entries cached before that may have missed a message
+    while True:
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            on_clear()
+            async for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                if message['data']:
+                    on_invalidate(decode_ids(message['data']))
+                else:
+                    on_clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Subscription to %s failed, resubscribing", channel)
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
@@ -0,0 +1,169 @@
+import asyncio
+import os
+import uuid
+from typing import Iterable, Optional, Sequence
+
+from redis import asyncio as aioredis
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..db import ml_score_model
+from .invalidation import listen_invalidations, publish_invalidation
+from .lru import LRUCache
+
+
+INVALIDATION_CHANNEL = 'ml_scores:invalidate'
+
+# The Redis hash holds advertiser_id (16 raw bytes) -> score, plus a marker field so that
+# a client without any scores is still a cache hit.
+_LOADED_FIELD = b'_'
+
+# Every writer bumps the client's version key; a read-through load writes the hash only if the version it read
+# before the database query is unchanged, so a load racing a writer cannot store the scores it replaced.
+# KEYS: hash, version. ARGV: advertiser id, score, ttl
+_SET_IF_LOADED = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+"""
+
+# KEYS: hash, version. ARGV: version read before the load or '' for none, ttl, then field, value pairs
+_STORE_IF_UNCHANGED = """
+local version = redis.call('GET', KEYS[2]) or ''
+if version ~= ARGV[1] then
+    return 0
+end
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+def _scores_key(client_id: uuid.UUID):
+    return f'client:{client_id}:ml_scores'
+
+
+def _version_key(client_id: uuid.UUID):
+    return f'client:{client_id}:ml_scores:version'
+
+
+class MLScoreCache:
+    # Read path: local LRU -> Redis hash shared by workers -> ml_scores table.
+    # Writers update the Redis hash and publish the client ids, every worker drops its local entries for them.
+
+    def __init__(self, redis: aioredis.Redis, max_size: int = 100000, ttl: float = 60.0,
+                 redis_ttl: int = 86400):
+        self.redis_ttl = redis_ttl
+        self._redis = redis
+        self._local = LRUCache(max_size, ttl)
+        # bumped on every invalidation, a load that started before it must not be cached
+        self._generation = 0
+        self._set_if_loaded = redis.register_script(_SET_IF_LOADED)
+        self._store_if_unchanged = redis.register_script(_STORE_IF_UNCHANGED)
+        self._listener: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, redis: aioredis.Redis):
+        return cls(redis,
+                   max_size=int(os.getenv('ML_SCORE_CACHE_SIZE', '100000')),
+                   ttl=float(os.getenv('ML_SCORE_CACHE_TTL', '60')),
+                   redis_ttl=int(os.getenv('ML_SCORE_REDIS_TTL', '86400')))
+
+    def start(self):
+        self._listener = asyncio.create_task(listen_invalidations(self._redis, INVALIDATION_CHANNEL,
+                                                                  self._invalidate_local, self._clear_local))
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+
+    def stats(self):
+        return self._local.stats()
+
+    async def get(self, session: AsyncSession, client_id: uuid.UUID) -> dict[uuid.UUID, int]:
+        result = await self.get_many(session, [client_id])
+        return result[client_id]
+
+    async def get_many(self, session: AsyncSession,
+                       client_ids: Sequence[uuid.UUID]) -> dict[uuid.UUID, dict[uuid.UUID, int]]:
+        result = {}
+        missing = []
+        for client_id in client_ids:
+            scores = self._local.get(client_id)
+            if scores is None:
+                missing.append(client_id)
+            else:
+                result[client_id] = scores
+        if not missing:
+            return result
+
+        generation = self._generation
+        pipe = self._redis.pipeline(transaction=False)
+        for client_id in missing:
+            pipe.hgetall(_scores_key(client_id))
+            pipe.get(_version_key(client_id))
+        replies = await pipe.execute()
+        not_in_redis = {}
+        for client_id, data, version in zip(missing, replies[::2], replies[1::2]):
+            if not data:
+                not_in_redis[client_id] = version or b''
+                continue
+            scores = {uuid.UUID(bytes=advertiser_id): int(score)
+                      for advertiser_id, score in data.items() if advertiser_id != _LOADED_FIELD}
+            if generation == self._generation:
+                self._local.set(client_id, scores)
+            result[client_id] = scores
+        if not not_in_redis:
+            return result
+
+        loaded = {client_id: {} for client_id in not_in_redis}
+        rows = await session.execute(select(ml_score_model.MLScore.client_id,
+                                            ml_score_model.MLScore.advertiser_id,
+                                            ml_score_model.MLScore.score)
+                                     .where(ml_score_model.MLScore.client_id.in_(not_in_redis)))
+        for client_id, advertiser_id, score in rows.all():
+            loaded[client_id][advertiser_id] = score
+
+        pipe = self._redis.pipeline(transaction=False)
+        for client_id, scores in loaded.items():
+            fields = [_LOADED_FIELD, 1]
+            for advertiser_id, score in scores.items():
+                fields += [advertiser_id.bytes, score]
+            await self._store_if_unchanged(keys=[_scores_key(client_id), _version_key(client_id)],
+                                           args=[not_in_redis[client_id], self.redis_ttl, *fields], client=pipe)
+            if generation == self._generation:
+                self._local.set(client_id, scores)
+            result[client_id] = scores
+        await pipe.execute()
+        return result
+
+    async def set_score(self, client_id: uuid.UUID, advertiser_id: uuid.UUID, score: int):
+        await self._set_if_loaded(keys=[_scores_key(client_id), _version_key(client_id)],
+                                  args=[advertiser_id.bytes, score, self.redis_ttl])
+        self._invalidate_local([client_id])
+        await publish_invalidation(self._redis, INVALIDATION_CHANNEL, [client_id])
+
+    async def invalidate_many(self, client_ids: Iterable[uuid.UUID]):
+        client_ids = list(client_ids)
+        if not client_ids:
+            return
+        self._invalidate_local(client_ids)
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.delete(*[_scores_key(client_id) for client_id in client_ids])
+        for client_id in client_ids:
+            pipe.incr(_version_key(client_id))
+            pipe.expire(_version_key(client_id), self.redis_ttl)
+        await pipe.execute()
+        await publish_invalidation(self._redis, INVALIDATION_CHANNEL, client_ids)
+
+    def _invalidate_local(self, client_ids: list[uuid.UUID]):
+        self._generation += 1
+        self._local.invalidate_many(client_ids)
+
+    def _clear_local(self):
+        self._generation += 1
+        self._local.clear()
@@ -1,5 +1,8 @@
+from . import action_day_model
 from . import action_model
 from . import advertiser_model
 from . import campaign_model
+from . import campaign_stats_model
+from . import click_model
 from . import client_model
 from . import ml_score_model
@@ -0,0 +1,10 @@
+from sqlalchemy import Column, Integer, Boolean
+from .db_session import SqlAlchemyBase
+
+
+class ActionDay(SqlAlchemyBase):
+    # one row per partition of `actions`; a sealed day has its rollup reconciled and the partition frozen
+    __tablename__ = 'action_days'
+    day = Column(Integer, primary_key=True, autoincrement=False)
+    sealed = Column(Boolean, nullable=False, default=False)
+    detached = Column(Boolean, nullable=False, default=False)
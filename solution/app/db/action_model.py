@@ -1,19 +1,25 @@
 import uuid
 
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, Float, String, ForeignKey, Integer
+from sqlalchemy import Column, Float, String, ForeignKey, Integer, Index
 from sqlalchemy.dialects.postgresql import UUID
 from .db_session import SqlAlchemyBase
 
 
 class Action(SqlAlchemyBase):
     __tablename__ = 'actions'
+    # partitioned by day (see action_partitions); unique indexes have to include the partition key
+    __table_args__ = (
+        Index('ix_actions_client_campaign_action_day', 'client_id', 'campaign_id', 'action', 'day', unique=True),
+        Index('ix_actions_campaign_day', 'campaign_id', 'day'),
+        {'postgresql_partition_by': 'RANGE (day)'},
+    )
     action_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     client_id = Column(UUID(as_uuid=True), ForeignKey("clients.client_id"))
     campaign_id = Column(UUID(as_uuid=True), ForeignKey("campaigns.campaign_id"))
     cost = Column(Float, nullable=False)
     action = Column(String, nullable=False)
-    day = Column(Integer, nullable=False)
+    day = Column(Integer, primary_key=True, autoincrement=False)
 
     campaign = relationship("Campaign", back_populates="actions", uselist=False)
     client = relationship("Client", back_populates="actions", uselist=False)
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from . import db_session
+from . import action_day_model
+from . import stats_rollup
+
+
+logger = logging.getLogger(__name__)
+
+# serializes partition DDL of all workers
+_DDL_LOCK_ID = 7310412
+
+ActionDay = action_day_model.ActionDay
+
+
+def partition_name(day: int):
+    return f'actions_d{day}'
+
+
+def archive_name(day: int):
+    return f'actions_archive_d{day}'
+
+
+_known_days: set[int] = set()
+
+
+async def ensure_partition(day: int):
+    # must complete before `day` is published, otherwise workers could write actions nobody can store
+    if day in _known_days:
+        return
+    async with db_session.session_factory() as session:
+        await session.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': _DDL_LOCK_ID})
+        await session.execute(text(f'CREATE TABLE IF NOT EXISTS {partition_name(day)} PARTITION OF actions '
+                                   f'FOR VALUES FROM ({day}) TO ({day + 1})'))
+        # a day that was detached earlier gets a fresh, empty partition
+        await session.execute(insert(ActionDay).values(day=day)
+                              .on_conflict_do_update(index_elements=['day'],
+                                                     set_={'sealed': False, 'detached': False},
+                                                     where=ActionDay.detached))
+        await session.commit()
+    _known_days.add(day)
+
+
+def rename_unpartitioned_actions(connection):
+    # an `actions` table created before partitioning is moved aside; its indexes are dropped
+    # because their names are taken by the indexes of the partitioned table
+    relkind = connection.execute(text("SELECT relkind::text FROM pg_class "
+                                      "WHERE oid = to_regclass('actions')")).scalar()
+    if relkind != 'r':
+        return
+    logger.warning("Converting the actions table to a partitioned one")
+    connection.execute(text('ALTER TABLE actions RENAME TO actions_unpartitioned'))
+    connection.execute(text('ALTER TABLE actions_unpartitioned DROP CONSTRAINT IF EXISTS actions_pkey'))
+    indexes = connection.execute(text("SELECT indexname FROM pg_indexes "
+                                      "WHERE tablename = 'actions_unpartitioned'")).scalars().all()
+    for index in indexes:
+        connection.execute(text(f'DROP INDEX {index}'))
+
+
+def copy_unpartitioned_actions(connection):
+    if connection.execute(text("SELECT to_regclass('actions_unpartitioned')")).scalar() is None:
+        return
+    days = connection.execute(text('SELECT DISTINCT day FROM actions_unpartitioned')).scalars().all()
+    for day in days:
+        connection.execute(text(f'CREATE TABLE IF NOT EXISTS {partition_name(day)} PARTITION OF actions '
+                                f'FOR VALUES FROM ({day}) TO ({day + 1})'))
+        connection.execute(insert(ActionDay).values(day=day).on_conflict_do_nothing())
+    connection.execute(text('INSERT INTO actions (action_id, client_id, campaign_id, cost, action, day) '
+                            'SELECT action_id, client_id, campaign_id, cost, action, day FROM actions_unpartitioned'))
+    connection.execute(text('DROP TABLE actions_unpartitioned'))
+    logger.warning("Moved actions of %d days into partitions", len(days))
+
+
+class DayCompactor:
+    # Runs after the day advances. Every finished day is sealed: its campaign_daily_stats rows are recomputed
+    # from the partition (they are maintained incrementally, this fixes any drift) and the partition is
+    # frozen, so autovacuum has nothing left to do there. With `retention_days` set, partitions older than
+    # that are detached from `actions` and kept as actions_archive_d{day} tables, or dropped.
+    # A day is sealed after `action_writer` has written the rows queued for it; writers of other workers are
+    # waited for only while their batches are in flight, the rows they send later are rejected.
+
+    def __init__(self, retention_days: Optional[int] = None, drop_detached: bool = False):
+        self.retention_days = retention_days
+        self.drop_detached = drop_detached
+        self._current_day = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.action_writer = None
+
+    @classmethod
+    def from_env(cls):
+        retention_days = os.getenv('ACTIONS_RETENTION_DAYS')
+        return cls(retention_days=int(retention_days) if retention_days else None,
+                   drop_detached=os.getenv('ACTIONS_DROP_DETACHED', '0') == '1')
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def day_advanced(self, day: int):
+        self._current_day = day
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                await self.compact(self._current_day)
+            except Exception:
+                logger.exception("Day compaction failed")
+
+    async def compact(self, current_day: int):
+        async with db_session.session_factory() as session:
+            days = await session.execute(select(ActionDay.day)
+                                         .where(~ActionDay.sealed, ~ActionDay.detached, ActionDay.day < current_day)
+                                         .order_by(ActionDay.day))
+            days = days.scalars().all()
+        if days and self.action_writer is not None:
+            await self.action_writer.flushed(days[-1])
+        for day in days:
+            await self._seal(day)
+
+        if self.retention_days is None:
+            return
+        async with db_session.session_factory() as session:
+            days = await session.execute(select(ActionDay.day)
+                                         .where(~ActionDay.detached,
+                                                ActionDay.day < current_day - self.retention_days)
+                                         .order_by(ActionDay.day))
+            days = days.scalars().all()
+        for day in days:
+            await self._detach(day)
+
+    @staticmethod
+    async def _locked_day(session, day: int):
+        # another worker compacting the same day holds the row, it is skipped here
+        result = await session.execute(select(ActionDay).where(ActionDay.day == day)
+                                       .with_for_update(skip_locked=True))
+        return result.scalar_one_or_none()
+
+    async def _seal(self, day: int):
+        async with db_session.session_factory() as session:
+            action_day = await self._locked_day(session, day)
+            if action_day is None or action_day.sealed:
+                return
+            rows = await stats_rollup.rebuild_partition(session, 'day', [day, day])
+            action_day.sealed = True
+            await session.commit()
+
+        async with db_session.engine.connect() as connection:
+            connection = await connection.execution_options(isolation_level='AUTOCOMMIT')
+            await connection.execute(text(f'VACUUM (FREEZE, ANALYZE) {partition_name(day)}'))
+        logger.info("Sealed day %d (%d campaign rows corrected)", day, rows)
+
+    async def _detach(self, day: int):
+        async with db_session.session_factory() as session:
+            action_day = await self._locked_day(session, day)
+            if action_day is None or action_day.detached:
+                return
+            await session.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': _DDL_LOCK_ID})
+            await session.execute(text(f'ALTER TABLE actions DETACH PARTITION {partition_name(day)}'))
+            if self.drop_detached:
+                await session.execute(text(f'DROP TABLE {partition_name(day)}'))
+            else:
+                archived = await session.execute(text('SELECT to_regclass(:name)'), {'name': archive_name(day)})
+                if archived.scalar() is None:
+                    await session.execute(text(f'ALTER TABLE {partition_name(day)} RENAME TO {archive_name(day)}'))
+                else:
+                    # the day was recreated after an earlier detach
+                    await session.execute(text(f'INSERT INTO {archive_name(day)} '
+                                               f'SELECT * FROM {partition_name(day)}'))
+                    await session.execute(text(f'DROP TABLE {partition_name(day)}'))
+            action_day.detached = True
+            await session.commit()
+        _known_days.discard(day)
+        logger.info("Detached the actions partition of day %d", day)
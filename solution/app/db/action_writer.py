@@ -0,0 +1,228 @@
+import asyncio
+import collections
+import logging
+import os
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+from . import db_session
+from . import action_day_model
+from . import action_model
+from . import campaign_model
+from . import client_model
+from . import stats_rollup
+from ..monitoring.metrics import ACTION_WRITE_FAILURES, ACTIONS_LATE
+
+
+logger = logging.getLogger(__name__)
+
+_FOREIGN_KEY_VIOLATION = '23503'
+
+
+class ActionQueueFull(Exception):
+    pass
+
+
+class ActionWriter:
+    # Handlers enqueue Action rows, a background task writes them with one multi-row INSERT per batch
+    # and adds them to campaign_daily_stats.
+    # A row waits at most `flush_interval` seconds (plus the duration of the write in progress) before
+    # it is sent to Postgres; `put` and `put_many` block for up to `put_timeout` when the queue is full.
+    # Rows of a day that is already sealed are rejected, see `flushed` and DayCompactor.
+
+    def __init__(self, flush_interval: float = 0.05, batch_size: int = 500,
+                 queue_size: int = 10000, put_timeout: float = 1.0):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._batch_ready = asyncio.Event()
+        # notified whenever the writer takes rows off the queue
+        self._room = asyncio.Condition()
+        # rows queued or being written, by day; notified whenever a batch is done
+        self._pending: collections.Counter = collections.Counter()
+        self._drained = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        # called with the campaign and advertiser ids of every committed batch
+        self.on_written: Optional[Callable[[set, set], Awaitable]] = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(flush_interval=int(os.getenv('ACTIONS_FLUSH_INTERVAL_MS', '50')) / 1000,
+                   batch_size=int(os.getenv('ACTIONS_BATCH_SIZE', '500')),
+                   queue_size=int(os.getenv('ACTIONS_QUEUE_SIZE', '10000')),
+                   put_timeout=int(os.getenv('ACTIONS_ENQUEUE_TIMEOUT_MS', '1000')) / 1000)
+
+    @staticmethod
+    def new_action(client_id: uuid.UUID, campaign_id: uuid.UUID, cost: float, action: str, day: int):
+        return {'action_id': uuid.uuid4(), 'client_id': client_id, 'campaign_id': campaign_id,
+                'cost': cost, 'action': action, 'day': day}
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # the sentinel goes behind everything already queued, so the writer drains the queue before exiting
+        self._stopping = True
+        await self._queue.put(None)
+        self._batch_ready.set()
+        await self._task
+
+    async def put(self, action: dict):
+        try:
+            await asyncio.wait_for(self._queue.put(action), timeout=self.put_timeout)
+        except asyncio.TimeoutError:
+            raise ActionQueueFull()
+        self._pending[action['day']] += 1
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    async def put_many(self, actions: list[dict]):
+        # all or nothing: waits until every row fits, so that a failed call leaves none of them queued
+        maxsize = self._queue.maxsize
+        if maxsize > 0:
+            if len(actions) > maxsize:
+                raise ActionQueueFull()
+            try:
+                async with self._room:
+                    await asyncio.wait_for(self._room.wait_for(lambda: maxsize - self._queue.qsize() >= len(actions)),
+                                           timeout=self.put_timeout)
+            except asyncio.TimeoutError:
+                raise ActionQueueFull()
+        for action in actions:
+            self._queue.put_nowait(action)
+            self._pending[action['day']] += 1
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            if batch[0] is None:
+                return
+            if self._queue.qsize() + 1 < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_ready.clear()
+
+            stopping = False
+            while len(batch) < self.batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            async with self._room:
+                self._room.notify_all()
+            await self._write(batch)
+            for action in batch:
+                self._pending[action['day']] -= 1
+                if not self._pending[action['day']]:
+                    del self._pending[action['day']]
+            async with self._drained:
+                self._drained.notify_all()
+            if stopping:
+                return
+
+    async def flushed(self, day: int):
+        # waits until every row of `day` and earlier days queued so far is written (or dropped)
+        async with self._drained:
+            await self._drained.wait_for(lambda: all(pending_day > day for pending_day in self._pending))
+
+    async def _write(self, batch: list[dict]):
+        # A failed batch is held and retried rather than dropped: while it is, the queue fills up and handlers
+        # get backpressure. Only rows of deleted campaigns or clients are dropped, and on shutdown a batch
+        # that keeps failing is given up after a few attempts.
+        attempt = 0
+        while True:
+            try:
+                async with db_session.session_factory() as session:
+                    batch = await self._reject_sealed(session, batch)
+                    if not batch:
+                        return
+                    inserted = await session.execute(
+                        insert(action_model.Action)
+                        .on_conflict_do_nothing(index_elements=['client_id', 'campaign_id', 'action', 'day'])
+                        .returning(action_model.Action.campaign_id, action_model.Action.day,
+                                   action_model.Action.action, action_model.Action.cost), batch)
+                    # the rollup is updated in the same transaction, so it never disagrees with actions
+                    inserted = inserted.all()
+                    await stats_rollup.add_actions(session, inserted)
+                    advertisers = None
+                    if self.on_written is not None and inserted:
+                        advertisers = await session.execute(
+                            select(campaign_model.Campaign.campaign_id, campaign_model.Campaign.advertiser_id)
+                            .where(campaign_model.Campaign.campaign_id.in_({row[0] for row in inserted})))
+                        advertisers = advertisers.all()
+                    await session.commit()
+                if advertisers:
+                    await self._notify(advertisers)
+                return
+            except IntegrityError as e:
+                if getattr(e.orig, 'sqlstate', None) != _FOREIGN_KEY_VIOLATION:
+                    await self._failed(batch, e, attempt)
+                else:
+                    # the campaign or the client was deleted while its action was waiting in the queue
+                    batch = await self._drop_orphans(batch)
+                    if not batch:
+                        return
+            except Exception as e:
+                await self._failed(batch, e, attempt)
+            attempt += 1
+            if self._stopping and attempt >= 3:
+                logger.error("Dropped %d actions after %d attempts on shutdown", len(batch), attempt)
+                return
+
+    @staticmethod
+    async def _reject_sealed(session, batch: list[dict]):
+        # a day is sealed once the compactor has waited for this worker's rows of it; rows that still come
+        # (from another worker, or with a stale day) would land in a reconciled and frozen partition
+        days = {action['day'] for action in batch}
+        await stats_rollup.lock_days(session, days)
+        sealed = await session.execute(select(action_day_model.ActionDay.day)
+                                       .where(action_day_model.ActionDay.day.in_(days),
+                                              action_day_model.ActionDay.sealed))
+        sealed = set(sealed.scalars().all())
+        if not sealed:
+            return batch
+        result = [action for action in batch if action['day'] not in sealed]
+        ACTIONS_LATE.inc(len(batch) - len(result))
+        logger.warning("Rejected %d actions of sealed days %s", len(batch) - len(result), sorted(sealed))
+        return result
+
+    async def _failed(self, batch: list[dict], error: Exception, attempt: int):
+        ACTION_WRITE_FAILURES.labels(error.__class__.__name__).inc()
+        logger.error("Failed to write %d actions (attempt %d), retrying", len(batch), attempt + 1,
+                     exc_info=error)
+        await asyncio.sleep(min(0.1 * 2 ** attempt, 5.0))
+
+    async def _notify(self, advertisers: list):
+        try:
+            await self.on_written({campaign_id for campaign_id, _ in advertisers},
+                                  {advertiser_id for _, advertiser_id in advertisers})
+        except Exception:
+            logger.exception("Action listener failed")
+
+    @staticmethod
+    async def _drop_orphans(batch: list[dict]):
+        async with db_session.session_factory() as session:
+            campaigns = await session.execute(select(campaign_model.Campaign.campaign_id)
+                                              .where(campaign_model.Campaign.campaign_id
+                                                     .in_({action['campaign_id'] for action in batch})))
+            clients = await session.execute(select(client_model.Client.client_id)
+                                            .where(client_model.Client.client_id
+                                                   .in_({action['client_id'] for action in batch})))
+        campaign_ids = set(campaigns.scalars().all())
+        client_ids = set(clients.scalars().all())
+        result = [action for action in batch
+                  if action['campaign_id'] in campaign_ids and action['client_id'] in client_ids]
+        if len(result) < len(batch):
+            logger.warning("Dropped %d actions of deleted campaigns or clients", len(batch) - len(result))
+        return result
@@ -0,0 +1,173 @@
+import tempfile
+import uuid
+from typing import IO, AsyncIterator, Awaitable, Callable, Optional
+
+from pydantic import BaseModel
+from sqlalchemy import Table, and_, column, distinct, exists, func, select, table, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import advertiser_model
+from . import client_model
+from . import ml_score_model
+
+
+CHUNK_SIZE = 5000
+MAX_REPORTED_ERRORS = 1000
+
+
+class ImportTarget:
+    def __init__(self, table_: Table, key: tuple[str, ...], unique: Optional[str] = None,
+                 generated: Optional[dict] = None):
+        self.table = table_
+        # columns of the unique index used by ON CONFLICT
+        self.key = key
+        # a column with a unique index besides the key, rows taking a value of another row are rejected
+        self.unique = unique
+        # columns filled in by the merge, e.g. a surrogate primary key
+        self.generated = generated or {}
+        self.columns = [c.name for c in table_.columns if c.name not in self.generated]
+
+
+CLIENTS = ImportTarget(client_model.Client.__table__, ('client_id',), unique='login')
+ADVERTISERS = ImportTarget(advertiser_model.Advertiser.__table__, ('advertiser_id',))
+ML_SCORES = ImportTarget(ml_score_model.MLScore.__table__, ('client_id', 'advertiser_id'),
+                         generated={'ml_score_id': func.gen_random_uuid()})
+
+
+class StagingTable:
+    # Valid rows are copied with COPY into a temporary table, which is merged into the target table in one
+    # statement. Everything happens in the session transaction, the staging table is dropped on commit.
+
+    def __init__(self, session: AsyncSession, target: ImportTarget):
+        self.session = session
+        self.target = target
+        self.name = f'{target.table.name}_import'
+        self.staging = table(self.name, column('line'), *[column(name) for name in target.columns])
+
+    async def create(self):
+        # the columns get the types of the target table, without its constraints
+        await self.session.execute(text(f'CREATE TEMPORARY TABLE {self.name} ON COMMIT DROP AS '
+                                         f'SELECT NULL::bigint AS line, {", ".join(self.target.columns)} '
+                                         f'FROM {self.target.table.name} WITH NO DATA'))
+
+    async def copy(self, rows: list[tuple]):
+        connection = await self.session.connection()
+        raw_connection = await connection.get_raw_connection()
+        await raw_connection.driver_connection.copy_records_to_table(self.name, records=rows,
+                                                                     columns=['line', *self.target.columns])
+
+    async def reject_conflicts(self) -> tuple[int, list[tuple[int, str]]]:
+        # A key repeated in the file is not an error, its last row wins. Rows referencing missing rows of other
+        # tables are rejected, as are rows whose unique value belongs to another existing row or to an earlier
+        # row of the file.
+        staging = self.staging
+        key = [staging.c[name] for name in self.target.key]
+        await self.session.execute(text(f'ANALYZE {self.name}'))
+        latest = select(staging.c.line, func.row_number().over(partition_by=key, order_by=staging.c.line.desc())
+                        .label('n')).subquery()
+        await self.session.execute(staging.delete().where(
+            staging.c.line.in_(select(latest.c.line).where(latest.c.n > 1))))
+
+        checks = []
+        for foreign_key in self.target.table.foreign_keys:
+            value = staging.c[foreign_key.parent.name]
+            missing = select(staging.c.line).where(~exists().where(foreign_key.column == value))
+            checks.append((missing, value, "not found"))
+        if self.target.unique is not None:
+            value = staging.c[self.target.unique]
+            target = self.target.table
+            owned = (select(staging.c.line).join(target, target.c[self.target.unique] == value)
+                     .where(~and_(*[target.c[name] == staging.c[name] for name in self.target.key])))
+            first = select(staging.c.line, func.row_number().over(partition_by=value, order_by=staging.c.line)
+                           .label('n')).subquery()
+            # rows owned by other existing rows go first, so that they do not shadow valid rows of the file
+            checks.append((owned, value, "is already registered"))
+            checks.append((select(first.c.line).where(first.c.n > 1), value, "is already registered"))
+
+        count = 0
+        errors = []
+        for rejected_lines, value, message in checks:
+            deleted = (staging.delete().where(staging.c.line.in_(rejected_lines))
+                       .returning(staging.c.line, value.label('value')).cte('deleted'))
+            rejected = await self.session.execute(select(deleted.c.line, deleted.c.value, func.count().over())
+                                                  .order_by(deleted.c.line).limit(MAX_REPORTED_ERRORS))
+            rejected = rejected.all()
+            if rejected:
+                count += rejected[0][2]
+                errors += [(line, f"{value.name} {rejected_value} {message}")
+                           for line, rejected_value, _ in rejected]
+        return count, errors
+
+    async def merge(self) -> int:
+        staging = self.staging
+        generated = list(self.target.generated)
+        statement = insert(self.target.table).from_select(
+            self.target.columns + generated,
+            # rows are written in key order, so that concurrent imports of the same rows do not deadlock
+            select(*[staging.c[name] for name in self.target.columns],
+                   *[self.target.generated[name] for name in generated])
+            .order_by(*[staging.c[name] for name in self.target.key]))
+        statement = statement.on_conflict_do_update(
+            index_elements=list(self.target.key),
+            set_={name: statement.excluded[name] for name in self.target.columns if name not in self.target.key})
+        result = await self.session.execute(statement)
+        return result.rowcount
+
+    async def spool_ids(self, name: str) -> IO[bytes]:
+        # Distinct uuids of a column of the merged rows, as raw 16-byte values in a temporary file. Caches are
+        # invalidated after the commit, when the staging table is already gone, and the ids may not fit in memory.
+        spool = tempfile.TemporaryFile()
+        result = await self.session.stream(select(distinct(self.staging.c[name])))
+        async for partition in result.partitions(CHUNK_SIZE):
+            spool.write(b''.join(row[0].bytes for row in partition))
+        spool.seek(0)
+        return spool
+
+
+def read_spooled_ids(spool: IO[bytes], batch_size: int = CHUNK_SIZE):
+    with spool:
+        while data := spool.read(16 * batch_size):
+            yield [uuid.UUID(bytes=data[i:i + 16]) for i in range(0, len(data), 16)]
+
+
+async def import_rows(staging: StagingTable, rows: AsyncIterator,
+                      progress: Optional[Callable[[int], Awaitable]] = None) -> dict:
+    # `rows` yields (line number, model or None, error or None), see importing.readers.parse_rows;
+    # `progress` is called with the number of rows read after every chunk
+    target = staging.target
+    await staging.create()
+    total = 0
+    errors_count = 0
+    errors = []
+    chunk = []
+    async for line, model, error in rows:
+        total += 1
+        if error is not None:
+            errors_count += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append((line, error))
+            continue
+        chunk.append(_record(line, model, target))
+        if len(chunk) >= CHUNK_SIZE:
+            await staging.copy(chunk)
+            chunk = []
+            if progress is not None:
+                await progress(total)
+    if chunk:
+        await staging.copy(chunk)
+
+    rejected_count, rejected = await staging.reject_conflicts()
+    imported = await staging.merge()
+    errors = sorted(errors + rejected)[:MAX_REPORTED_ERRORS]
+    return {'rows': total, 'imported': imported, 'errors_count': errors_count + rejected_count,
+            'errors': [{'line': line, 'error': error} for line, error in errors]}
+
+
+def _record(line: int, model: BaseModel, target: ImportTarget):
+    values = [line]
+    for name in target.columns:
+        value = getattr(model, name)
+        # enum members are written as their values
+        values.append(getattr(value, 'value', value))
+    return tuple(values)
@@ -9,7 +9,7 @@ from .db_session import SqlAlchemyBase
 class Campaign(SqlAlchemyBase):
     __tablename__ = 'campaigns'
     campaign_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    advertiser_id = Column(UUID(as_uuid=True), ForeignKey("advertisers.advertiser_id"))
+    advertiser_id = Column(UUID(as_uuid=True), ForeignKey("advertisers.advertiser_id"), index=True)
     impressions_limit = Column(Integer, nullable=False)
     clicks_limit = Column(Integer, nullable=False)
     cost_per_impression = Column(Float, nullable=False)
@@ -26,3 +26,7 @@ class Campaign(SqlAlchemyBase):
     advertiser = relationship("Advertiser", back_populates="campaigns", uselist=False)
     actions = relationship("Action", back_populates="campaign",
                            cascade="all, delete", uselist=True)
+    daily_stats = relationship("CampaignDailyStats", back_populates="campaign",
+                               cascade="all, delete", uselist=True)
+    clicks = relationship("Click", back_populates="campaign",
+                          cascade="all, delete", uselist=True)
@@ -0,0 +1,16 @@
+from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Float, ForeignKey, Integer
+from sqlalchemy.dialects.postgresql import UUID
+from .db_session import SqlAlchemyBase
+
+
+class CampaignDailyStats(SqlAlchemyBase):
+    __tablename__ = 'campaign_daily_stats'
+    campaign_id = Column(UUID(as_uuid=True), ForeignKey("campaigns.campaign_id"), primary_key=True)
+    day = Column(Integer, primary_key=True)
+    impressions_count = Column(Integer, nullable=False, default=0)
+    clicks_count = Column(Integer, nullable=False, default=0)
+    spent_impressions = Column(Float, nullable=False, default=0)
+    spent_clicks = Column(Float, nullable=False, default=0)
+
+    campaign = relationship("Campaign", back_populates="daily_stats", uselist=False)
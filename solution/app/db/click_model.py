@@ -0,0 +1,19 @@
+from sqlalchemy.orm import relationship
+from sqlalchemy import Column, ForeignKey, Integer, Index
+from sqlalchemy.dialects.postgresql import UUID
+from .db_session import SqlAlchemyBase
+
+
+class Click(SqlAlchemyBase):
+    # one row per clicked (campaign, client) pair; unlike `actions` it is not partitioned,
+    # so a click is still known after the partition of its day is detached
+    __tablename__ = 'clicks'
+    __table_args__ = (
+        Index('ix_clicks_client_id', 'client_id'),
+    )
+    campaign_id = Column(UUID(as_uuid=True), ForeignKey("campaigns.campaign_id"), primary_key=True)
+    client_id = Column(UUID(as_uuid=True), ForeignKey("clients.client_id"), primary_key=True)
+    day = Column(Integer, nullable=False)
+
+    campaign = relationship("Campaign", back_populates="clicks", uselist=False)
+    client = relationship("Client", back_populates="clicks", uselist=False)
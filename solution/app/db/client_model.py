@@ -10,7 +10,7 @@ from .db_session import SqlAlchemyBase
 class Client(SqlAlchemyBase):
     __tablename__ = 'clients'
     client_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    login = Column(String, nullable=False)
+    login = Column(String, nullable=False, unique=True, index=True)
     age = Column(Integer, nullable=False)
     location = Column(String, nullable=False)
     gender = Column(String, nullable=True)
@@ -19,3 +19,5 @@ class Client(SqlAlchemyBase):
                              cascade="all, delete", uselist=True)
     actions = relationship("Action", back_populates="client",
                            cascade="all, delete", uselist=True)
+    clicks = relationship("Click", back_populates="client",
+                          cascade="all, delete", uselist=True)
@@ -1,7 +1,13 @@
 import os
+import time
 
+from sqlalchemy import text
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from ..monitoring.metrics import DB_POOL_CHECKOUT_WAIT
+from ..monitoring.sql import instrument_engine_from_env
 
 
 SqlAlchemyBase = declarative_base()
@@ -10,6 +16,16 @@ engine = None
 session_factory = None
 
 
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    # the pool has no event before a checkout starts, so the wait is measured around _do_get
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+
 async def global_init():
     global engine, session_factory
 
@@ -20,13 +36,48 @@ async def global_init():
 
     print(f"Connection to {url_connection}")
 
-    engine = create_async_engine(url_connection, echo=False)
+    engine = create_async_engine(url_connection, echo=False, poolclass=TimedQueuePool)
+    instrument_engine_from_env(engine)
     session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
     from . import __all_models
+    from . import action_partitions
 
     async with engine.begin() as conn:
+        # workers start at the same time, the schema is created (or converted) by one of them at a time
+        await conn.execute(text('SELECT pg_advisory_xact_lock(7310411)'))
+        clicks_missing = (await conn.execute(text("SELECT to_regclass('clicks') IS NULL"))).scalar()
+        await conn.run_sync(action_partitions.rename_unpartitioned_actions)
         await conn.run_sync(SqlAlchemyBase.metadata.create_all)
+        await conn.run_sync(_remove_duplicate_ml_scores)
+        await conn.run_sync(_create_missing_indexes)
+        await conn.run_sync(action_partitions.copy_unpartitioned_actions)
+        if clicks_missing:
+            await conn.run_sync(_copy_clicks)
+
+
+def _remove_duplicate_ml_scores(connection):
+    # scores written before the unique index existed may repeat a (client, advertiser) pair
+    if connection.execute(text("SELECT to_regclass('ix_ml_scores_client_advertiser')")).scalar() is not None:
+        return
+    connection.execute(text('DELETE FROM ml_scores a USING ml_scores b '
+                            'WHERE a.client_id = b.client_id AND a.advertiser_id = b.advertiser_id '
+                            'AND a.ml_score_id < b.ml_score_id'))
+
+
+def _copy_clicks(connection):
+    # clicks recorded before the clicks table existed are only in the attached partitions of `actions`
+    connection.execute(text("INSERT INTO clicks (campaign_id, client_id, day) "
+                            "SELECT campaign_id, client_id, min(day) FROM actions "
+                            "WHERE action = 'click' AND campaign_id IS NOT NULL AND client_id IS NOT NULL "
+                            "GROUP BY campaign_id, client_id"))
+
+
+def _create_missing_indexes(connection):
+    # create_all skips tables that already exist, so indexes added to existing models are created here
+    for table in SqlAlchemyBase.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
 
 
 async def create_session():
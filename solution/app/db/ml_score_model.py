@@ -1,13 +1,14 @@
 import uuid
 
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, Integer, ForeignKey
+from sqlalchemy import Column, Integer, ForeignKey, Index
 from sqlalchemy.dialects.postgresql import UUID
 from .db_session import SqlAlchemyBase
 
 
 class MLScore(SqlAlchemyBase):
     __tablename__ = 'ml_scores'
+    __table_args__ = (Index('ix_ml_scores_client_advertiser', 'client_id', 'advertiser_id', unique=True),)
     ml_score_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     client_id = Column(UUID(as_uuid=True), ForeignKey("clients.client_id"))
     advertiser_id = Column(UUID(as_uuid=True), ForeignKey("advertisers.advertiser_id"))
@@ -0,0 +1,162 @@
+import uuid
+from typing import Iterable
+
+from sqlalchemy import and_, column, delete, func, literal, or_, select, table, text, true, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import action_day_model
+from . import action_model
+from . import campaign_stats_model
+
+
+COUNTERS = ('impressions_count', 'clicks_count', 'spent_impressions', 'spent_clicks')
+
+# advisory lock classes of rebuild_partition: stripes of the campaign_id space and days
+_STRIPES_LOCK_CLASS = 7310413
+_DAYS_LOCK_CLASS = 7310414
+REBUILD_STRIPES = 256
+
+
+def add_on_conflict(statement):
+    # turns an INSERT into campaign_daily_stats into "add these numbers to the existing row"
+    table = campaign_stats_model.CampaignDailyStats.__table__
+    return statement.on_conflict_do_update(index_elements=['campaign_id', 'day'],
+                                           set_={name: table.c[name] + statement.excluded[name]
+                                                 for name in COUNTERS})
+
+
+def aggregate(actions: Iterable) -> list[dict]:
+    # `actions` are (campaign_id, day, action, cost) rows that were actually inserted into actions
+    rows = {}
+    for campaign_id, day, action, cost in actions:
+        row = rows.get((campaign_id, day))
+        if row is None:
+            row = rows[(campaign_id, day)] = {'campaign_id': campaign_id, 'day': day, 'impressions_count': 0,
+                                              'clicks_count': 0, 'spent_impressions': 0.0, 'spent_clicks': 0.0}
+        if action == 'click':
+            row['clicks_count'] += 1
+            row['spent_clicks'] += cost
+        else:
+            row['impressions_count'] += 1
+            row['spent_impressions'] += cost
+    # a fixed order of row locks keeps concurrent writers of the same campaigns from deadlocking
+    return [rows[key] for key in sorted(rows)]
+
+
+async def add_actions(session: AsyncSession, actions: Iterable):
+    rows = aggregate(actions)
+    if rows:
+        await session.execute(add_on_conflict(insert(campaign_stats_model.CampaignDailyStats.__table__)), rows)
+
+
+async def lock_days(session: AsyncSession, days: Iterable[int]):
+    # writers hold the days they write to in shared mode until their commit, so rebuilding a day waits
+    # for the batches in flight; ascending order, like the rebuild
+    await session.execute(text('SELECT count(pg_advisory_xact_lock_shared(CAST(:class AS integer), day)) '
+                               'FROM unnest(CAST(:days AS integer[])) AS day'),
+                          {'class': _DAYS_LOCK_CLASS, 'days': sorted(days)})
+
+
+async def _lock_partition(session: AsyncSession, by: str, chunk: list):
+    # Two rebuilds of overlapping partitions would both apply the same correction, so they wait for each other.
+    # A campaign range locks the stripes of the campaign_id space it touches. A range of days locks its days
+    # and, since it covers every campaign, all stripes in shared mode, so day ranges only wait for each other
+    # on common days. Stripes are always locked before days and in ascending order.
+    if by == 'day':
+        first_stripe, last_stripe, lock = 0, REBUILD_STRIPES - 1, 'pg_advisory_xact_lock_shared'
+    else:
+        lower, upper = chunk
+        shift = 128 - (REBUILD_STRIPES - 1).bit_length()
+        first_stripe = 0 if lower is None else uuid.UUID(lower).int >> shift
+        last_stripe = REBUILD_STRIPES - 1 if upper is None else (uuid.UUID(upper).int - 1) >> shift
+        lock = 'pg_advisory_xact_lock'
+    await session.execute(text(f'SELECT count({lock}(CAST(:class AS integer), stripe)) '
+                               f'FROM generate_series(CAST(:first AS integer), CAST(:last AS integer)) AS stripe'),
+                          {'class': _STRIPES_LOCK_CLASS, 'first': first_stripe, 'last': last_stripe})
+    if by == 'day':
+        await session.execute(text('SELECT count(pg_advisory_xact_lock(CAST(:class AS integer), day)) '
+                                   'FROM generate_series(CAST(:first AS integer), CAST(:last AS integer)) AS day'),
+                              {'class': _DAYS_LOCK_CLASS, 'first': chunk[0], 'last': chunk[1]})
+
+
+async def rebuild_partition(session: AsyncSession, by: str, chunk: list) -> int:
+    # Recomputes the rollup rows of one partition from actions, a chunk of days [first, last] or a campaign_chunks
+    # range depending on `by`; returns the number of rows that had to be corrected. Safe to run next to live
+    # writers, which add to actions and to the rollup in one transaction: the totals and the rollup rows are read
+    # in one statement, i.e. from one snapshot, without locking anything, and every differing row is then set to
+    # its total plus whatever writers added to it since that snapshot. Only those rows are locked, in key order,
+    # and only until the commit. Rows left at zero had no actions and are removed.
+    # Days whose actions partition was detached keep their rows, they cannot be recomputed.
+    rollup = campaign_stats_model.CampaignDailyStats.__table__
+    actions = action_model.Action.__table__
+    columns = ['campaign_id', 'day', *COUNTERS]
+    detached_days = select(action_day_model.ActionDay.day).where(action_day_model.ActionDay.detached)
+    where = chunk_filter(by, chunk)
+
+    await _lock_partition(session, by, chunk)
+    await session.execute(text(f'CREATE TEMPORARY TABLE rollup_diff ON COMMIT DROP AS '
+                               f'SELECT campaign_id, day, {", ".join(COUNTERS)}, '
+                               f'{", ".join(f"{name} AS seen_{name}" for name in COUNTERS)} '
+                               f'FROM campaign_daily_stats WITH NO DATA'))
+    diff = table('rollup_diff', *[column(name) for name in columns], *[column(f'seen_{name}') for name in COUNTERS])
+
+    is_click = actions.c.action == 'click'
+    totals = (select(actions.c.campaign_id, actions.c.day,
+                     func.count().filter(~is_click).label('impressions_count'),
+                     func.count().filter(is_click).label('clicks_count'),
+                     func.coalesce(func.sum(actions.c.cost).filter(~is_click), 0.0).label('spent_impressions'),
+                     func.coalesce(func.sum(actions.c.cost).filter(is_click), 0.0).label('spent_clicks'))
+              .where(where(actions))
+              .group_by(actions.c.campaign_id, actions.c.day)
+              .subquery('totals'))
+    seen = (select(rollup).where(where(rollup), rollup.c.day.not_in(detached_days))
+            .subquery('seen'))
+    joined = totals.join(seen, and_(totals.c.campaign_id == seen.c.campaign_id, totals.c.day == seen.c.day),
+                         full=True)
+    await session.execute(insert(diff).from_select(
+        list(diff.c.keys()),
+        select(func.coalesce(totals.c.campaign_id, seen.c.campaign_id),
+               func.coalesce(totals.c.day, seen.c.day),
+               *[func.coalesce(totals.c[name], 0) for name in COUNTERS],
+               *[func.coalesce(seen.c[name], 0) for name in COUNTERS])
+        .select_from(joined)
+        .where(or_(totals.c.campaign_id.is_(None),
+                   seen.c.campaign_id.is_(None),
+                   *[totals.c[name] != seen.c[name] for name in COUNTERS]))))
+    await session.execute(text('ANALYZE rollup_diff'))
+
+    # creates the missing rows and locks the rest in the order writers use
+    created = insert(rollup).from_select(columns, select(diff.c.campaign_id, diff.c.day, literal(0), literal(0),
+                                                         literal(0.0), literal(0.0))
+                                         .order_by(diff.c.campaign_id, diff.c.day))
+    await session.execute(created.on_conflict_do_update(index_elements=['campaign_id', 'day'],
+                                                        set_={name: rollup.c[name] for name in COUNTERS}))
+    in_diff = and_(rollup.c.campaign_id == diff.c.campaign_id, rollup.c.day == diff.c.day)
+    result = await session.execute(update(rollup).where(in_diff)
+                                   .values({name: diff.c[name] + (rollup.c[name] - diff.c[f'seen_{name}'])
+                                            for name in COUNTERS}))
+    await session.execute(delete(rollup).where(in_diff, rollup.c.impressions_count == 0,
+                                               rollup.c.clicks_count == 0))
+    return result.rowcount
+
+
+def campaign_chunks(count: int):
+    # `count` campaign_id ranges [lower, upper) covering the whole uuid space, None is unbounded
+    bounds = [None] + [str(uuid.UUID(int=i * 2 ** 128 // count)) for i in range(1, count)] + [None]
+    return [[lower, upper] for lower, upper in zip(bounds, bounds[1:])]
+
+
+def chunk_filter(by: str, chunk: list):
+    # the `where` of rebuild_partition for a chunk of days [first, last] or a campaign_chunks range
+    def where(table):
+        if by == 'day':
+            return table.c.day.between(*chunk)
+        lower, upper = chunk
+        conditions = [true()]
+        if lower is not None:
+            conditions.append(table.c.campaign_id >= uuid.UUID(lower))
+        if upper is not None:
+            conditions.append(table.c.campaign_id < uuid.UUID(upper))
+        return and_(*conditions)
+    return where
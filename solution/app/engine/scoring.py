@@ -0,0 +1,116 @@
+import heapq
+import itertools
+import os
+import uuid
+from typing import Iterator, Sequence
+
+import numpy as np
+
+
+def campaign_profit(campaign) -> float:
+    # the same operations in the same order as `combine`, so both give bit-identical values
+    ctr = (campaign.current_clicks + 1) / (campaign.current_impressions + 2)
+    return campaign.cost_per_impression + campaign.cost_per_click * ctr
+
+
+class ScoringEngine:
+    # combined_score = alpha * normalized_profit + beta * normalized_ml, computed over columnar arrays
+
+    def __init__(self, alpha: float = 0.8, beta: float = 0.2):
+        self.alpha = alpha
+        self.beta = beta
+
+    @classmethod
+    def from_env(cls):
+        return cls(alpha=float(os.getenv('SCORING_ALPHA', '0.8')),
+                   beta=float(os.getenv('SCORING_BETA', '0.2')))
+
+    def scores(self, campaigns: Sequence, ml_scores: dict[uuid.UUID, int]) -> np.ndarray:
+        n = len(campaigns)
+        clicks = np.fromiter((c.current_clicks for c in campaigns), dtype=np.float64, count=n)
+        impressions = np.fromiter((c.current_impressions for c in campaigns), dtype=np.float64, count=n)
+        cost_per_impression = np.fromiter((c.cost_per_impression for c in campaigns), dtype=np.float64, count=n)
+        cost_per_click = np.fromiter((c.cost_per_click for c in campaigns), dtype=np.float64, count=n)
+        ml = np.fromiter((ml_scores.get(c.advertiser_id, 0) for c in campaigns), dtype=np.float64, count=n)
+        return self.combine(cost_per_impression, cost_per_click, clicks, impressions, ml)
+
+    def combine(self, cost_per_impression: np.ndarray, cost_per_click: np.ndarray,
+                clicks: np.ndarray, impressions: np.ndarray, ml: np.ndarray) -> np.ndarray:
+        ctr = (clicks + 1) / (impressions + 2)
+        profit = cost_per_impression + cost_per_click * ctr
+
+        result = np.zeros(len(profit), dtype=np.float64)
+        if len(profit) == 0:
+            return result
+        max_profit = profit.max()
+        if max_profit != 0:
+            result += self.alpha * (profit / max_profit)
+        max_ml = ml.max()
+        if max_ml != 0:
+            result += self.beta * (ml / max_ml)
+        return result
+
+    def best(self, campaigns: Sequence, ml_scores: dict[uuid.UUID, int]):
+        if len(campaigns) == 0:
+            return None
+        return campaigns[int(np.argmax(self.scores(campaigns, ml_scores)))]
+
+    def top_k(self, campaigns: Sequence, ml_scores: dict[uuid.UUID, int], k: int) -> list[tuple]:
+        scores = self.scores(campaigns, ml_scores)
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        # ties on the k-th score are resolved by position, the same way a stable full sort would do it
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[:k - len(above)]
+        selected = np.concatenate((above, ties))
+        selected = selected[np.argsort(-scores[selected], kind='stable')]
+        return [(campaigns[i], float(scores[i])) for i in selected]
+
+    def ranked_segment(self, segment, excluded: set[uuid.UUID], ml_scores: dict[uuid.UUID, int]) -> Iterator:
+        # Lazy best-first order over the campaigns of a targeting Segment that still have both limits left,
+        # minus `excluded`. All campaigns of one advertiser share the ML term, so within an advertiser the
+        # combined score follows profit: the walk merges the segment's profit order (advertisers without
+        # a score) with one profit-ordered stream per scored advertiser, and stops as soon as it is consumed.
+        # The streams are snapshots of the index taken here, the caller may await between the steps.
+        profit_order = (c for c in segment if c.campaign_id not in excluded)
+        first = next(profit_order, None)
+        if first is None:
+            return
+        max_profit = first.profit
+
+        streams = []
+        for advertiser_id, ml in ml_scores.items():
+            if ml <= 0:
+                continue
+            campaigns = (c for c in segment.for_advertiser(advertiser_id) if c.campaign_id not in excluded)
+            campaign = next(campaigns, None)
+            if campaign is not None:
+                streams.append((campaign, ml, campaigns))
+        max_ml = max((ml for _, ml, _ in streams), default=0)
+
+        def score(profit: float, ml: int):
+            result = 0.0
+            if max_profit != 0:
+                result += self.alpha * (profit / max_profit)
+            if max_ml != 0:
+                result += self.beta * (ml / max_ml)
+            return result
+
+        heap = [(-score(campaign.profit, ml), campaign.rank_key, campaign, ml, campaigns)
+                for campaign, ml, campaigns in streams]
+        heapq.heapify(heap)
+        scored_advertisers = {advertiser_id for advertiser_id, ml in ml_scores.items() if ml > 0}
+        rest = (c for c in itertools.chain((first,), profit_order) if c.advertiser_id not in scored_advertisers)
+        current = next(rest, None)
+        while heap or current is not None:
+            if current is not None and (not heap or (-score(current.profit, 0), current.rank_key) < heap[0][:2]):
+                yield current
+                current = next(rest, None)
+                continue
+            _, _, campaign, ml, campaigns = heapq.heappop(heap)
+            yield campaign
+            following = next(campaigns, None)
+            if following is not None:
+                heapq.heappush(heap, (-score(following.profit, ml), following.rank_key, following, ml, campaigns))
@@ -0,0 +1,383 @@
+import asyncio
+import bisect
+import heapq
+import itertools
+import uuid
+from typing import Collection, Iterator, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..db import campaign_model
+from .scoring import campaign_profit
+
+
+MIN_AGE = 0
+MAX_AGE = 100
+GENDERS = ('MALE', 'FEMALE')
+
+_sequence = itertools.count()
+
+
+class IndexedCampaign:
+    __slots__ = ('campaign_id', 'advertiser_id', 'gender', 'location', 'age_from', 'age_to',
+                 'start_date', 'end_date', 'impressions_limit', 'clicks_limit',
+                 'cost_per_impression', 'cost_per_click', 'ad_title', 'ad_text',
+                 'current_impressions', 'current_clicks', 'profit', 'rank_key')
+
+    def __init__(self, campaign: campaign_model.Campaign):
+        targeting = campaign.targeting or {}
+        gender = targeting.get('gender')
+        age_from = targeting.get('age_from')
+        age_to = targeting.get('age_to')
+
+        self.campaign_id = campaign.campaign_id
+        self.advertiser_id = campaign.advertiser_id
+        # 'ALL' and missing gender both mean "any gender"
+        self.gender = next((g for g in GENDERS if g == gender), None)
+        self.location = targeting.get('location')
+        self.age_from = MIN_AGE if age_from is None else max(MIN_AGE, age_from)
+        self.age_to = MAX_AGE if age_to is None else min(MAX_AGE, age_to)
+        self.start_date = campaign.start_date
+        self.end_date = campaign.end_date
+        self.impressions_limit = campaign.impressions_limit
+        self.clicks_limit = campaign.clicks_limit
+        self.cost_per_impression = campaign.cost_per_impression
+        self.cost_per_click = campaign.cost_per_click
+        self.ad_title = campaign.ad_title
+        self.ad_text = campaign.ad_text
+        # last observed counters; the live values are kept in Redis
+        self.current_impressions = campaign.current_impressions or 0
+        self.current_clicks = campaign.current_clicks or 0
+        self.profit = campaign_profit(self)
+        # profit order with a stable tie-breaker; kept in sync with the counters by TargetingIndex.set_counters
+        self.rank_key = (-self.profit, next(_sequence))
+
+    def is_active(self, day: int):
+        return self.start_date <= day <= self.end_date
+
+    def has_limits_left(self):
+        return self.current_impressions < self.impressions_limit and self.current_clicks < self.clicks_limit
+
+    def matches(self, gender: str, location: str, age: int):
+        return (self.gender is None or self.gender == gender) and \
+            (self.location is None or self.location == location) and self.age_from <= age <= self.age_to
+
+
+class ProfitOrder:
+    # (rank_key, campaign) pairs sorted by profit, best first, in a B+tree whose nodes are never changed in place:
+    # an update copies the O(log n) nodes on its path and replaces the root. A walk that awaits in between keeps
+    # seeing the tree it started on, keys included.
+    # Nodes are lists of (key, item) pairs, the item is the campaign in a leaf and a child node above, where the
+    # key is the last key of the child. All leaves are `height` levels below the root.
+    __slots__ = ('root', 'height', 'size')
+
+    NODE_SIZE = 64
+
+    def __init__(self):
+        self.root = []
+        self.height = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self) -> Iterator[tuple]:
+        return self._walk(self.root, self.height)
+
+    def insert(self, campaign: IndexedCampaign):
+        nodes = self._insert(self.root, self.height, (campaign.rank_key, campaign))
+        if len(nodes) > 1:
+            self.root = [(node[-1][0], node) for node in nodes]
+            self.height += 1
+        else:
+            self.root = nodes[0]
+        self.size += 1
+
+    def remove(self, key: tuple):
+        root = self._remove(self.root, self.height, key)
+        if root is None:
+            return
+        while self.height > 0 and len(root) <= 1:
+            root = root[0][1] if root else []
+            self.height -= 1
+        self.root = root
+        self.size -= 1
+
+    @classmethod
+    def _walk(cls, node: list, height: int) -> Iterator[tuple]:
+        if height == 0:
+            yield from node
+        else:
+            for _, child in node:
+                yield from cls._walk(child, height - 1)
+
+    @classmethod
+    def _split(cls, node: list) -> list[list]:
+        if len(node) <= cls.NODE_SIZE:
+            return [node]
+        middle = len(node) // 2
+        return [node[:middle], node[middle:]]
+
+    @classmethod
+    def _insert(cls, node: list, height: int, entry: tuple) -> list[list]:
+        # rank keys are unique, a 1-tuple sorts right before the pair with the same key
+        i = bisect.bisect_left(node, (entry[0],))
+        if height == 0:
+            return cls._split(node[:i] + [entry] + node[i:])
+        i = min(i, len(node) - 1)
+        children = cls._insert(node[i][1], height - 1, entry)
+        return cls._split(node[:i] + [(child[-1][0], child) for child in children] + node[i + 1:])
+
+    @classmethod
+    def _remove(cls, node: list, height: int, key: tuple) -> Optional[list]:
+        # the new node, None if the key is not there
+        i = bisect.bisect_left(node, (key,))
+        if i == len(node):
+            return None
+        if height == 0:
+            return node[:i] + node[i + 1:] if node[i][0] == key else None
+        child = cls._remove(node[i][1], height - 1, key)
+        if child is None:
+            return None
+        first, last = i, i + 1
+        if len(child) < cls.NODE_SIZE // 4 and len(node) > 1:
+            # a small child is merged into its neighbour, and split again if that gets too big
+            if i > 0:
+                first, child = i - 1, node[i - 1][1] + child
+            else:
+                last, child = i + 2, child + node[i + 1][1]
+        parts = cls._split(child) if child else []
+        return node[:first] + [(part[-1][0], part) for part in parts] + node[last:]
+
+
+class AgeIntervalTree:
+    # Segment tree over [MIN_AGE, MAX_AGE]: an interval is stored in O(log R) canonical nodes,
+    # a stabbing query walks one root-to-leaf path and yields the sets it meets.
+
+    def __init__(self):
+        self._nodes = [set() for _ in range(4 * (MAX_AGE - MIN_AGE + 1))]
+        self.size = 0
+
+    def _update(self, node: int, lo: int, hi: int, left: int, right: int, item, add: bool):
+        if right < lo or hi < left:
+            return
+        if left <= lo and hi <= right:
+            if add:
+                self._nodes[node].add(item)
+            else:
+                self._nodes[node].discard(item)
+            return
+        mid = (lo + hi) // 2
+        self._update(2 * node, lo, mid, left, right, item, add)
+        self._update(2 * node + 1, mid + 1, hi, left, right, item, add)
+
+    def add(self, left: int, right: int, item):
+        self._update(1, MIN_AGE, MAX_AGE, left, right, item, True)
+        self.size += 1
+
+    def remove(self, left: int, right: int, item):
+        self._update(1, MIN_AGE, MAX_AGE, left, right, item, False)
+        self.size -= 1
+
+    def stab(self, age: int) -> Iterator[set]:
+        if not MIN_AGE <= age <= MAX_AGE:
+            return
+        node, lo, hi = 1, MIN_AGE, MAX_AGE
+        while True:
+            if self._nodes[node]:
+                yield self._nodes[node]
+            if lo == hi:
+                return
+            mid = (lo + hi) // 2
+            if age <= mid:
+                node, hi = 2 * node, mid
+            else:
+                node, lo = 2 * node + 1, mid + 1
+
+
+class Bucket:
+    # Campaigns of one (gender, location) targeting: an age interval tree over all of them and profit orders
+    # (whole bucket and per advertiser) over those with both limits left.
+    __slots__ = ('ages', 'order', 'by_advertiser')
+
+    def __init__(self):
+        self.ages = AgeIntervalTree()
+        self.order = ProfitOrder()
+        self.by_advertiser: dict[uuid.UUID, ProfitOrder] = {}
+
+    def insert(self, campaign: IndexedCampaign):
+        if not campaign.has_limits_left():
+            return
+        self.order.insert(campaign)
+        order = self.by_advertiser.get(campaign.advertiser_id)
+        if order is None:
+            order = self.by_advertiser[campaign.advertiser_id] = ProfitOrder()
+        order.insert(campaign)
+
+    def remove(self, campaign: IndexedCampaign, key: tuple):
+        self.order.remove(key)
+        order = self.by_advertiser.get(campaign.advertiser_id)
+        if order is not None:
+            order.remove(key)
+            if len(order) == 0:
+                del self.by_advertiser[campaign.advertiser_id]
+
+
+class Segment:
+    # The campaigns a client with the targeting profile (gender, location, age) can get: the buckets of its
+    # gender and location plus the wildcard ones, filtered by age while they are walked.
+
+    def __init__(self, buckets: list[Bucket], campaigns: dict[uuid.UUID, IndexedCampaign], age: int):
+        self.age = age
+        self._buckets = buckets
+        self._campaigns = campaigns
+
+    def __iter__(self) -> Iterator[IndexedCampaign]:
+        # campaigns with both limits left, best profit first
+        return self._merge([iter(bucket.order) for bucket in self._buckets])
+
+    def for_advertiser(self, advertiser_id: uuid.UUID) -> Iterator[IndexedCampaign]:
+        orders = (bucket.by_advertiser.get(advertiser_id) for bucket in self._buckets)
+        return self._merge([iter(order) for order in orders if order is not None])
+
+    def is_empty(self):
+        return not any(True for bucket in self._buckets for _ in bucket.ages.stab(self.age))
+
+    def candidates(self) -> list[IndexedCampaign]:
+        # every campaign of the profile, limits or not
+        return [self._campaigns[campaign_id]
+                for bucket in self._buckets for ids in bucket.ages.stab(self.age) for campaign_id in ids]
+
+    def _merge(self, snapshots: list[Iterator[tuple]]) -> Iterator[IndexedCampaign]:
+        # the walks are started before the merge, see ProfitOrder
+        age = self.age
+        merged = snapshots[0] if len(snapshots) == 1 else heapq.merge(*snapshots)
+        return (c for _, c in merged if c.age_from <= age <= c.age_to)
+
+
+class TargetingIndex:
+    # Eligibility index over the campaigns active on `day`, bucketed by (gender, location) with
+    # None as the wildcard bucket.
+
+    def __init__(self):
+        self.day: Optional[int] = None
+        self._campaigns: dict[uuid.UUID, IndexedCampaign] = {}
+        self._buckets: dict[tuple, Bucket] = {}
+        self._pending: Optional[list] = None
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._campaigns)
+
+    def get(self, campaign_id: uuid.UUID) -> Optional[IndexedCampaign]:
+        return self._campaigns.get(campaign_id)
+
+    def campaigns(self) -> list[IndexedCampaign]:
+        return list(self._campaigns.values())
+
+    async def ensure_day(self, session: AsyncSession, day: int):
+        if self.day == day:
+            return
+        async with self._lock:
+            if self.day == day:
+                return
+            # changes made by the campaign handlers while the snapshot is loading are replayed on top of it
+            self._pending = []
+            try:
+                result = await session.execute(select(campaign_model.Campaign)
+                                               .filter(campaign_model.Campaign.start_date <= day,
+                                                       day <= campaign_model.Campaign.end_date))
+                campaigns = result.scalars().all()
+
+                self.day = day
+                self._campaigns = {}
+                self._buckets = {}
+                for campaign in campaigns:
+                    self._add(IndexedCampaign(campaign))
+                pending, self._pending = self._pending, None
+                for campaign_id, campaign in pending:
+                    self._apply(campaign_id, campaign)
+            finally:
+                self._pending = None
+
+    def upsert(self, campaign: campaign_model.Campaign):
+        self._apply(campaign.campaign_id, IndexedCampaign(campaign))
+
+    def remove(self, campaign_id: uuid.UUID):
+        self._apply(campaign_id, None)
+
+    async def reload(self, session: AsyncSession, campaign_ids: Collection[uuid.UUID]):
+        # re-reads campaigns changed by other workers, the deleted ones are dropped
+        if self.day is None and self._pending is None:
+            return
+        result = await session.execute(select(campaign_model.Campaign)
+                                       .filter(campaign_model.Campaign.campaign_id.in_(campaign_ids)))
+        found = {campaign.campaign_id: campaign for campaign in result.scalars().all()}
+        for campaign_id in campaign_ids:
+            campaign = found.get(campaign_id)
+            self._apply(campaign_id, IndexedCampaign(campaign) if campaign is not None else None)
+
+    def reset(self):
+        # the next ensure_day loads a fresh snapshot
+        self.day = None
+
+    def segment(self, gender: str, location: str, age: int) -> Segment:
+        buckets = []
+        for key in ((gender, location), (gender, None), (None, location), (None, None)):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                buckets.append(bucket)
+        return Segment(buckets, self._campaigns, age)
+
+    def candidates(self, gender: str, location: str, age: int) -> list[IndexedCampaign]:
+        return self.segment(gender, location, age).candidates()
+
+    def set_counters(self, campaign: IndexedCampaign, impressions: int, clicks: int):
+        if impressions == campaign.current_impressions and clicks == campaign.current_clicks:
+            return
+        old_key = campaign.rank_key
+        campaign.current_impressions = impressions
+        campaign.current_clicks = clicks
+        campaign.profit = campaign_profit(campaign)
+        campaign.rank_key = (-campaign.profit, old_key[1])
+        # the campaign may be a replaced entry or one that is not indexed yet
+        if self._campaigns.get(campaign.campaign_id) is campaign:
+            bucket = self._buckets[(campaign.gender, campaign.location)]
+            bucket.remove(campaign, old_key)
+            bucket.insert(campaign)
+
+    def _apply(self, campaign_id: uuid.UUID, campaign: Optional[IndexedCampaign]):
+        if self._pending is not None:
+            self._pending.append((campaign_id, campaign))
+        if self.day is None:
+            return
+
+        old = self._campaigns.get(campaign_id)
+        if old is not None:
+            self._discard(old)
+            if campaign is not None:
+                # the row's counters may lag behind the ones already synced from Redis
+                self.set_counters(campaign, old.current_impressions, old.current_clicks)
+        if campaign is not None and campaign.is_active(self.day):
+            self._add(campaign)
+
+    def _add(self, campaign: IndexedCampaign):
+        if campaign.age_from > campaign.age_to:
+            return
+        key = (campaign.gender, campaign.location)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = Bucket()
+        bucket.ages.add(campaign.age_from, campaign.age_to, campaign.campaign_id)
+        bucket.insert(campaign)
+        self._campaigns[campaign.campaign_id] = campaign
+
+    def _discard(self, campaign: IndexedCampaign):
+        key = (campaign.gender, campaign.location)
+        bucket = self._buckets[key]
+        bucket.ages.remove(campaign.age_from, campaign.age_to, campaign.campaign_id)
+        bucket.remove(campaign, campaign.rank_key)
+        if bucket.ages.size == 0:
+            del self._buckets[key]
+        del self._campaigns[campaign.campaign_id]
@@ -0,0 +1,80 @@
+import uuid
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from fastapi import HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..db import bulk_import
+from ..schemas.advertiser_schemas import AdvertiserUpsert
+from ..schemas.client_schemas import ClientUpsert, MLScore
+from .readers import import_format, parse_rows
+
+
+# The imports run the same way inside a request and in a background job. `state` holds the caches to
+# invalidate: app.state in the server, its stand-in in jobs_worker.py.
+
+class ImportConflict(Exception):
+    pass
+
+
+Progress = Optional[Callable[[int], Awaitable]]
+
+
+async def import_clients(session: AsyncSession, rows: AsyncIterator, state, progress: Progress = None):
+    try:
+        report = await bulk_import.import_rows(bulk_import.StagingTable(session, bulk_import.CLIENTS), rows,
+                                               progress)
+        await session.commit()
+    except IntegrityError:
+        # a concurrent request took one of the logins after the check
+        await session.rollback()
+        raise ImportConflict("Login is already registered")
+    await state.client_cache.clear()
+    return report
+
+
+async def import_advertisers(session: AsyncSession, rows: AsyncIterator, state, progress: Progress = None):
+    report = await bulk_import.import_rows(bulk_import.StagingTable(session, bulk_import.ADVERTISERS), rows,
+                                           progress)
+    await session.commit()
+    return report
+
+
+async def import_ml_scores(session: AsyncSession, rows: AsyncIterator, state, progress: Progress = None):
+    staging = bulk_import.StagingTable(session, bulk_import.ML_SCORES)
+    report = await bulk_import.import_rows(staging, rows, progress)
+    changed_clients = await staging.spool_ids('client_id')
+    await session.commit()
+    for client_ids in bulk_import.read_spooled_ids(changed_clients):
+        await state.ml_score_cache.invalidate_many(client_ids)
+    return report
+
+
+# job kind -> row schema, import function
+IMPORTS = {
+    'import_clients': (ClientUpsert, import_clients),
+    'import_advertisers': (AdvertiserUpsert, import_advertisers),
+    'import_ml_scores': (MLScore, import_ml_scores),
+}
+
+
+async def run_import_request(request: Request, session: AsyncSession, kind: str, background: bool):
+    # With `background` the body is handed to a job and 202 is returned with the job, see GET /jobs/{job_id}
+    format_ = import_format(request.headers.get('content-type'))
+    if format_ is None:
+        raise HTTPException(status_code=415, detail="Expected application/json, application/x-ndjson or text/csv")
+    if background:
+        job_queue = request.app.state.job_queue
+        job_id = uuid.uuid4()
+        path = await job_queue.store_payload(job_id, request.stream())
+        job = await job_queue.enqueue(kind, {'format': format_, 'payload': path}, job_id)
+        return JSONResponse(status_code=202, content=jsonable_encoder(job))
+
+    schema, run = IMPORTS[kind]
+    try:
+        return await run(session, parse_rows(request.stream(), format_, schema), request.app.state)
+    except ImportConflict as e:
+        raise HTTPException(status_code=400, detail=str(e))
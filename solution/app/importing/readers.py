@@ -0,0 +1,98 @@
+import csv
+import json
+from typing import AsyncIterator, Optional
+
+from pydantic import BaseModel, ValidationError
+
+
+# Import bodies are parsed line by line while they are being received, only the current line is kept in
+# memory. CSV files start with a header line; quoted values spanning several lines are not supported.
+# A plain JSON array is accepted too, for small bodies: it is read into memory whole.
+
+MAX_LINE_LENGTH = 64 * 1024
+
+FORMATS = {
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'text/csv': 'csv',
+}
+
+
+def import_format(content_type: Optional[str]) -> Optional[str]:
+    if not content_type:
+        return None
+    return FORMATS.get(content_type.split(';')[0].strip().lower())
+
+
+async def read_lines(stream: AsyncIterator[bytes]):
+    # yields (line number, line); a line longer than MAX_LINE_LENGTH is skipped and yielded as None
+    buffer = b''
+    number = 0
+    too_long = False
+    async for chunk in stream:
+        lines = chunk.split(b'\n')
+        buffer += lines[0]
+        for line in lines[1:]:
+            number += 1
+            yield number, None if too_long or len(buffer) > MAX_LINE_LENGTH else buffer
+            buffer = line
+            too_long = False
+        if len(buffer) > MAX_LINE_LENGTH:
+            buffer = b''
+            too_long = True
+    if buffer or too_long:
+        yield number + 1, None if too_long else buffer
+
+
+def _describe(error: ValidationError):
+    return '; '.join(f"{'.'.join(map(str, item['loc']))}: {item['msg']}" if item['loc'] else item['msg']
+                     for item in error.errors(include_url=False))
+
+
+async def parse_rows(stream: AsyncIterator[bytes], format_: str, schema: type[BaseModel]):
+    # yields (line number, model, None) for valid rows and (line number, None, error) for the others;
+    # items of a JSON array are numbered as lines
+    if format_ == 'json':
+        async for row in _parse_array(stream, schema):
+            yield row
+        return
+    header = None
+    async for number, line in read_lines(stream):
+        if line is None:
+            yield number, None, f"Line is longer than {MAX_LINE_LENGTH} bytes"
+            continue
+        if not line.strip():
+            continue
+        try:
+            if format_ == 'ndjson':
+                yield number, schema.model_validate_json(line), None
+                continue
+            values = next(csv.reader([line.decode().rstrip('\r')]))
+            if header is None:
+                header = values
+                continue
+            if len(values) != len(header):
+                yield number, None, f"Expected {len(header)} values, got {len(values)}"
+                continue
+            yield number, schema.model_validate_strings(dict(zip(header, values))), None
+        except ValidationError as e:
+            yield number, None, _describe(e)
+        except (UnicodeDecodeError, csv.Error) as e:
+            yield number, None, str(e)
+
+
+async def _parse_array(stream: AsyncIterator[bytes], schema: type[BaseModel]):
+    try:
+        items = json.loads(b''.join([chunk async for chunk in stream]))
+    except ValueError as e:
+        yield 1, None, f"Invalid JSON: {e}"
+        return
+    if not isinstance(items, list):
+        yield 1, None, "Expected a JSON array"
+        return
+    for number, item in enumerate(items, 1):
+        try:
+            yield number, schema.model_validate(item), None
+        except ValidationError as e:
+            yield number, None, _describe(e)
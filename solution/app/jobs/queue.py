@@ -0,0 +1,252 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+import uuid
+from typing import AsyncIterator, Optional
+
+from redis import asyncio as aioredis
+
+
+# A job is the hash job:{id} (kind, status, progress, params, result, error, timestamps); ids of queued jobs
+# wait in the jobs:queue list. A running job holds a lease, its deadline in the jobs:running sorted set: the
+# worker renews it while the job runs, and once it runs out the job is queued again (see requeue_expired).
+# Every claim bumps the job's `attempt`, a worker whose lease was taken over can no longer renew or finish
+# the job. A request body handed to a job is written to a file in `payload_dir`, the job params carry its
+# path; the directory has to be shared with jobs_worker.py when it runs on another host.
+
+QUEUE_KEY = 'jobs:queue'
+RUNNING_KEY = 'jobs:running'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+PAYLOAD_PIECE_SIZE = 256 * 1024
+
+# KEYS: job, running set. ARGV: now, lease deadline, job id
+_CLAIM = """
+if redis.call('HGET', KEYS[1], 'status') ~= 'queued' then
+    return 0
+end
+local attempt = redis.call('HINCRBY', KEYS[1], 'attempt', 1)
+redis.call('HSET', KEYS[1], 'status', 'running', 'started_at', ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[3])
+return attempt
+"""
+
+# KEYS: job, running set. ARGV: attempt, lease deadline, job id
+_RENEW = """
+if redis.call('HGET', KEYS[1], 'status') ~= 'running' or redis.call('HGET', KEYS[1], 'attempt') ~= ARGV[1] then
+    return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[3])
+return 1
+"""
+
+# KEYS: job, running set. ARGV: attempt, ttl, job id, then field, value pairs
+_FINISH = """
+if redis.call('HGET', KEYS[1], 'status') ~= 'running' or redis.call('HGET', KEYS[1], 'attempt') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 4))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('ZREM', KEYS[2], ARGV[3])
+return 1
+"""
+
+# KEYS: job, running set, queue. ARGV: now, job id, max attempts
+_REQUEUE = """
+local deadline = redis.call('ZSCORE', KEYS[2], ARGV[2])
+if not deadline or tonumber(deadline) > tonumber(ARGV[1]) then
+    return false
+end
+redis.call('ZREM', KEYS[2], ARGV[2])
+if redis.call('HGET', KEYS[1], 'status') ~= 'running' then
+    return false
+end
+if redis.call('HGET', KEYS[1], 'cancel_requested') == '1' then
+    redis.call('HSET', KEYS[1], 'status', 'cancelled', 'finished_at', ARGV[1])
+    return 'cancelled'
+end
+if tonumber(redis.call('HGET', KEYS[1], 'attempt')) >= tonumber(ARGV[3]) then
+    redis.call('HSET', KEYS[1], 'status', 'failed', 'finished_at', ARGV[1],
+               'error', 'The worker running the job stopped responding')
+    return 'failed'
+end
+redis.call('HSET', KEYS[1], 'status', 'queued')
+redis.call('HDEL', KEYS[1], 'started_at')
+redis.call('LPUSH', KEYS[3], ARGV[2])
+return 'queued'
+"""
+
+_CANCEL = """
+local status = redis.call('HGET', KEYS[1], 'status')
+if status == 'queued' then
+    redis.call('HSET', KEYS[1], 'status', 'cancelled', 'finished_at', ARGV[1])
+    return 'cancelled'
+end
+if status == 'running' then
+    redis.call('HSET', KEYS[1], 'cancel_requested', '1')
+end
+return status
+"""
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _job_key(job_id: uuid.UUID):
+    return f'job:{job_id}'
+
+
+class JobQueue:
+
+    def __init__(self, redis: aioredis.Redis, ttl: int = 86400, lease: float = 30.0, max_attempts: int = 3,
+                 payload_dir: Optional[str] = None):
+        # finished jobs and unread payloads expire after `ttl` seconds; a job whose lease ran out
+        # `max_attempts` times is failed instead of being queued again
+        self.ttl = ttl
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.payload_dir = payload_dir or os.path.join(tempfile.gettempdir(), 'job_payloads')
+        os.makedirs(self.payload_dir, exist_ok=True)
+        self._redis = redis
+        self._claim = redis.register_script(_CLAIM)
+        self._renew = redis.register_script(_RENEW)
+        self._finish = redis.register_script(_FINISH)
+        self._requeue = redis.register_script(_REQUEUE)
+        self._cancel = redis.register_script(_CANCEL)
+
+    @classmethod
+    def from_env(cls, redis: aioredis.Redis):
+        return cls(redis, ttl=int(os.getenv('JOB_TTL', '86400')), lease=float(os.getenv('JOB_LEASE', '30')),
+                   max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', '3')), payload_dir=os.getenv('JOB_PAYLOAD_DIR'))
+
+    async def store_payload(self, job_id: uuid.UUID, stream: AsyncIterator[bytes]) -> str:
+        path = os.path.join(self.payload_dir, f'{job_id}.payload')
+        try:
+            with open(path, 'wb') as file:
+                async for chunk in stream:
+                    await asyncio.to_thread(file.write, chunk)
+        except BaseException:
+            self.delete_payload(path)
+            raise
+        return path
+
+    @staticmethod
+    async def read_payload(path: str):
+        with open(path, 'rb') as file:
+            while piece := await asyncio.to_thread(file.read, PAYLOAD_PIECE_SIZE):
+                yield piece
+
+    @staticmethod
+    def delete_payload(path: Optional[str]):
+        if path is None:
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def remove_stale_payloads(self):
+        # bodies of jobs that were never finished by a worker, e.g. cancelled by the reaper
+        deadline = time.time() - self.ttl
+        with os.scandir(self.payload_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.payload') and entry.stat().st_mtime < deadline:
+                    self.delete_payload(entry.path)
+
+    async def enqueue(self, kind: str, params: Optional[dict] = None, job_id: Optional[uuid.UUID] = None) -> dict:
+        job_id = job_id or uuid.uuid4()
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.hset(_job_key(job_id), mapping={'kind': kind, 'status': QUEUED, 'progress': 0,
+                                             'params': json.dumps(params or {}), 'created_at': time.time()})
+        pipe.expire(_job_key(job_id), self.ttl)
+        pipe.lpush(QUEUE_KEY, str(job_id))
+        await pipe.execute()
+        return await self.get(job_id)
+
+    async def get(self, job_id: uuid.UUID) -> Optional[dict]:
+        data = await self._redis.hgetall(_job_key(job_id))
+        if not data:
+            return None
+        data = {key.decode(): value.decode() for key, value in data.items()}
+        return {'job_id': job_id,
+                'kind': data['kind'],
+                'status': data['status'],
+                'progress': int(data['progress']),
+                'cancel_requested': data.get('cancel_requested') == '1',
+                'result': json.loads(data['result']) if 'result' in data else None,
+                'error': data.get('error'),
+                'created_at': float(data['created_at']),
+                'started_at': float(data['started_at']) if 'started_at' in data else None,
+                'finished_at': float(data['finished_at']) if 'finished_at' in data else None}
+
+    async def cancel(self, job_id: uuid.UUID) -> Optional[str]:
+        # a queued job is cancelled at once, a running one stops at its next progress report
+        status = await self._cancel(keys=[_job_key(job_id)], args=[time.time()])
+        if status == b'cancelled':
+            self.delete_payload(await self._payload_path(job_id))
+        return status.decode() if status is not None else None
+
+    async def _payload_path(self, job_id: uuid.UUID) -> Optional[str]:
+        params = await self._redis.hget(_job_key(job_id), 'params')
+        return json.loads(params).get('payload') if params is not None else None
+
+    async def next_job(self, timeout: float = 1.0) -> Optional[tuple[uuid.UUID, str, dict, int]]:
+        popped = await self._redis.brpop([QUEUE_KEY], timeout=timeout)
+        if popped is None:
+            return None
+        job_id = uuid.UUID(popped[1].decode())
+        # cancelled (or expired) while waiting in the queue
+        attempt = await self._claim(keys=[_job_key(job_id), RUNNING_KEY],
+                                    args=[time.time(), time.time() + self.lease, str(job_id)])
+        if not attempt:
+            return None
+        kind, params = await self._redis.hmget(_job_key(job_id), ['kind', 'params'])
+        return job_id, kind.decode(), json.loads(params), attempt
+
+    async def renew(self, job_id: uuid.UUID, attempt: int) -> bool:
+        # False once the job was finished, or taken over after the lease ran out
+        return bool(await self._renew(keys=[_job_key(job_id), RUNNING_KEY],
+                                      args=[attempt, time.time() + self.lease, str(job_id)]))
+
+    async def requeue_expired(self) -> int:
+        # jobs whose worker stopped renewing the lease go back to the queue
+        now = time.time()
+        expired = await self._redis.zrangebyscore(RUNNING_KEY, '-inf', now)
+        requeued = 0
+        for job_id in expired:
+            job_id = uuid.UUID(job_id.decode())
+            status = await self._requeue(keys=[_job_key(job_id), RUNNING_KEY, QUEUE_KEY],
+                                         args=[now, str(job_id), self.max_attempts])
+            requeued += status == b'queued'
+        return requeued
+
+    async def report_progress(self, job_id: uuid.UUID, progress: int):
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.hset(_job_key(job_id), 'progress', progress)
+        pipe.hget(_job_key(job_id), 'cancel_requested')
+        _, cancel_requested = await pipe.execute()
+        if cancel_requested == b'1':
+            raise JobCancelled()
+
+    async def finish(self, job_id: uuid.UUID, attempt: int, status: str, result: Optional[dict] = None,
+                     error: Optional[str] = None) -> bool:
+        # False when the lease of this attempt was lost, the job belongs to another worker then
+        mapping = {'status': status, 'finished_at': time.time()}
+        if result is not None:
+            mapping['result'] = json.dumps(result)
+        if error is not None:
+            mapping['error'] = error
+        finished = await self._finish(keys=[_job_key(job_id), RUNNING_KEY],
+                                      args=[attempt, self.ttl, str(job_id),
+                                            *[item for pair in mapping.items() for item in pair]])
+        if finished:
+            self.delete_payload(await self._payload_path(job_id))
+        return bool(finished)
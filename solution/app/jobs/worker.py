@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import uuid
+
+from sqlalchemy import update
+
+from ..db import campaign_model
+from ..db import db_session
+from ..db import stats_rollup
+from ..importing.imports import IMPORTS, ImportConflict
+from ..llm.ad_text import AdTextError
+from ..importing.readers import parse_rows
+from ..monitoring.metrics import JOBS_FINISHED
+from .queue import CANCELLED, DONE, FAILED, JobCancelled, JobQueue
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobWorker:
+    # Runs `concurrency` loops taking jobs from the queue, inside the server or in jobs_worker.py, and a reaper
+    # that queues again the jobs of workers that stopped renewing their lease.
+    # `state` holds the caches the jobs invalidate, see importing.imports.
+
+    def __init__(self, queue: JobQueue, state, concurrency: int = 1):
+        self.queue = queue
+        self.state = state
+        self.concurrency = concurrency
+        self._tasks: list[asyncio.Task] = []
+
+    @classmethod
+    def from_env(cls, queue: JobQueue, state):
+        return cls(queue, state, concurrency=int(os.getenv('JOB_WORKERS', '1')))
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
+        if self.concurrency:
+            self._tasks.append(asyncio.create_task(self._reap()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            try:
+                job = await self.queue.next_job()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to take a job")
+                await asyncio.sleep(1)
+                continue
+            if job is None:
+                continue
+            try:
+                await self._execute(*job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # the job itself is handled in _perform, this is its bookkeeping; the lease runs out then
+                logger.exception("Failed to run job %s (%s)", job[0], job[1])
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(self.queue.lease / 2)
+            try:
+                requeued = await self.queue.requeue_expired()
+                if requeued:
+                    logger.warning("Queued %d jobs with an expired lease again", requeued)
+                await asyncio.to_thread(self.queue.remove_stale_payloads)
+            except Exception:
+                logger.exception("Failed to requeue expired jobs")
+
+    async def _execute(self, job_id: uuid.UUID, kind: str, params: dict, attempt: int):
+        job = asyncio.create_task(self._perform(job_id, kind, params, attempt))
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, attempt, job))
+        try:
+            await asyncio.wait([job])
+        finally:
+            heartbeat.cancel()
+            job.cancel()
+            await asyncio.gather(job, heartbeat, return_exceptions=True)
+        if not job.cancelled():
+            job.result()
+
+    async def _heartbeat(self, job_id: uuid.UUID, attempt: int, job: asyncio.Task):
+        # a lease that cannot be renewed was taken over by the reaper, the job is stopped here
+        while True:
+            await asyncio.sleep(self.queue.lease / 3)
+            try:
+                renewed = await self.queue.renew(job_id, attempt)
+            except Exception:
+                logger.exception("Failed to renew the lease of job %s", job_id)
+                continue
+            if not renewed:
+                logger.warning("Lost the lease of job %s, stopping it", job_id)
+                job.cancel()
+                return
+
+    async def _perform(self, job_id: uuid.UUID, kind: str, params: dict, attempt: int):
+        status, result, error = FAILED, None, None
+        try:
+            if kind in IMPORTS:
+                result = await self._import(job_id, kind, params)
+            elif kind == 'rebuild_stats':
+                result = await self._rebuild_stats(job_id, params)
+            elif kind == 'ad_text':
+                result = await self._ad_text(params)
+            else:
+                error = f"Unknown job kind {kind}"
+            if error is None:
+                status = DONE
+        except JobCancelled:
+            status = CANCELLED
+        except (ImportConflict, AdTextError) as e:
+            error = str(e)
+        except asyncio.CancelledError:
+            # a no-op when the lease was lost
+            await self.queue.finish(job_id, attempt, FAILED, error="The worker was stopped")
+            raise
+        except Exception as e:
+            logger.exception("Job %s (%s) failed", job_id, kind)
+            error = f"{e.__class__.__name__}: {e}"
+        if await self.queue.finish(job_id, attempt, status, result, error):
+            JOBS_FINISHED.labels(kind, status).inc()
+        else:
+            logger.warning("Job %s (%s) was taken over by another worker, its %s result is dropped",
+                           job_id, kind, status)
+
+    def _progress(self, job_id: uuid.UUID):
+        async def report(progress: int):
+            await self.queue.report_progress(job_id, progress)
+        return report
+
+    async def _import(self, job_id: uuid.UUID, kind: str, params: dict):
+        schema, run = IMPORTS[kind]
+        rows = parse_rows(self.queue.read_payload(params['payload']), params['format'], schema)
+        async with db_session.session_factory() as session:
+            return await run(session, rows, self.state, self._progress(job_id))
+
+    async def _rebuild_stats(self, job_id: uuid.UUID, params: dict):
+        # chunks are committed one by one, a cancelled rebuild leaves the finished chunks rebuilt
+        chunks = stats_rollup.campaign_chunks(params.get('chunks', 256))
+        report = self._progress(job_id)
+        rows = 0
+        for index, chunk in enumerate(chunks):
+            async with db_session.session_factory() as session:
+                rows += await stats_rollup.rebuild_partition(session, 'campaign', chunk)
+                await session.commit()
+            await report(index + 1)
+        return {'chunks': len(chunks), 'rows': rows}
+
+    async def _ad_text(self, params: dict):
+        text = await self.state.ad_text_generator.generate(params['title'])
+        campaigns = campaign_model.Campaign
+        async with db_session.session_factory() as session:
+            # the title may have been changed while the text was generated, then the text is dropped
+            result = await session.execute(update(campaigns)
+                                           .where(campaigns.campaign_id == uuid.UUID(params['campaign_id']),
+                                                  campaigns.ad_title == params['title'])
+                                           .values(ad_text=text)
+                                           .returning(campaigns.campaign_id))
+            campaign_id = result.scalar_one_or_none()
+            await session.commit()
+        if campaign_id is not None:
+            await self.state.campaign_sync.invalidate_many([campaign_id])
+        return {'updated': campaign_id is not None}
@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from redis import asyncio as aioredis
+
+from ..monitoring.metrics import LLM_AD_TEXT
+
+
+logger = logging.getLogger(__name__)
+
+PROMPT = ("Привет! Напиши, пожалуйста, небольшой (до 5 предложений) рекламный текст "
+          "для \"{title}\". Я хочу получить ТОЛЬКО текст рекламы. Спасибо заранее.")
+
+
+class AdTextError(Exception):
+    pass
+
+
+class G4FProvider:
+    # g4f has only a blocking client, calls run in a thread pool; a call that timed out keeps its thread
+    # until g4f returns, so the pool size also caps the calls hanging in the background
+
+    def __init__(self, model: str, threads: int = 4):
+        self.model = model
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='llm')
+
+    def _complete(self, prompt: str):
+        from g4f.client import Client
+
+        response = Client().chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            web_search=False, ignore_stream=True, ignore_working=True
+        )
+        return response.choices[0].message.content
+
+    async def complete(self, prompt: str) -> str:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._complete, prompt)
+
+
+class FakeProvider:
+    # deterministic text without network access, for tests and local runs
+
+    def __init__(self, model: str, delay: float = 0.0):
+        self.model = model
+        self.delay = delay
+
+    async def complete(self, prompt: str) -> str:
+        await asyncio.sleep(self.delay)
+        digest = hashlib.sha256(prompt.encode()).hexdigest()[:8]
+        return f"Рекламный текст {digest}: {prompt[:200]}"
+
+
+PROVIDERS = {'g4f': G4FProvider, 'fake': FakeProvider}
+
+
+def _cache_key(model: str, prompt: str):
+    return 'llm:ad_text:' + hashlib.sha256(f'{model}\n{prompt}'.encode()).hexdigest()
+
+
+class AdTextGenerator:
+    # Texts are cached in Redis under the hash of the model and the prompt, which includes the title, so every
+    # worker and every campaign with the same title reuse one generation. Concurrent requests for the same
+    # prompt in a worker wait for a single call.
+
+    def __init__(self, redis: aioredis.Redis, provider, timeout: float = 30.0, attempts: int = 3,
+                 cache_ttl: int = 7 * 86400):
+        self.provider = provider
+        self.timeout = timeout
+        self.attempts = attempts
+        self.cache_ttl = cache_ttl
+        self._redis = redis
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    @classmethod
+    def from_env(cls, redis: aioredis.Redis):
+        model = os.getenv('LLM_MODEL', 'gpt-4o-mini')
+        if os.getenv('LLM_PROVIDER', 'g4f') == 'fake':
+            provider = FakeProvider(model, delay=float(os.getenv('LLM_FAKE_DELAY', '0')))
+        else:
+            provider = G4FProvider(model, threads=int(os.getenv('LLM_THREADS', '4')))
+        return cls(redis, provider,
+                   timeout=float(os.getenv('LLM_TIMEOUT', '30')),
+                   attempts=int(os.getenv('LLM_ATTEMPTS', '3')),
+                   cache_ttl=int(os.getenv('LLM_CACHE_TTL', str(7 * 86400))))
+
+    async def generate(self, title: str) -> str:
+        prompt = PROMPT.format(title=title)
+        key = _cache_key(self.provider.model, prompt)
+        cached = await self._redis.get(key)
+        if cached is not None:
+            LLM_AD_TEXT.labels('cache_hit').inc()
+            return cached.decode()
+
+        future = self._in_flight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            text = await self._complete(prompt)
+            await self._redis.set(key, text, ex=self.cache_ttl)
+            future.set_result(text)
+            return text
+        except BaseException as e:
+            future.set_exception(e if isinstance(e, AdTextError) else AdTextError(str(e)))
+            # the waiters get the error, the future itself must not log "exception was never retrieved"
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    async def _complete(self, prompt: str) -> str:
+        for attempt in range(self.attempts):
+            started = time.perf_counter()
+            try:
+                text = await asyncio.wait_for(self.provider.complete(prompt), self.timeout)
+                if text:
+                    LLM_AD_TEXT.labels('generated').inc()
+                    return text
+                result = 'empty'
+            except asyncio.TimeoutError:
+                result = 'timeout'
+            except Exception:
+                logger.exception("Ad text generation failed")
+                result = 'error'
+            LLM_AD_TEXT.labels(result).inc()
+            logger.warning("Ad text attempt %d/%d: %s after %.1fs", attempt + 1, self.attempts, result,
+                           time.perf_counter() - started)
+        raise AdTextError("Error due creating llm text")
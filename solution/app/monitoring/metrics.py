@@ -0,0 +1,78 @@
+import time
+from functools import lru_cache
+
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+# in-process timings are mostly well under a millisecond, the default buckets start at 5 ms
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Request latency by route template',
+                            ['method', 'route', 'status'], buckets=FAST_BUCKETS)
+STAGE_LATENCY = Histogram('handler_stage_duration_seconds', 'Time spent in a stage of a request handler',
+                          ['handler', 'stage'], buckets=FAST_BUCKETS)
+DB_POOL_CHECKOUT_WAIT = Histogram('db_pool_checkout_wait_seconds',
+                                  'Time to get a connection from the SQLAlchemy pool, connecting included',
+                                  buckets=FAST_BUCKETS)
+REDIS_LATENCY = Histogram('redis_command_duration_seconds', 'Redis round trip by command, PIPELINE for pipelines',
+                          ['command'], buckets=FAST_BUCKETS)
+ADS_NOT_FOUND = Counter('ads_not_found_total', '"No campaigns found" outcomes of ad requests',
+                        ['handler', 'reason'])
+STATS_CACHE_REQUESTS = Counter('stats_cache_requests_total', 'Stats requests answered from the Redis cache or not',
+                               ['result'])
+LLM_AD_TEXT = Counter('llm_ad_text_total', 'Ad text requests by outcome: cache_hit, generated or a failed attempt '
+                      '(timeout, error, empty)', ['result'])
+ACTION_WRITE_FAILURES = Counter('action_write_failures_total', 'Failed batch writes of the action writer by error, '
+                                'the batch is retried', ['error'])
+ACTIONS_LATE = Counter('actions_late_total',
+                       'Actions rejected by the action writer because their day was already sealed')
+JOBS_FINISHED = Counter('jobs_finished_total', 'Background jobs finished by this process', ['kind', 'status'])
+
+
+@lru_cache(maxsize=None)
+def _stage_histogram(handler: str, stage: str):
+    return STAGE_LATENCY.labels(handler, stage)
+
+
+class stage:
+    # with stage('ads', 'scoring'): ...
+    __slots__ = ('_histogram', '_started')
+
+    def __init__(self, handler: str, name: str):
+        self._histogram = _stage_histogram(handler, name)
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._started)
+
+
+@lru_cache(maxsize=None)
+def redis_histogram(command: str):
+    return REDIS_LATENCY.labels(command)
+
+
+class CacheCollector:
+    # exports the counters of the per-worker caches kept in app.state
+
+    def __init__(self, state, caches: dict[str, str]):
+        self._state = state
+        self._caches = caches
+
+    def collect(self):
+        hits = CounterMetricFamily('cache_hits', 'Cache hits', labels=['cache'])
+        misses = CounterMetricFamily('cache_misses', 'Cache misses', labels=['cache'])
+        evictions = CounterMetricFamily('cache_evictions', 'Entries evicted by the size cap', labels=['cache'])
+        size = GaugeMetricFamily('cache_size', 'Entries in the cache', labels=['cache'])
+        for name, attribute in self._caches.items():
+            cache = getattr(self._state, attribute, None)
+            if cache is None:
+                continue
+            stats = cache.stats()
+            hits.add_metric([name], stats['hits'])
+            misses.add_metric([name], stats['misses'])
+            evictions.add_metric([name], stats['evictions'])
+            size.add_metric([name], stats['size'])
+        return [hits, misses, evictions, size]
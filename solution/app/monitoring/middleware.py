@@ -0,0 +1,31 @@
+import time
+
+from .metrics import REQUEST_LATENCY
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware: BaseHTTPMiddleware would add a task and a stream per request.
+    # Requests are labelled with the route template, so ids in paths don't multiply the series.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get('route')
+            REQUEST_LATENCY.labels(scope['method'], route.path if route is not None else 'other',
+                                   status).observe(time.perf_counter() - started)
@@ -0,0 +1,126 @@
+import logging
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+logger = logging.getLogger(__name__)
+
+QUERIES_PER_REQUEST = Histogram('db_queries_per_request', 'SQL statements executed while handling a request',
+                                ['route'], buckets=(0, 1, 2, 3, 4, 5, 8, 10, 15, 20, 50, 100, 500, 1000))
+DB_TIME_PER_REQUEST = Histogram('db_time_per_request_seconds', 'Time spent in SQL statements per request',
+                                ['route'], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                                                    0.25, 0.5, 1.0, 2.5))
+QUERY_BUDGET_EXCEEDED = Counter('db_query_budget_exceeded_total',
+                                'Requests that executed more statements than SQL_QUERY_BUDGET', ['route'])
+SLOW_QUERIES = Counter('db_slow_queries_total', 'Statements slower than SLOW_QUERY_MS')
+
+_PARAMETERS_LOG_LIMIT = 2000
+
+
+class QueryStats:
+    __slots__ = ('count', 'duration')
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+
+# set by QueryBudgetMiddleware for the duration of a request; background tasks run without it
+request_query_stats: ContextVar[Optional[QueryStats]] = ContextVar('request_query_stats', default=None)
+
+
+def _format_parameters(parameters, executemany: bool):
+    if executemany:
+        text = f"{len(parameters)} rows, first: {parameters[0]!r}" if parameters else "0 rows"
+    else:
+        text = repr(parameters)
+    if len(text) > _PARAMETERS_LOG_LIMIT:
+        text = text[:_PARAMETERS_LOG_LIMIT] + '...'
+    return text
+
+
+def _explain(connection, statement: str, parameters):
+    # EXPLAIN ANALYZE executes the statement again, so only plain SELECTs are explained;
+    # a fresh cursor keeps the rows of the original one for SQLAlchemy
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute('EXPLAIN ANALYZE ' + statement, parameters)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+    finally:
+        cursor.close()
+
+
+def instrument_engine(engine: AsyncEngine, slow_query_ms: float, explain: bool):
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - connection.info['query_started'].pop()
+        stats = request_query_stats.get()
+        if stats is not None:
+            stats.count += 1
+            stats.duration += elapsed
+
+        if elapsed * 1000 < slow_query_ms:
+            return
+        SLOW_QUERIES.inc()
+        plan = None
+        if explain and not executemany and statement.lstrip()[:6].upper() == 'SELECT':
+            try:
+                plan = _explain(connection, statement, parameters)
+            except Exception:
+                logger.exception("EXPLAIN ANALYZE of a slow query failed")
+        logger.warning("Slow query (%.1f ms): %s\nParameters: %s%s", elapsed * 1000, statement,
+                       _format_parameters(parameters, executemany), f"\nPlan:\n{plan}" if plan else "")
+
+
+def instrument_engine_from_env(engine: AsyncEngine):
+    instrument_engine(engine, slow_query_ms=float(os.getenv('SLOW_QUERY_MS', '100')),
+                      explain=os.getenv('SLOW_QUERY_EXPLAIN', '0') == '1')
+
+
+class QueryBudgetMiddleware:
+    # Counts the statements and DB time of every request. Requests over `budget` statements are logged,
+    # and with `debug_headers` the numbers are returned as X-DB-Queries / X-DB-Time-Ms.
+
+    def __init__(self, app, budget: int = 10, debug_headers: bool = False):
+        self.app = app
+        self.budget = budget
+        self.debug_headers = debug_headers
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        stats = QueryStats()
+        token = request_query_stats.set(stats)
+
+        async def send_with_headers(message):
+            if self.debug_headers and message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + [
+                    (b'x-db-queries', str(stats.count).encode()),
+                    (b'x-db-time-ms', f'{stats.duration * 1000:.2f}'.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            request_query_stats.reset(token)
+            route = scope.get('route')
+            route = route.path if route is not None else 'other'
+            QUERIES_PER_REQUEST.labels(route).observe(stats.count)
+            DB_TIME_PER_REQUEST.labels(route).observe(stats.duration)
+            if 0 < self.budget < stats.count:
+                QUERY_BUDGET_EXCEEDED.labels(route).inc()
+                logger.warning("%s %s executed %d SQL statements (budget %d) in %.1f ms",
+                               scope['method'], route, stats.count, self.budget, stats.duration * 1000)
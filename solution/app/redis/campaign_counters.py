@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import uuid
+from typing import Optional, Sequence
+
+from redis import asyncio as aioredis
+from redis.commands.core import AsyncScript
+from sqlalchemy import select, update, bindparam, func, Integer
+
+from ..db import db_session
+from ..db import campaign_model
+from ..db import click_model
+
+
+logger = logging.getLogger(__name__)
+
+DIRTY_KEY = 'campaigns:dirty_counters'
+
+# KEYS: counter, dirty set. ARGV: limit (-1 for none), campaign id, seed used when the counter is missing;
+# without a seed a missing counter is left alone and -2 is returned
+_INCR_WITH_LIMIT = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+    if ARGV[3] == '' then
+        return -2
+    end
+    current = ARGV[3]
+    redis.call('SET', KEYS[1], current)
+end
+local limit = tonumber(ARGV[1])
+if limit >= 0 and tonumber(current) >= limit then
+    return -1
+end
+redis.call('SADD', KEYS[2], ARGV[2])
+return redis.call('INCR', KEYS[1])
+"""
+# KEYS: counter, dirty set. ARGV: value, campaign id; the counter is only ever raised
+_SET_AT_LEAST = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '-1')
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+redis.call('SADD', KEYS[2], ARGV[2])
+"""
+# the sha is computed once here, every call names its client; the script is loaded on the first NOSCRIPT
+_incr_with_limit = AsyncScript(None, _INCR_WITH_LIMIT.encode())
+_set_at_least = AsyncScript(None, _SET_AT_LEAST.encode())
+
+
+def _counter_key(campaign_id: uuid.UUID, counter: str):
+    return f'campaign:{campaign_id}:{counter}'
+
+
+async def get_counters(redis: aioredis.Redis, campaigns: Sequence) -> list[tuple[int, int]]:
+    # `campaigns` are Campaign rows or index entries; their own counters are the fallback
+    # for campaigns whose live counters were never touched
+    if len(campaigns) == 0:
+        return []
+    keys = []
+    for campaign in campaigns:
+        keys.append(_counter_key(campaign.campaign_id, 'impressions'))
+        keys.append(_counter_key(campaign.campaign_id, 'clicks'))
+    values = await redis.mget(keys)
+
+    result = []
+    for i, campaign in enumerate(campaigns):
+        impressions, clicks = values[2 * i], values[2 * i + 1]
+        result.append((int(impressions) if impressions is not None else campaign.current_impressions or 0,
+                       int(clicks) if clicks is not None else campaign.current_clicks or 0))
+    return result
+
+
+async def _incr(redis: aioredis.Redis, campaign_id: uuid.UUID, counter: str, limit: int, seed: Optional[int]):
+    return await _incr_with_limit(keys=[_counter_key(campaign_id, counter), DIRTY_KEY],
+                                  args=[limit, str(campaign_id), seed if seed is not None else ''], client=redis)
+
+
+async def reserve_impression(redis: aioredis.Redis, campaign) -> bool:
+    result = await _incr(redis, campaign.campaign_id, 'impressions',
+                         campaign.impressions_limit, campaign.current_impressions or 0)
+    return result != -1
+
+
+async def release_impression(redis: aioredis.Redis, campaign):
+    pipe = redis.pipeline(transaction=False)
+    pipe.decr(_counter_key(campaign.campaign_id, 'impressions'))
+    pipe.sadd(DIRTY_KEY, str(campaign.campaign_id))
+    await pipe.execute()
+
+
+async def sync_counters(redis: aioredis.Redis, targeting_index, chunk_size: int = 5000):
+    campaigns = targeting_index.campaigns()
+    for i in range(0, len(campaigns), chunk_size):
+        chunk = campaigns[i:i + chunk_size]
+        for campaign, (impressions, clicks) in zip(chunk, await get_counters(redis, chunk)):
+            targeting_index.set_counters(campaign, impressions, clicks)
+
+
+async def run_counters_sync(redis: aioredis.Redis, targeting_index, interval: float):
+    # other workers' impressions and clicks reach this worker's index through here
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sync_counters(redis, targeting_index)
+        except Exception:
+            logger.exception("Failed to sync campaign counters")
+
+
+async def add_click(redis: aioredis.Redis, campaign_id: uuid.UUID):
+    # called after the click is committed to the clicks table; a missing counter (a new campaign, or one lost
+    # with Redis) is set from that table rather than from current_clicks, which lags behind by a flush
+    if await _incr(redis, campaign_id, 'clicks', -1, None) != -2:
+        return
+    async with db_session.session_factory() as session:
+        clicks = await session.scalar(select(func.count()).select_from(click_model.Click)
+                                      .where(click_model.Click.campaign_id == campaign_id))
+    await _set_at_least(keys=[_counter_key(campaign_id, 'clicks'), DIRTY_KEY],
+                        args=[clicks, str(campaign_id)], client=redis)
+
+
+async def delete_counters(redis: aioredis.Redis, campaign_id: uuid.UUID):
+    pipe = redis.pipeline(transaction=False)
+    pipe.delete(_counter_key(campaign_id, 'impressions'), _counter_key(campaign_id, 'clicks'))
+    pipe.srem(DIRTY_KEY, str(campaign_id))
+    await pipe.execute()
+
+
+async def flush_counters(redis: aioredis.Redis, batch_size: int = 1000):
+    table = campaign_model.Campaign.__table__
+    stmt = (update(table)
+            .where(table.c.campaign_id == bindparam('b_campaign_id'))
+            .values(current_impressions=func.coalesce(bindparam('b_impressions', type_=Integer),
+                                                      table.c.current_impressions),
+                    current_clicks=func.coalesce(bindparam('b_clicks', type_=Integer), table.c.current_clicks)))
+
+    while True:
+        dirty = await redis.spop(DIRTY_KEY, batch_size)
+        if not dirty:
+            return
+        campaign_ids = [uuid.UUID(campaign_id.decode()) for campaign_id in dirty]
+        keys = []
+        for campaign_id in campaign_ids:
+            keys.append(_counter_key(campaign_id, 'impressions'))
+            keys.append(_counter_key(campaign_id, 'clicks'))
+        values = await redis.mget(keys)
+
+        params = []
+        for i, campaign_id in enumerate(campaign_ids):
+            impressions, clicks = values[2 * i], values[2 * i + 1]
+            if impressions is None and clicks is None:
+                continue
+            params.append({'b_campaign_id': campaign_id,
+                           'b_impressions': int(impressions) if impressions is not None else None,
+                           'b_clicks': int(clicks) if clicks is not None else None})
+        try:
+            if params:
+                async with db_session.session_factory() as session:
+                    await session.execute(stmt, params)
+                    await session.commit()
+        except Exception:
+            await redis.sadd(DIRTY_KEY, *dirty)
+            raise
+
+        if len(dirty) < batch_size:
+            return
+
+
+async def run_counters_flusher(redis: aioredis.Redis, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush_counters(redis)
+        except Exception:
+            logger.exception("Failed to flush campaign counters")
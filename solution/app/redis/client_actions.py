@@ -0,0 +1,109 @@
+import uuid
+from typing import Sequence
+
+from redis import asyncio as aioredis
+from sqlalchemy import select, literal, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..db import action_model
+from ..db import click_model
+
+
+# Campaign ids are stored as raw 16-byte UUIDs to keep the per-client sets compact.
+# The `loaded` marker tells that the sets were hydrated from the database at least once: impressions come
+# from the actions table, clicks from the clicks table, which keeps them after a partition is detached.
+
+def _actions_key(client_id: uuid.UUID, action: str):
+    return f'client:{client_id}:{action}'
+
+
+def _loaded_key(client_id: uuid.UUID):
+    return f'client:{client_id}:actions_loaded'
+
+
+async def _hydrate(redis: aioredis.Redis, session: AsyncSession, client_id: uuid.UUID):
+    impressions = (select(action_model.Action.campaign_id, action_model.Action.action)
+                   .where(action_model.Action.client_id == client_id, action_model.Action.action == 'impression'))
+    clicks = (select(click_model.Click.campaign_id, literal('click'))
+              .where(click_model.Click.client_id == client_id))
+    result = await session.execute(union_all(impressions, clicks))
+    pipe = redis.pipeline(transaction=False)
+    for campaign_id, action in result.all():
+        pipe.sadd(_actions_key(client_id, action), campaign_id.bytes)
+    pipe.set(_loaded_key(client_id), 1)
+    await pipe.execute()
+
+
+async def get_seen_campaigns_many(redis: aioredis.Redis, session: AsyncSession,
+                                  campaigns_by_client: dict[uuid.UUID, Sequence[uuid.UUID]]):
+    result = {}
+    pending = dict(campaigns_by_client)
+    for _ in range(2):
+        pipe = redis.pipeline(transaction=False)
+        for client_id, campaign_ids in pending.items():
+            members = [campaign_id.bytes for campaign_id in campaign_ids]
+            pipe.exists(_loaded_key(client_id))
+            pipe.smismember(_actions_key(client_id, 'impression'), members)
+            pipe.smismember(_actions_key(client_id, 'click'), members)
+        replies = await pipe.execute()
+
+        not_loaded = {}
+        for i, (client_id, campaign_ids) in enumerate(pending.items()):
+            loaded, impressioned, clicked = replies[3 * i: 3 * i + 3]
+            if not loaded:
+                not_loaded[client_id] = campaign_ids
+                continue
+            result[client_id] = ({campaign_id for campaign_id, flag in zip(campaign_ids, impressioned) if flag},
+                                 {campaign_id for campaign_id, flag in zip(campaign_ids, clicked) if flag})
+        if not not_loaded:
+            break
+        for client_id in not_loaded:
+            await _hydrate(redis, session, client_id)
+        pending = not_loaded
+    return result
+
+
+async def get_client_actions_many(redis: aioredis.Redis, session: AsyncSession,
+                                  client_ids: Sequence[uuid.UUID]):
+    # whole sets, for callers that walk the candidates lazily instead of testing each of them
+    result = {}
+    pending = list(client_ids)
+    for _ in range(2):
+        pipe = redis.pipeline(transaction=False)
+        for client_id in pending:
+            pipe.exists(_loaded_key(client_id))
+            pipe.smembers(_actions_key(client_id, 'impression'))
+            pipe.smembers(_actions_key(client_id, 'click'))
+        replies = await pipe.execute()
+
+        not_loaded = []
+        for i, client_id in enumerate(pending):
+            loaded, impressioned, clicked = replies[3 * i: 3 * i + 3]
+            if not loaded:
+                not_loaded.append(client_id)
+                continue
+            result[client_id] = ({uuid.UUID(bytes=campaign_id) for campaign_id in impressioned},
+                                 {uuid.UUID(bytes=campaign_id) for campaign_id in clicked})
+        if not not_loaded:
+            break
+        for client_id in not_loaded:
+            await _hydrate(redis, session, client_id)
+        pending = not_loaded
+    return result
+
+
+async def get_seen_campaigns(redis: aioredis.Redis, session: AsyncSession, client_id: uuid.UUID,
+                             campaign_ids: Sequence[uuid.UUID]):
+    result = await get_seen_campaigns_many(redis, session, {client_id: campaign_ids})
+    return result[client_id]
+
+
+async def add_actions(redis: aioredis.Redis, actions: Sequence[tuple[uuid.UUID, uuid.UUID, str]]):
+    pipe = redis.pipeline(transaction=False)
+    for client_id, campaign_id, action in actions:
+        pipe.sadd(_actions_key(client_id, action), campaign_id.bytes)
+    await pipe.execute()
+
+
+async def add_action(redis: aioredis.Redis, client_id: uuid.UUID, campaign_id: uuid.UUID, action: str):
+    await redis.sadd(_actions_key(client_id, action), campaign_id.bytes)
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from redis import asyncio as aioredis
+
+from . import redis_client
+
+
+logger = logging.getLogger(__name__)
+
+
+class DayCache:
+    # Per-worker copy of the current day. Updated from the `day` pub/sub channel that set_day publishes to,
+    # and re-read from Redis in the background every `ttl` seconds in case a message was missed.
+
+    def __init__(self, redis: aioredis.Redis, ttl: float = 5.0):
+        self.ttl = ttl
+        self._redis = redis
+        self._day: Optional[int] = None
+        # bumped on every update, a re-read that started before an update is dropped
+        self._version = 0
+        self._tasks: list[asyncio.Task] = []
+
+    @classmethod
+    def from_env(cls, redis: aioredis.Redis):
+        return cls(redis, ttl=float(os.getenv('DAY_CACHE_TTL', '5')))
+
+    async def start(self):
+        await self.refresh()
+        self._tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._refresh_periodically())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+    async def get(self) -> int:
+        if self._day is None:
+            await self.refresh()
+        return self._day
+
+    async def refresh(self):
+        version = self._version
+        day = await redis_client.get_day(self._redis)
+        if version == self._version:
+            self.set_local(day)
+
+    def set_local(self, day: int):
+        self._day = day
+        self._version += 1
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Failed to re-read the current day")
+
+    async def _listen(self):
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(redis_client.DAY_CHANNEL)
+                # anything published before the subscription was active is picked up here
+                await self.refresh()
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.set_local(int(message['data']))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Day subscription failed, resubscribing")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
@@ -1,12 +1,43 @@
+import time
+
 from redis import asyncio as aioredis
+from redis.asyncio.client import Pipeline
 import os
 
+from ..monitoring.metrics import redis_histogram
+
+
+DAY_CHANNEL = 'day'
+
+
+class TimedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        started = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            redis_histogram('PIPELINE').observe(time.perf_counter() - started)
+
+
+class TimedRedis(aioredis.Redis):
+    # every command and pipeline round trip is recorded in redis_command_duration_seconds
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            redis_histogram(str(args[0]).upper()).observe(time.perf_counter() - started)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> TimedPipeline:
+        return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
 
 async def init_redis():
     host = os.getenv('REDIS_HOST', 'localhost')
     port = int(os.getenv('REDIS_PORT', '6379'))
     db = int(os.getenv('REDIS_DB', '0'))
-    redis = aioredis.Redis(host=host, port=port, db=db)
+    redis = TimedRedis(host=host, port=port, db=db)
     return redis
 
 
@@ -16,4 +47,7 @@ async def get_day(redis: aioredis.Redis):
 
 
 async def set_day(redis: aioredis.Redis, day: int):
-    await redis.set('day', day)
+    pipe = redis.pipeline(transaction=True)
+    pipe.set('day', day)
+    pipe.publish(DAY_CHANNEL, day)
+    await pipe.execute()
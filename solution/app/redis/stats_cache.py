@@ -0,0 +1,60 @@
+import json
+import os
+import uuid
+from typing import Awaitable, Callable, Iterable
+
+from fastapi.encoders import jsonable_encoder
+from redis import asyncio as aioredis
+
+from ..monitoring.metrics import STATS_CACHE_REQUESTS
+
+
+# Responses are stored under stats:{scope}:{id}:{day}:{variant}:{version}. Writers bump the version of the
+# campaign and of its advertiser after the actions are committed, which makes the old entries unreachable;
+# a request reads the version before computing, so a result that raced a write is stored under the old
+# version. Entries expire after `max_staleness` seconds in any case.
+
+_GET_CURRENT = """
+local version = redis.call('GET', KEYS[1]) or '0'
+return {version, redis.call('GET', ARGV[1] .. version)}
+"""
+
+
+def _version_key(scope: str, scope_id: uuid.UUID):
+    return f'stats:{scope}:{scope_id}:version'
+
+
+class StatsCache:
+
+    def __init__(self, redis: aioredis.Redis, max_staleness: float = 10.0):
+        self.max_staleness = max_staleness
+        self._redis = redis
+        self._get_current = redis.register_script(_GET_CURRENT)
+
+    @classmethod
+    def from_env(cls, redis: aioredis.Redis):
+        return cls(redis, max_staleness=float(os.getenv('STATS_CACHE_MAX_STALENESS', '10')))
+
+    async def get_or_compute(self, scope: str, scope_id: uuid.UUID, day: int, variant: str,
+                             compute: Callable[[], Awaitable]):
+        if self.max_staleness <= 0:
+            return await compute()
+        prefix = f'stats:{scope}:{scope_id}:{day}:{variant}:'
+        version, cached = await self._get_current(keys=[_version_key(scope, scope_id)], args=[prefix])
+        if cached is not None:
+            STATS_CACHE_REQUESTS.labels('hit').inc()
+            return json.loads(cached)
+
+        STATS_CACHE_REQUESTS.labels('miss').inc()
+        payload = jsonable_encoder(await compute())
+        await self._redis.set(prefix + version.decode(), json.dumps(payload), px=int(self.max_staleness * 1000))
+        return payload
+
+    async def bump(self, campaign_ids: Iterable[uuid.UUID] = (), advertiser_ids: Iterable[uuid.UUID] = ()):
+        pipe = self._redis.pipeline(transaction=False)
+        for campaign_id in set(campaign_ids):
+            pipe.incr(_version_key('campaign', campaign_id))
+        for advertiser_id in set(advertiser_ids):
+            pipe.incr(_version_key('advertiser', advertiser_id))
+        if len(pipe):
+            await pipe.execute()
@@ -2,21 +2,32 @@ import random
 from typing import Annotated, Sequence
 
 from fastapi import APIRouter, Body, Path, Depends, HTTPException, Request, Query
-from sqlalchemy.orm import selectinload
 from starlette import status
 
-from sqlalchemy import select, or_
+from sqlalchemy import select, exists, literal, true
+from sqlalchemy.dialects.postgresql import insert, UUID as PG_UUID
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..db.db_session import create_session
 from ..db import client_model
+from ..db import click_model
 from ..db import action_model
+from ..db import action_day_model
+from ..db.action_writer import ActionWriter, ActionQueueFull
 from ..db import campaign_model
+from ..db import campaign_stats_model
+from ..db import stats_rollup
 
-from ..schemas.advertiser_schemas import Ad
-from ..schemas.client_schemas import ClientUUID
+from ..engine.targeting_index import IndexedCampaign, Segment, TargetingIndex
+from ..engine.scoring import ScoringEngine
 
-from ..redis import redis_client
+from ..schemas.advertiser_schemas import Ad, AdBatchItem
+from ..schemas.client_schemas import ClientUUID, ClientUUIDs
+
+from ..redis import client_actions
+from ..redis import campaign_counters
+
+from ..monitoring.metrics import stage, ADS_NOT_FOUND
 
 import uuid
 
@@ -41,19 +52,12 @@ router = APIRouter(tags=["Ads"])
 #     return ok_campaigns
 
 
-async def filter_campaigns(campaigns_all: Sequence[campaign_model.Campaign], client: client_model.Client):
+async def filter_campaigns(campaigns_all: Sequence[IndexedCampaign],
+                           impression_campaigns_actions: set[uuid.UUID], click_campaigns_actions: set[uuid.UUID]):
     can_impression_campaigns = []
     can_click_campaigns = []
     show_again_campaigns = []
 
-    impression_campaigns_actions = set()
-    click_campaigns_actions = set()
-    for action in client.actions:
-        if action.action == 'impression':
-            impression_campaigns_actions.add(action.campaign_id)
-        if action.action == 'click':
-            click_campaigns_actions.add(action.campaign_id)
-
     for campaign in campaigns_all:
         impressioned = campaign.campaign_id in impression_campaigns_actions
         clicked = campaign.campaign_id in click_campaigns_actions
@@ -69,148 +73,222 @@ async def filter_campaigns(campaigns_all: Sequence[campaign_model.Campaign], cli
     return can_impression_campaigns, can_click_campaigns, show_again_campaigns
 
 
-async def calc_combined_scores(campaigns_all: list[campaign_model.Campaign], client: client_model.Client):
-    alpha = 0.8
-    beta = 0.2
-
-    campaigns_data = []
-    max_ml = 0
-    max_profit = 0
-
-    ml_scores = {cur_score.advertiser_id: cur_score.score for cur_score in client.ml_scores}
-
-    for campaign in campaigns_all:
-        ctr_numerator = campaign.current_clicks + 1
-        ctr_denominator = campaign.current_impressions + 2
-        ctr = ctr_numerator / ctr_denominator
-
-        profit = campaign.cost_per_impression + campaign.cost_per_click * ctr
-
-        campaigns_data.append({
-            'campaign': campaign,
-            'ml': ml_scores.get(campaign.advertiser_id, 0),
-            'profit': profit,
-            'ctr': ctr
-        })
-
-        max_ml = max(max_ml, ml_scores.get(campaign.advertiser_id, 0))
-        max_profit = max(max_profit, profit)
-
-    for data in campaigns_data:
-        normalized_ml = (data['ml'] / max_ml) if max_ml != 0 else 0
-        normalized_profit = (data['profit'] / max_profit) if max_profit != 0 else 0
-        data['score'] = alpha * normalized_profit + beta * normalized_ml
-
-    return sorted([(d['campaign'], d['score']) for d in campaigns_data],
-                  key=lambda x: x[1], reverse=True)
+async def choose_campaign(redis, targeting_index: TargetingIndex, scoring_engine: ScoringEngine,
+                          segment: Segment, impressioned_ids: set[uuid.UUID], clicked_ids: set[uuid.UUID],
+                          ml_scores: dict[uuid.UUID, int]):
+    # the limit is enforced atomically in Redis, another worker may have taken the last impression
+    for campaign in scoring_engine.ranked_segment(segment, impressioned_ids, ml_scores):
+        if await campaign_counters.reserve_impression(redis, campaign):
+            targeting_index.set_counters(campaign, campaign.current_impressions + 1, campaign.current_clicks)
+            return campaign, True
+
+    _, can_click_campaigns, show_again_campaigns = \
+        await filter_campaigns(segment.candidates(), impressioned_ids, clicked_ids)
+    if len(can_click_campaigns) > 0:
+        return scoring_engine.best(can_click_campaigns, ml_scores), False
+    if len(show_again_campaigns) > 0:
+        return random.choice(show_again_campaigns), False
+    return None, False
+
+
+def ad_response(campaign: IndexedCampaign):
+    return {'ad_id': campaign.campaign_id, 'ad_title': campaign.ad_title, 'ad_text': campaign.ad_text,
+            'advertiser_id': campaign.advertiser_id}
+
+
+async def record_impressions(request: Request, impressions: list[tuple[uuid.UUID, IndexedCampaign, int]]):
+    # the impressions are queued all together or not at all, a 503 leaves none of them counted
+    redis = request.app.state.redis
+    try:
+        await request.app.state.action_writer.put_many([
+            ActionWriter.new_action(client_id, campaign.campaign_id, campaign.cost_per_impression, 'impression', day)
+            for client_id, campaign, day in impressions])
+    except ActionQueueFull:
+        for _, campaign, _ in impressions:
+            await campaign_counters.release_impression(redis, campaign)
+            request.app.state.targeting_index.set_counters(campaign, campaign.current_impressions - 1,
+                                                           campaign.current_clicks)
+        raise HTTPException(status_code=503, detail="Too many actions in queue, try again later")
+    await client_actions.add_actions(redis, [(client_id, campaign.campaign_id, 'impression')
+                                             for client_id, campaign, _ in impressions])
 
 
 @router.get("/ads", response_model=Ad)
 async def get_ad_for_client(request: Request,
                             client_id: Annotated[uuid.UUID, Query()],
                             session: AsyncSession = Depends(create_session)):
-    client = await session.execute(select(client_model.Client)
-                                   .options(selectinload(client_model.Client.actions))
-                                   .options(selectinload(client_model.Client.ml_scores))
-                                   .where(client_model.Client.client_id == client_id))
-    client = client.scalar_one_or_none()
+    with stage('ads', 'client'):
+        client = await request.app.state.client_cache.get(session, client_id)
     if client is None:
         raise HTTPException(status_code=404, detail="Client not found")
 
-    current_day = await redis_client.get_day(request.app.state.redis)
-
-    campaigns_all = await session.execute(select(campaign_model.Campaign)
-                                          .filter(campaign_model.Campaign.start_date <= current_day,
-                                                  current_day <= campaign_model.Campaign.end_date,
-                                                  or_(
-                                                      campaign_model.Campaign.targeting['gender'].is_(None),
-                                                      ~campaign_model.Campaign.targeting['gender'].astext.in_(['MALE', 'FEMALE']),
-                                                      campaign_model.Campaign.targeting['gender'].astext == client.gender
-                                                  ),
-                                                  or_(
-                                                      campaign_model.Campaign.targeting['age_from'].is_(None),
-                                                      campaign_model.Campaign.targeting['age_from'].as_integer() <= client.age
-                                                  ),
-                                                  or_(
-                                                      campaign_model.Campaign.targeting['age_to'].is_(None),
-                                                      campaign_model.Campaign.targeting['age_to'].as_integer() >= client.age
-                                                  ),
-                                                  or_(
-                                                      campaign_model.Campaign.targeting['location'].is_(None),
-                                                      campaign_model.Campaign.targeting['location'].astext == client.location
-                                                  )
-                                                  ))
-    ok_campaigns = campaigns_all.scalars().all()
-
-    if len(ok_campaigns) == 0:
+    with stage('ads', 'day'):
+        current_day = await request.app.state.day_cache.get()
+
+    targeting_index = request.app.state.targeting_index
+    with stage('ads', 'campaigns'):
+        await targeting_index.ensure_day(session, current_day)
+        segment = targeting_index.segment(client.gender, client.location, client.age)
+    if segment.is_empty():
+        ADS_NOT_FOUND.labels('ads', 'no_targeted_campaigns').inc()
         raise HTTPException(status_code=404, detail="No campaigns found")
 
-    can_impression_campaigns, can_click_campaigns, show_again_campaigns = \
-        await filter_campaigns(ok_campaigns, client)
-    if len(can_impression_campaigns) > 0:
-        calculated_campaigns = await calc_combined_scores(can_impression_campaigns, client)
-        choiced = calculated_campaigns[0][0]
-        choiced.current_impressions += 1
-        new_action = action_model.Action(
-            client_id=client.client_id,
-            campaign_id=choiced.campaign_id,
-            cost=choiced.cost_per_impression,
-            action='impression',
-            day=current_day
-        )
-        session.add(new_action)
-        await session.commit()
-    elif len(can_click_campaigns) > 0:
-        calculated_campaigns = await calc_combined_scores(can_click_campaigns, client)
-        choiced = calculated_campaigns[0][0]
-    elif len(show_again_campaigns) > 0:
-        choiced = random.choice(show_again_campaigns)
-    else:
+    with stage('ads', 'seen'):
+        seen = await client_actions.get_client_actions_many(request.app.state.redis, session, [client.client_id])
+    impressioned_ids, clicked_ids = seen[client.client_id]
+    with stage('ads', 'ml_scores'):
+        ml_scores = await request.app.state.ml_score_cache.get(session, client.client_id)
+
+    with stage('ads', 'choose'):
+        choiced, impression = await choose_campaign(request.app.state.redis, targeting_index,
+                                                    request.app.state.scoring_engine,
+                                                    segment, impressioned_ids, clicked_ids, ml_scores)
+    if choiced is None:
+        ADS_NOT_FOUND.labels('ads', 'nothing_to_show').inc()
         raise HTTPException(status_code=404, detail="No campaigns found")
 
-    return {'ad_id': choiced.campaign_id, 'ad_title': choiced.ad_title, 'ad_text': choiced.ad_text,
-            'advertiser_id': choiced.advertiser_id}
+    if impression:
+        with stage('ads', 'record'):
+            await record_impressions(request, [(client.client_id, choiced, current_day)])
+
+    return ad_response(choiced)
+
+
+@router.post("/ads/batch", response_model=list[AdBatchItem])
+async def get_ads_for_clients(request: Request,
+                              data: Annotated[ClientUUIDs, Body()],
+                              session: AsyncSession = Depends(create_session)):
+    with stage('ads_batch', 'client'):
+        clients = await request.app.state.client_cache.get_many(session, data.client_ids)
+
+    with stage('ads_batch', 'day'):
+        current_day = await request.app.state.day_cache.get()
+
+    targeting_index = request.app.state.targeting_index
+    with stage('ads_batch', 'campaigns'):
+        await targeting_index.ensure_day(session, current_day)
+
+        # clients with the same targeting profile share one segment
+        segments_by_client = {}
+        for client in clients.values():
+            segment = targeting_index.segment(client.gender, client.location, client.age)
+            if not segment.is_empty():
+                segments_by_client[client.client_id] = segment
+
+    with stage('ads_batch', 'seen'):
+        seen = await client_actions.get_client_actions_many(request.app.state.redis, session,
+                                                            list(segments_by_client))
+    with stage('ads_batch', 'ml_scores'):
+        ml_scores_by_client = await request.app.state.ml_score_cache.get_many(session, list(segments_by_client))
+
+    result = []
+    impressions = []
+    with stage('ads_batch', 'choose'):
+        for client_id in data.client_ids:
+            if client_id not in segments_by_client:
+                result.append({'client_id': client_id, 'ad': None})
+                continue
+            impressioned_ids, clicked_ids = seen[client_id]
+
+            choiced, impression = await choose_campaign(request.app.state.redis, targeting_index,
+                                                        request.app.state.scoring_engine,
+                                                        segments_by_client[client_id], impressioned_ids, clicked_ids,
+                                                        ml_scores_by_client[client_id])
+            if impression:
+                impressioned_ids.add(choiced.campaign_id)
+                impressions.append((client_id, choiced, current_day))
+            elif choiced is None:
+                ADS_NOT_FOUND.labels('ads_batch', 'nothing_to_show').inc()
+            result.append({'client_id': client_id, 'ad': ad_response(choiced) if choiced is not None else None})
+
+    if impressions:
+        with stage('ads_batch', 'record'):
+            await record_impressions(request, impressions)
+    return result
+
+
+def click_statement(campaign_id: uuid.UUID, client_id: uuid.UUID, day: int, allowed: bool):
+    campaigns = campaign_model.Campaign.__table__
+    clients = client_model.Client.__table__
+    clicks = click_model.Click.__table__
+    actions = action_model.Action.__table__
+    action_days = action_day_model.ActionDay.__table__
+
+    sealed = exists(select(action_days.c.day).where(action_days.c.day == day, action_days.c.sealed))
+    campaign = (select(campaigns.c.campaign_id, campaigns.c.advertiser_id, campaigns.c.cost_per_click)
+                .where(campaigns.c.campaign_id == campaign_id).cte('campaign'))
+    client = select(clients.c.client_id).where(clients.c.client_id == client_id).cte('client')
+    # the clicks table decides whether this is the first click of the pair; the action and the rollup
+    # are written only for the row it returns
+    clicked = (insert(clicks)
+               .from_select(['campaign_id', 'client_id', 'day'],
+                            select(campaign.c.campaign_id, client.c.client_id, literal(day))
+                            .select_from(campaign.join(client, true()))
+                            .where(literal(allowed), ~sealed))
+               .on_conflict_do_nothing(index_elements=['campaign_id', 'client_id'])
+               .returning(clicks.c.campaign_id, clicks.c.client_id)
+               .cte('clicked'))
+    inserted = (insert(actions)
+                .from_select(['action_id', 'client_id', 'campaign_id', 'cost', 'action', 'day'],
+                             select(literal(uuid.uuid4(), PG_UUID(as_uuid=True)), clicked.c.client_id,
+                                    clicked.c.campaign_id, campaign.c.cost_per_click,
+                                    literal('click'), literal(day))
+                             .select_from(clicked.join(campaign, true())))
+                .on_conflict_do_nothing(index_elements=['client_id', 'campaign_id', 'action', 'day'])
+                .returning(actions.c.action_id, actions.c.campaign_id, actions.c.cost)
+                .cte('inserted'))
+    rollup = (stats_rollup.add_on_conflict(
+        insert(campaign_stats_model.CampaignDailyStats.__table__)
+        .from_select(['campaign_id', 'day', 'impressions_count', 'clicks_count', 'spent_impressions', 'spent_clicks'],
+                     select(inserted.c.campaign_id, literal(day), literal(0), literal(1), literal(0.0),
+                            inserted.c.cost)))
+              .cte('rollup'))
+    return select(exists(select(campaign.c.campaign_id)).label('campaign_exists'),
+                  exists(select(client.c.client_id)).label('client_exists'),
+                  exists(select(clicked.c.campaign_id)).label('clicked'),
+                  sealed.label('day_sealed'),
+                  select(campaign.c.advertiser_id).scalar_subquery().label('advertiser_id')).add_cte(rollup)
 
 
 @router.post("/ads/{ad_id}/click", status_code=status.HTTP_204_NO_CONTENT)
 async def set_ed_click(request: Request, ad_id: Annotated[uuid.UUID, Path()],
                        data: Annotated[ClientUUID, Body()], session: AsyncSession = Depends(create_session)):
-    campaign = await session.execute(select(campaign_model.Campaign)
-                                     .where(campaign_model.Campaign.campaign_id == ad_id))
-    campaign = campaign.scalar_one_or_none()
-    if campaign is None:
+    with stage('click', 'day'):
+        current_day = await request.app.state.day_cache.get()
+
+    # impressions reach the actions table through the background writer, the Redis sets are up to date
+    with stage('click', 'seen'):
+        impressioned_ids, clicked_ids = await client_actions.get_seen_campaigns(
+            request.app.state.redis, session, data.client_id, [ad_id])
+    impressioned = ad_id in impressioned_ids
+    # a repeat click is usually turned away by the clicked set, the clicks table catches the rest
+    allowed = impressioned and ad_id not in clicked_ids
+
+    # existence checks and the insert-if-absent run as one autocommitted statement
+    with stage('click', 'insert'):
+        connection = await session.connection(execution_options={'isolation_level': 'AUTOCOMMIT'})
+        result = await connection.execute(click_statement(ad_id, data.client_id, current_day, allowed))
+        campaign_exists, client_exists, clicked, day_sealed, advertiser_id = result.one()
+        if day_sealed:
+            # the cached day is behind and its partition is sealed already, the click goes to the current day
+            await request.app.state.day_cache.refresh()
+            current_day = await request.app.state.day_cache.get()
+            result = await connection.execute(click_statement(ad_id, data.client_id, current_day, allowed))
+            campaign_exists, client_exists, clicked, day_sealed, advertiser_id = result.one()
+
+    if not campaign_exists:
         raise HTTPException(status_code=404, detail="Campaign not found")
-
-    client = await session.execute(select(client_model.Client).where(client_model.Client.client_id == data.client_id))
-    client = client.scalar_one_or_none()
-    if client is None:
+    if not client_exists:
         raise HTTPException(status_code=404, detail="Client not found")
-
-    current_day = await redis_client.get_day(request.app.state.redis)
-
-    impressioned = await session.execute(select(action_model.Action)
-                                         .filter(action_model.Action.client_id == client.client_id,
-                                                 action_model.Action.campaign_id == campaign.campaign_id,
-                                                 action_model.Action.action == 'impression'))
-    impressioned = impressioned.scalar_one_or_none()
-
-    if impressioned is None:
+    if not impressioned:
         raise HTTPException(status_code=403, detail="Campaign must be seen before click")
 
-    clicked = await session.execute(select(action_model.Action)
-                                    .filter(action_model.Action.client_id == client.client_id,
-                                            action_model.Action.campaign_id == campaign.campaign_id,
-                                            action_model.Action.action == 'click'))
-    clicked = clicked.scalar_one_or_none()
-
-    if clicked is None:
-        campaign.current_clicks += 1
-        new_action = action_model.Action(
-            client_id=client.client_id,
-            campaign_id=campaign.campaign_id,
-            cost=campaign.cost_per_click,
-            action='click',
-            day=current_day
-        )
-        session.add(new_action)
-        await session.commit()
+    if clicked:
+        with stage('click', 'counters'):
+            await campaign_counters.add_click(request.app.state.redis, ad_id)
+            campaign = request.app.state.targeting_index.get(ad_id)
+            if campaign is not None:
+                request.app.state.targeting_index.set_counters(campaign, campaign.current_impressions,
+                                                               campaign.current_clicks + 1)
+            await client_actions.add_action(request.app.state.redis, data.client_id, ad_id, 'click')
+            await request.app.state.stats_cache.bump([ad_id], [advertiser_id])
@@ -1,6 +1,6 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Body, Path, Depends, HTTPException
+from fastapi import APIRouter, Body, Path, Query, Depends, HTTPException, Request
 from starlette import status
 
 from sqlalchemy import select
@@ -13,6 +13,9 @@ from ..db import client_model
 
 from ..schemas.advertiser_schemas import AdvertiserUpsert, Advertiser
 from ..schemas.client_schemas import MLScore
+from ..schemas.import_schemas import ImportReport
+from ..schemas.job_schemas import Job
+from ..importing.imports import run_import_request
 
 import uuid
 
@@ -45,6 +48,12 @@ async def create_advertisers(advertisers: Annotated[list[AdvertiserUpsert], Body
     return advertisers
 
 
+@router.post("/advertisers/import", response_model=ImportReport, responses={202: {'model': Job}})
+async def import_advertisers(request: Request, background: Annotated[bool, Query()] = False,
+                             session: AsyncSession = Depends(create_session)):
+    return await run_import_request(request, session, 'import_advertisers', background)
+
+
 @router.get("/advertisers/{advertiser_id}", response_model=Advertiser)
 async def get_advertiser_by_uuid(advertiser_id: Annotated[uuid.UUID, Path()],
                                  session: AsyncSession = Depends(create_session)):
@@ -57,8 +66,14 @@ async def get_advertiser_by_uuid(advertiser_id: Annotated[uuid.UUID, Path()],
     return advertiser
 
 
+@router.post("/ml-scores/bulk", response_model=ImportReport, responses={202: {'model': Job}})
+async def create_ml_scores(request: Request, background: Annotated[bool, Query()] = False,
+                           session: AsyncSession = Depends(create_session)):
+    return await run_import_request(request, session, 'import_ml_scores', background)
+
+
 @router.post("/ml-scores", response_model=MLScore)
-async def create_ml_score(ml_score: Annotated[MLScore, Body()],
+async def create_ml_score(request: Request, ml_score: Annotated[MLScore, Body()],
                           session: AsyncSession = Depends(create_session)):
     client_exists = await session.execute(select(client_model.Client)
                                           .where(client_model.Client.client_id == ml_score.client_id))
@@ -84,4 +99,5 @@ async def create_ml_score(ml_score: Annotated[MLScore, Body()],
     else:
         data.score = ml_score.score
     await session.commit()
+    await request.app.state.ml_score_cache.set_score(ml_score.client_id, ml_score.advertiser_id, ml_score.score)
     return data
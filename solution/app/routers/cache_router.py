@@ -0,0 +1,12 @@
+from fastapi import APIRouter, Request
+
+from ..schemas.cache_schemas import CacheStats
+
+
+router = APIRouter(tags=["Cache"])
+
+
+@router.get("/cache/stats", response_model=dict[str, CacheStats])
+async def get_cache_stats(request: Request):
+    return {'clients': request.app.state.client_cache.stats(),
+            'ml_scores': request.app.state.ml_score_cache.stats()}
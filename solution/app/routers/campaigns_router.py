@@ -1,10 +1,11 @@
 from typing import Annotated, Optional
 
-from fastapi import APIRouter, Body, Path, Query, Depends, HTTPException, Request
+from fastapi import APIRouter, Body, Path, Query, Depends, HTTPException, Request, Response
 from starlette import status
 
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import flag_modified
 
 from ..db.db_session import create_session
 from ..db import advertiser_model
@@ -12,36 +13,35 @@ from ..db import campaign_model
 
 from ..schemas.campaign_schemas import Campaign, CampaignCreate, CampaignUpdate
 
-from ..redis import redis_client
+from ..redis import campaign_counters
+from ..llm.ad_text import AdTextError
 
 import uuid
 
-from g4f.client import Client
-
 
 router = APIRouter(tags=["Campaigns"])
 
 
-def create_llm_text(title: str):
-    client = Client()
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "user",
-             "content": f"Привет! Напиши, пожалуйста, небольшой (до 5 предложений) рекламный текст "
-                        f"для \"{title}\". Я хочу получить ТОЛЬКО текст рекламы. Спасибо заранее."
-             }
-        ],
-        web_search=False, ignore_stream=True, ignore_working=True
-    )
-    return response.choices[0].message.content
+async def create_llm_text(request: Request, title: str):
+    try:
+        return await request.app.state.ad_text_generator.generate(title)
+    except AdTextError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def enqueue_llm_text(request: Request, response: Response, campaign_id: uuid.UUID, title: str):
+    # the text is written by a background job, its id is returned for GET /jobs/{job_id}
+    job = await request.app.state.job_queue.enqueue('ad_text', {'campaign_id': str(campaign_id), 'title': title})
+    response.headers['X-Job-Id'] = str(job['job_id'])
 
 
 @router.post("/advertisers/{advertiser_id}/campaigns", status_code=status.HTTP_201_CREATED, response_model=Campaign)
 async def create_campaign(request: Request,
+                          response: Response,
                           advertiser_id: Annotated[uuid.UUID, Path()],
                           data: Annotated[CampaignCreate, Body()],
                           llm: Annotated[Optional[int], Query()] = None,
+                          llm_async: Annotated[bool, Query()] = False,
                           session: AsyncSession = Depends(create_session)):
     advertiser_exists = await session.execute(select(advertiser_model.Advertiser)
                                               .where(advertiser_model.Advertiser.advertiser_id == advertiser_id))
@@ -49,7 +49,7 @@ async def create_campaign(request: Request,
     if advertiser_exists is None:
         raise HTTPException(status_code=404, detail="Advertiser not found")
 
-    current_day = await redis_client.get_day(request.app.state.redis)
+    current_day = await request.app.state.day_cache.get()
 
     if not (current_day <= data.start_date <= data.end_date):
         raise HTTPException(status_code=400,
@@ -75,19 +75,16 @@ async def create_campaign(request: Request,
         end_date=data.end_date,
         targeting=d
     )
-    if llm is not None:
-        attempts = 3
-        while True:
-            try:
-                new_campaign.ad_text = create_llm_text(data.ad_title)
-                break
-            except Exception:
-                attempts -= 1
-                if attempts == 0:
-                    raise HTTPException(status_code=500, detail="Error due creating llm text")
+    if llm is not None and not llm_async:
+        new_campaign.ad_text = await create_llm_text(request, data.ad_title)
 
     session.add(new_campaign)
     await session.commit()
+    request.app.state.targeting_index.upsert(new_campaign)
+    await request.app.state.campaign_sync.invalidate_many([new_campaign.campaign_id])
+    await request.app.state.stats_cache.bump(advertiser_ids=[advertiser_id])
+    if llm is not None and llm_async:
+        await enqueue_llm_text(request, response, new_campaign.campaign_id, new_campaign.ad_title)
     return new_campaign
 
 
@@ -134,10 +131,12 @@ async def get_campaign(advertiser_id: Annotated[uuid.UUID, Path()],
 
 @router.put("/advertisers/{advertiser_id}/campaigns/{campaign_id}", response_model=Campaign)
 async def update_campaign(request: Request,
+                          response: Response,
                           advertiser_id: Annotated[uuid.UUID, Path()],
                           campaign_id: Annotated[uuid.UUID, Path()],
                           data: Annotated[CampaignUpdate, Body()],
                           llm: Annotated[Optional[int], Query()] = None,
+                          llm_async: Annotated[bool, Query()] = False,
                           session: AsyncSession = Depends(create_session)):
     campaign_exists = await session.execute(select(campaign_model.Campaign)
                                             .filter(campaign_model.Campaign.campaign_id == campaign_id,
@@ -146,7 +145,7 @@ async def update_campaign(request: Request,
     if campaign_exists is None:
         raise HTTPException(status_code=404, detail="Campaign not found")
 
-    current_day = await redis_client.get_day(request.app.state.redis)
+    current_day = await request.app.state.day_cache.get()
 
     if campaign_exists.start_date <= current_day:
         if data.start_date is not None or data.end_date is not None:
@@ -183,35 +182,40 @@ async def update_campaign(request: Request,
     if data.ad_text is not None:
         campaign_exists.ad_text = data.ad_text
 
-    if llm is not None:
-        attempts = 3
-        while True:
-            try:
-                campaign_exists.ad_text = create_llm_text(campaign_exists.ad_title)
-                break
-            except Exception:
-                attempts -= 1
-                if attempts == 0:
-                    raise HTTPException(status_code=500, detail="Error due creating llm text")
+    if llm is not None and not llm_async:
+        campaign_exists.ad_text = await create_llm_text(request, campaign_exists.ad_title)
 
     campaign_exists.targeting['gender'] = data.targeting.gender
     campaign_exists.targeting['age_from'] = data.targeting.age_from
     campaign_exists.targeting['age_to'] = data.targeting.age_to
     campaign_exists.targeting['location'] = data.targeting.location
+    flag_modified(campaign_exists, 'targeting')
     await session.commit()
+    request.app.state.targeting_index.upsert(campaign_exists)
+    await request.app.state.campaign_sync.invalidate_many([campaign_id])
+    if llm is not None and llm_async:
+        await enqueue_llm_text(request, response, campaign_id, campaign_exists.ad_title)
     return campaign_exists
 
 
 @router.delete("/advertisers/{advertiser_id}/campaigns/{campaign_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_campaign(advertiser_id: Annotated[uuid.UUID, Path()],
+async def delete_campaign(request: Request,
+                          advertiser_id: Annotated[uuid.UUID, Path()],
                           campaign_id: Annotated[uuid.UUID, Path()],
                           session: AsyncSession = Depends(create_session)):
+    # the row lock makes the action writer's inserts for this campaign wait (and then drop their rows),
+    # so the cascade below sees every action committed before it
     campaign_exists = await session.execute(select(campaign_model.Campaign)
                                             .filter(campaign_model.Campaign.campaign_id == campaign_id,
-                                                    campaign_model.Campaign.advertiser_id == advertiser_id))
+                                                    campaign_model.Campaign.advertiser_id == advertiser_id)
+                                            .with_for_update())
     campaign_exists = campaign_exists.scalar_one_or_none()
     if campaign_exists is None:
         raise HTTPException(status_code=404, detail="Campaign not found")
 
     await session.delete(campaign_exists)
     await session.commit()
+    request.app.state.targeting_index.remove(campaign_id)
+    await request.app.state.campaign_sync.invalidate_many([campaign_id])
+    await campaign_counters.delete_counters(request.app.state.redis, campaign_id)
+    await request.app.state.stats_cache.bump([campaign_id], [advertiser_id])
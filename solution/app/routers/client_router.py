@@ -1,74 +1,80 @@
 import string
 from typing import Annotated
 
-from fastapi import APIRouter, Body, Path, Depends, HTTPException
+from fastapi import APIRouter, Body, Path, Query, Depends, HTTPException, Request
 from starlette import status
 
-from sqlalchemy import select
+from sqlalchemy import String, any_, bindparam, select
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..db.db_session import create_session
 from ..db import client_model
+from ..importing.imports import run_import_request
 
 from ..schemas.client_schemas import ClientUpsert, Client
+from ..schemas.import_schemas import ImportReport
+from ..schemas.job_schemas import Job
 
 import uuid
 
 
 router = APIRouter(tags=["Clients"])
 
+_UPSERT_CHUNK_SIZE = 5000
+
 
 @router.post("/clients/bulk", status_code=status.HTTP_201_CREATED, response_model=list[Client])
-async def create_clients(clients: Annotated[list[ClientUpsert], Body()],
+async def create_clients(request: Request, clients: Annotated[list[ClientUpsert], Body()],
                          session: AsyncSession = Depends(create_session)):
     # ok_letters = set(string.ascii_lowercase + string.ascii_uppercase + string.digits)
-    logins_array = []
-    uuids_array = []
-    for data in clients:
-        # for ch in data.login:
-        #     if ch not in ok_letters:
-        #         raise HTTPException(status_code=400, detail=f"Bad login: {data.login}")
-
-        result = await session.execute(select(client_model.Client)
-                                       .where(client_model.Client.login == data.login))
-        client = result.scalar_one_or_none()
-        if client is not None and client.client_id != data.client_id:
-            raise HTTPException(status_code=400, detail=f"Login {client.login} is already registered")
-
-        logins_array.append(data.login)
-        uuids_array.append(data.client_id)
-
-    if len(logins_array) != len(set(logins_array)) or \
-        len(uuids_array) != len(set(uuids_array)):
+    # for data in clients:
+    #     for ch in data.login:
+    #         if ch not in ok_letters:
+    #             raise HTTPException(status_code=400, detail=f"Bad login: {data.login}")
+    owners = {data.login: data.client_id for data in clients}
+    uuids_array = {data.client_id for data in clients}
+    if len(owners) != len(clients) or len(uuids_array) != len(clients):
         raise HTTPException(status_code=400, detail="Login or UUID are not unique")
 
-    for data in clients:
-        result = await session.execute(select(client_model.Client)
-                                       .where(client_model.Client.client_id == data.client_id))
-        client = result.scalar_one_or_none()
-        if client is None:
-            new_client = client_model.Client(
-                client_id=data.client_id,
-                login=data.login,
-                age=data.age,
-                location=data.location,
-                gender=data.gender
-            )
-            session.add(new_client)
-        else:
-            client.login = data.login
-            client.age = data.age
-            client.location = data.location
-            client.gender = data.gender
+    # one lookup through the unique index on login, the logins are passed as a single array parameter
+    table = client_model.Client.__table__
+    registered = await session.execute(select(table.c.client_id, table.c.login)
+                                       .where(table.c.login == any_(bindparam('logins', list(owners),
+                                                                              type_=ARRAY(String)))))
+    for client_id, login in registered.all():
+        if owners[login] != client_id:
+            raise HTTPException(status_code=400, detail=f"Login {login} is already registered")
+
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(index_elements=['client_id'],
+                                                set_={name: statement.excluded[name]
+                                                      for name in ('login', 'age', 'location', 'gender')})
+    # rows are written in key order, so that concurrent imports of the same clients do not deadlock
+    rows = sorted((data.model_dump() for data in clients), key=lambda row: row['client_id'])
+    try:
+        for i in range(0, len(rows), _UPSERT_CHUNK_SIZE):
+            await session.execute(statement, rows[i:i + _UPSERT_CHUNK_SIZE])
         await session.commit()
+    except IntegrityError:
+        # a concurrent request took one of the logins after the check above
+        await session.rollback()
+        raise HTTPException(status_code=400, detail="Login is already registered")
+    await request.app.state.client_cache.invalidate_many(uuids_array)
     return clients
 
 
+@router.post("/clients/import", response_model=ImportReport, responses={202: {'model': Job}})
+async def import_clients(request: Request, background: Annotated[bool, Query()] = False,
+                         session: AsyncSession = Depends(create_session)):
+    return await run_import_request(request, session, 'import_clients', background)
+
+
 @router.get("/clients/{client_id}", response_model=Client)
-async def get_client_by_uuid(client_id: Annotated[uuid.UUID, Path()],
+async def get_client_by_uuid(request: Request, client_id: Annotated[uuid.UUID, Path()],
                              session: AsyncSession = Depends(create_session)):
-    result = await session.execute(select(client_model.Client).where(client_model.Client.client_id == client_id))
-    user = result.scalar_one_or_none()
+    user = await request.app.state.client_cache.get(session, client_id)
     if user is None:
         raise HTTPException(status_code=404, detail="Client not found")
 
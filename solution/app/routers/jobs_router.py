@@ -0,0 +1,35 @@
+from typing import Annotated
+
+from fastapi import APIRouter, Body, Path, HTTPException, Request
+from starlette import status
+
+from ..schemas.job_schemas import Job, RebuildStatsJob
+
+import uuid
+
+
+router = APIRouter(tags=["Jobs"])
+
+
+@router.post("/jobs", status_code=status.HTTP_202_ACCEPTED, response_model=Job)
+async def create_job(request: Request, job: Annotated[RebuildStatsJob, Body()]):
+    # imports are started by their own endpoints with ?background=1, they need the request body
+    return await request.app.state.job_queue.enqueue(job.kind, {'chunks': job.chunks})
+
+
+@router.get("/jobs/{job_id}", response_model=Job)
+async def get_job(request: Request, job_id: Annotated[uuid.UUID, Path()]):
+    job = await request.app.state.job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/jobs/{job_id}/cancel", response_model=Job)
+async def cancel_job(request: Request, job_id: Annotated[uuid.UUID, Path()]):
+    job_status = await request.app.state.job_queue.cancel(job_id)
+    if job_status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job_status in ('done', 'failed'):
+        raise HTTPException(status_code=409, detail=f"Job is already {job_status}")
+    return await request.app.state.job_queue.get(job_id)
@@ -1,18 +1,20 @@
-from typing import Annotated
+from typing import Annotated, Optional
 
-from fastapi import APIRouter, Body, Path, Depends, HTTPException, Request
+from fastapi import APIRouter, Body, Path, Query, Depends, HTTPException, Request
 
-from sqlalchemy import select
+from sqlalchemy import select, func
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
 
 from ..db.db_session import create_session
+from ..db import action_partitions
 from ..db import advertiser_model
 from ..db import campaign_model
+from ..db.campaign_stats_model import CampaignDailyStats
 
-from ..schemas.stats_schemas import DateSetting, Stats, DailyStats
+from ..schemas.stats_schemas import DateSetting, Stats, DailyStats, AdvertiserCampaignsStats
 
 from ..redis import redis_client
+from ..redis import campaign_counters
 
 import uuid
 
@@ -26,163 +28,209 @@ async def set_new_day(request: Request, new_day: Annotated[DateSetting, Body()])
     if new_day.current_date < current_day:
         raise HTTPException(status_code=400, detail=f"Day must be current day or later")
 
+    await action_partitions.ensure_partition(new_day.current_date)
     await redis_client.set_day(request.app.state.redis, new_day.current_date)
+    request.app.state.day_cache.set_local(new_day.current_date)
+    request.app.state.day_compactor.day_advanced(new_day.current_date)
     return new_day
 
 
-@router.get("/stats/campaigns/{campaign_id}", response_model=Stats)
-async def get_campaign_stats(campaign_id: Annotated[uuid.UUID, Path()],
-                             session: AsyncSession = Depends(create_session)):
-    campaign = await session.execute(select(campaign_model.Campaign)
-                                     .options(selectinload(campaign_model.Campaign.actions))
-                                     .where(campaign_model.Campaign.campaign_id == campaign_id))
-    campaign = campaign.scalar_one_or_none()
+def stats_response(impressions_count: int, clicks_count: int, spent_impressions: float, spent_clicks: float):
+    return {
+        'impressions_count': impressions_count,
+        'clicks_count': clicks_count,
+        'conversion': clicks_count / impressions_count if impressions_count > 0 else 0.0,
+        'spent_impressions': spent_impressions,
+        'spent_clicks': spent_clicks,
+        'spent_total': spent_impressions + spent_clicks
+    }
+
+
+def spent_columns():
+    return (func.coalesce(func.sum(CampaignDailyStats.spent_impressions), 0.0).label('spent_impressions'),
+            func.coalesce(func.sum(CampaignDailyStats.spent_clicks), 0.0).label('spent_clicks'))
+
+
+def daily_columns():
+    return (CampaignDailyStats.day,
+            func.sum(CampaignDailyStats.impressions_count).label('impressions_count'),
+            func.sum(CampaignDailyStats.clicks_count).label('clicks_count'),
+            func.sum(CampaignDailyStats.spent_impressions).label('spent_impressions'),
+            func.sum(CampaignDailyStats.spent_clicks).label('spent_clicks'))
+
+
+def day_range(query, from_day, to_day):
+    # the rollup's primary key (campaign_id, day) turns the range into an index range scan
+    if from_day is not None and to_day is not None and from_day > to_day:
+        raise HTTPException(status_code=400, detail="from_day must not be greater than to_day")
+    if from_day is not None:
+        query = query.where(CampaignDailyStats.day >= from_day)
+    if to_day is not None:
+        query = query.where(CampaignDailyStats.day <= to_day)
+    return query
+
+
+def daily_response(rows):
+    result = []
+    for row in rows:
+        d = stats_response(row.impressions_count, row.clicks_count, row.spent_impressions, row.spent_clicks)
+        d['date'] = row.day
+        result.append(d)
+    return result
+
+
+# Spend comes from the campaign_daily_stats rollup, which is updated together with the actions table.
+# Impression and click counts come from the live Redis counters, like ad selection does, in every total and
+# in the per-campaign breakdown.
+# The endpoints at the end of the file serve these payloads through the Redis stats cache.
+
+async def campaign_stats(request: Request, session: AsyncSession, campaign_id: uuid.UUID):
+    campaign = await session.execute(select(campaign_model.Campaign.campaign_id,
+                                            campaign_model.Campaign.current_impressions,
+                                            campaign_model.Campaign.current_clicks,
+                                            *spent_columns())
+                                     .outerjoin(CampaignDailyStats)
+                                     .where(campaign_model.Campaign.campaign_id == campaign_id)
+                                     .group_by(campaign_model.Campaign.campaign_id))
+    campaign = campaign.one_or_none()
     if campaign is None:
         raise HTTPException(status_code=404, detail="Campaign not found")
 
-    clicks_cost = 0
-    impressions_cost = 0
-    for action in campaign.actions:
-        if action.action == 'click':
-            clicks_cost += action.cost
-        else:
-            impressions_cost += action.cost
-    d = {
-        'impressions_count': campaign.current_impressions,
-        'clicks_count': campaign.current_clicks,
-        'spent_impressions': impressions_cost,
-        'spent_clicks': clicks_cost,
-        'spent_total': impressions_cost + clicks_cost
-    }
-    if campaign.current_impressions > 0:
-        d['conversion'] = campaign.current_clicks / campaign.current_impressions
-    else:
-        d['conversion'] = 0
-    return d
+    [(impressions_count, clicks_count)] = await campaign_counters.get_counters(request.app.state.redis, [campaign])
+    return stats_response(impressions_count, clicks_count, campaign.spent_impressions, campaign.spent_clicks)
 
 
-@router.get("/stats/campaigns/{campaign_id}/daily", response_model=list[DailyStats])
-async def get_campaign_daily_stats(campaign_id: Annotated[uuid.UUID, Path()],
-                                   session: AsyncSession = Depends(create_session)):
-    campaign = await session.execute(select(campaign_model.Campaign)
-                                     .options(selectinload(campaign_model.Campaign.actions))
-                                     .where(campaign_model.Campaign.campaign_id == campaign_id))
-    campaign = campaign.scalar_one_or_none()
-    if campaign is None:
+async def campaign_daily_stats(session: AsyncSession, campaign_id: uuid.UUID,
+                               from_day: Optional[int], to_day: Optional[int]):
+    campaign_exists = await session.execute(select(campaign_model.Campaign.campaign_id)
+                                            .where(campaign_model.Campaign.campaign_id == campaign_id))
+    if campaign_exists.scalar_one_or_none() is None:
         raise HTTPException(status_code=404, detail="Campaign not found")
 
-    daily_stats = {}
-    for action in campaign.actions:
-        if action.day not in daily_stats:
-            daily_stats[action.day] = {
-                'impressions_count': 0,
-                'clicks_count': 0,
-                'spent_impressions': 0,
-                'spent_clicks': 0
-            }
-        if action.action == 'click':
-            daily_stats[action.day]['spent_clicks'] += action.cost
-            daily_stats[action.day]['clicks_count'] += 1
-        else:
-            daily_stats[action.day]['spent_impressions'] += action.cost
-            daily_stats[action.day]['impressions_count'] += 1
-    result = []
-    for day in daily_stats:
-        d = {
-            'date': day,
-            'impressions_count': daily_stats[day]['impressions_count'],
-            'clicks_count': daily_stats[day]['clicks_count'],
-            'spent_impressions': daily_stats[day]['spent_impressions'],
-            'spent_clicks': daily_stats[day]['spent_clicks'],
-            'spent_total': daily_stats[day]['spent_impressions'] + daily_stats[day]['spent_clicks']
-        }
-        if daily_stats[day]['impressions_count'] > 0:
-            d['conversion'] = daily_stats[day]['clicks_count'] / daily_stats[day]['impressions_count']
-        else:
-            d['conversion'] = 0
-        result.append(d)
-    return sorted(result, key=lambda d: d['date'])
+    query = select(*daily_columns()).where(CampaignDailyStats.campaign_id == campaign_id)
+    rows = await session.execute(day_range(query, from_day, to_day)
+                                 .group_by(CampaignDailyStats.day)
+                                 .order_by(CampaignDailyStats.day))
+    return daily_response(rows.all())
 
 
-@router.get("/stats/advertisers/{advertiser_id}/campaigns", response_model=Stats)
-async def get_campaigns_stats_for_advertiser(advertiser_id: Annotated[uuid.UUID, Path()],
-                                             session: AsyncSession = Depends(create_session)):
-    advertiser_exists = await session.execute(select(advertiser_model.Advertiser)
-                                              .options(selectinload(advertiser_model.Advertiser.campaigns))
-                                              .options(selectinload(campaign_model.Campaign.actions))
+async def advertiser_campaigns(request: Request, session: AsyncSession, advertiser_id: uuid.UUID) -> list:
+    # (campaign, impressions, clicks) of every campaign of the advertiser, the same numbers for the total and
+    # for the per-campaign breakdown
+    advertiser_exists = await session.execute(select(advertiser_model.Advertiser.advertiser_id)
                                               .where(advertiser_model.Advertiser.advertiser_id == advertiser_id))
-    advertiser_exists = advertiser_exists.scalar_one_or_none()
-    if advertiser_exists is None:
+    if advertiser_exists.scalar_one_or_none() is None:
         raise HTTPException(status_code=404, detail="Advertiser not found")
 
-    impressions_count = 0
-    clicks_count = 0
-    spent_impressions = 0
-    spent_clicks = 0
-
-    for campaign in advertiser_exists.campaigns:
-        for action in campaign.actions:
-            if action.action == 'click':
-                spent_clicks += action.cost
-            else:
-                spent_impressions += action.cost
-        impressions_count += campaign.current_impressions
-        clicks_count += campaign.current_clicks
-
-    d = {
-        'impressions_count': impressions_count,
-        'clicks_count': clicks_count,
-        'spent_impressions': spent_impressions,
-        'spent_clicks': spent_clicks,
-        'spent_total': spent_impressions + spent_clicks
+    campaigns = await session.execute(select(campaign_model.Campaign.campaign_id,
+                                             campaign_model.Campaign.current_impressions,
+                                             campaign_model.Campaign.current_clicks,
+                                             *spent_columns())
+                                      .outerjoin(CampaignDailyStats)
+                                      .where(campaign_model.Campaign.advertiser_id == advertiser_id)
+                                      .group_by(campaign_model.Campaign.campaign_id)
+                                      .order_by(campaign_model.Campaign.start_date,
+                                                campaign_model.Campaign.campaign_id))
+    campaigns = campaigns.all()
+
+    counters = await campaign_counters.get_counters(request.app.state.redis, campaigns)
+    return [(campaign, impressions, clicks) for campaign, (impressions, clicks) in zip(campaigns, counters)]
+
+
+def total_response(campaigns: list):
+    return stats_response(sum(impressions for _, impressions, _ in campaigns),
+                          sum(clicks for _, _, clicks in campaigns),
+                          sum((campaign.spent_impressions for campaign, _, _ in campaigns), 0.0),
+                          sum((campaign.spent_clicks for campaign, _, _ in campaigns), 0.0))
+
+
+async def advertiser_stats(request: Request, session: AsyncSession, advertiser_id: uuid.UUID):
+    return total_response(await advertiser_campaigns(request, session, advertiser_id))
+
+
+async def advertiser_campaigns_stats(request: Request, session: AsyncSession, advertiser_id: uuid.UUID,
+                                     size: Optional[int], page: Optional[int]):
+    # the total covers all campaigns, so all of them are read once and the page is cut from them
+    campaigns = await advertiser_campaigns(request, session, advertiser_id)
+    page_campaigns = campaigns
+    if size is not None:
+        offset = ((page or 1) - 1) * size
+        page_campaigns = campaigns[offset:offset + size]
+
+    result = []
+    for campaign, impressions, clicks in page_campaigns:
+        d = stats_response(impressions, clicks, campaign.spent_impressions, campaign.spent_clicks)
+        d['campaign_id'] = campaign.campaign_id
+        result.append(d)
+    return {
+        'total': total_response(campaigns),
+        'campaigns_count': len(campaigns),
+        'campaigns': result
     }
-    if impressions_count > 0:
-        d['conversion'] = clicks_count / impressions_count
-    else:
-        d['conversion'] = 0
-    return d
 
 
-@router.get("/stats/advertisers/{advertiser_id}/campaigns/daily", response_model=list[DailyStats])
-async def get_campaign_daily_stats_for_advertiser(advertiser_id: Annotated[uuid.UUID, Path()],
-                                                  session: AsyncSession = Depends(create_session)):
-    advertiser_exists = await session.execute(select(advertiser_model.Advertiser)
-                                              .options(selectinload(advertiser_model.Advertiser.campaigns))
-                                              .options(selectinload(campaign_model.Campaign.actions))
+async def advertiser_daily_stats(session: AsyncSession, advertiser_id: uuid.UUID,
+                                 from_day: Optional[int], to_day: Optional[int]):
+    advertiser_exists = await session.execute(select(advertiser_model.Advertiser.advertiser_id)
                                               .where(advertiser_model.Advertiser.advertiser_id == advertiser_id))
-    advertiser_exists = advertiser_exists.scalar_one_or_none()
-    if advertiser_exists is None:
+    if advertiser_exists.scalar_one_or_none() is None:
         raise HTTPException(status_code=404, detail="Advertiser not found")
 
-    daily_stats = {}
-    for campaign in advertiser_exists.campaigns:
-        for action in campaign.actions:
-            if action.day not in daily_stats:
-                daily_stats[action.day] = {
-                    'impressions_count': 0,
-                    'clicks_count': 0,
-                    'spent_impressions': 0,
-                    'spent_clicks': 0
-                }
-            if action.action == 'click':
-                daily_stats[action.day]['spent_clicks'] += action.cost
-                daily_stats[action.day]['clicks_count'] += 1
-            else:
-                daily_stats[action.day]['spent_impressions'] += action.cost
-                daily_stats[action.day]['impressions_count'] += 1
-    result = []
-    for day in daily_stats:
-        d = {
-            'date': day,
-            'impressions_count': daily_stats[day]['impressions_count'],
-            'clicks_count': daily_stats[day]['clicks_count'],
-            'spent_impressions': daily_stats[day]['spent_impressions'],
-            'spent_clicks': daily_stats[day]['spent_clicks'],
-            'spent_total': daily_stats[day]['spent_impressions'] + daily_stats[day]['spent_clicks']
-        }
-        if daily_stats[day]['impressions_count'] > 0:
-            d['conversion'] = daily_stats[day]['clicks_count'] / daily_stats[day]['impressions_count']
-        else:
-            d['conversion'] = 0
-        result.append(d)
-    return sorted(result, key=lambda d: d['date'])
+    query = (select(*daily_columns())
+             .join(campaign_model.Campaign)
+             .where(campaign_model.Campaign.advertiser_id == advertiser_id))
+    rows = await session.execute(day_range(query, from_day, to_day)
+                                 .group_by(CampaignDailyStats.day)
+                                 .order_by(CampaignDailyStats.day))
+    return daily_response(rows.all())
+
+
+async def cached_stats(request: Request, scope: str, scope_id: uuid.UUID, variant: str, compute):
+    day = await request.app.state.day_cache.get()
+    return await request.app.state.stats_cache.get_or_compute(scope, scope_id, day, variant, compute)
+
+
+@router.get("/stats/campaigns/{campaign_id}", response_model=Stats)
+async def get_campaign_stats(request: Request,
+                             campaign_id: Annotated[uuid.UUID, Path()],
+                             session: AsyncSession = Depends(create_session)):
+    return await cached_stats(request, 'campaign', campaign_id, 'total',
+                              lambda: campaign_stats(request, session, campaign_id))
+
+
+@router.get("/stats/campaigns/{campaign_id}/daily", response_model=list[DailyStats])
+async def get_campaign_daily_stats(request: Request,
+                                   campaign_id: Annotated[uuid.UUID, Path()],
+                                   from_day: Annotated[Optional[int], Query(ge=0)] = None,
+                                   to_day: Annotated[Optional[int], Query(ge=0)] = None,
+                                   session: AsyncSession = Depends(create_session)):
+    return await cached_stats(request, 'campaign', campaign_id, f'daily:{from_day}:{to_day}',
+                              lambda: campaign_daily_stats(session, campaign_id, from_day, to_day))
+
+
+@router.get("/stats/advertisers/{advertiser_id}/campaigns", response_model=Stats)
+async def get_campaigns_stats_for_advertiser(request: Request,
+                                             advertiser_id: Annotated[uuid.UUID, Path()],
+                                             session: AsyncSession = Depends(create_session)):
+    return await cached_stats(request, 'advertiser', advertiser_id, 'total',
+                              lambda: advertiser_stats(request, session, advertiser_id))
+
+
+@router.get("/stats/advertisers/{advertiser_id}/campaigns/breakdown", response_model=AdvertiserCampaignsStats)
+async def get_per_campaign_stats_for_advertiser(request: Request,
+                                                advertiser_id: Annotated[uuid.UUID, Path()],
+                                                size: Annotated[Optional[int], Query(ge=1)] = None,
+                                                page: Annotated[Optional[int], Query(ge=1)] = None,
+                                                session: AsyncSession = Depends(create_session)):
+    return await cached_stats(request, 'advertiser', advertiser_id, f'breakdown:{size}:{page}',
+                              lambda: advertiser_campaigns_stats(request, session, advertiser_id, size, page))
+
+
+@router.get("/stats/advertisers/{advertiser_id}/campaigns/daily", response_model=list[DailyStats])
+async def get_campaign_daily_stats_for_advertiser(request: Request,
+                                                  advertiser_id: Annotated[uuid.UUID, Path()],
+                                                  from_day: Annotated[Optional[int], Query(ge=0)] = None,
+                                                  to_day: Annotated[Optional[int], Query(ge=0)] = None,
+                                                  session: AsyncSession = Depends(create_session)):
+    return await cached_stats(request, 'advertiser', advertiser_id, f'daily:{from_day}:{to_day}',
+                              lambda: advertiser_daily_stats(session, advertiser_id, from_day, to_day))
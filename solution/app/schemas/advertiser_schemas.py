@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel, Field, StrictStr, ConfigDict
 
 import uuid
@@ -19,3 +21,8 @@ class Ad(BaseModel):
     ad_title: StrictStr = Field(min_length=3)
     ad_text: StrictStr = Field(min_length=3)
     advertiser_id: uuid.UUID
+
+
+class AdBatchItem(BaseModel):
+    client_id: uuid.UUID
+    ad: Optional[Ad]
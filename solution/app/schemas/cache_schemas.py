@@ -0,0 +1,9 @@
+from pydantic import BaseModel, Field, StrictInt
+
+
+class CacheStats(BaseModel):
+    size: StrictInt = Field(ge=0)
+    max_size: StrictInt = Field(ge=0)
+    hits: StrictInt = Field(ge=0)
+    misses: StrictInt = Field(ge=0)
+    evictions: StrictInt = Field(ge=0)
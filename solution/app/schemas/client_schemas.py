@@ -29,3 +29,7 @@ class MLScore(BaseModel):
 
 class ClientUUID(BaseModel):
     client_id: uuid.UUID
+
+
+class ClientUUIDs(BaseModel):
+    client_ids: list[uuid.UUID] = Field(min_length=1, max_length=1000)
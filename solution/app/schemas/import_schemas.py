@@ -0,0 +1,14 @@
+from pydantic import BaseModel, Field, StrictInt, StrictStr
+
+
+class ImportRowError(BaseModel):
+    line: StrictInt = Field(ge=1)
+    error: StrictStr
+
+
+class ImportReport(BaseModel):
+    rows: StrictInt = Field(ge=0)
+    imported: StrictInt = Field(ge=0)
+    errors_count: StrictInt = Field(ge=0)
+    # only the first errors are listed
+    errors: list[ImportRowError]
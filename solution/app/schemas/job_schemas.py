@@ -0,0 +1,24 @@
+from typing import Any, Literal, Optional
+
+from pydantic import BaseModel, Field, StrictInt, StrictStr
+
+import uuid
+
+
+class Job(BaseModel):
+    job_id: uuid.UUID
+    kind: StrictStr
+    status: Literal['queued', 'running', 'done', 'failed', 'cancelled']
+    # rows read by an import, chunks rebuilt by a stats rebuild
+    progress: StrictInt = Field(ge=0)
+    cancel_requested: bool
+    result: Optional[dict[str, Any]]
+    error: Optional[StrictStr]
+    created_at: float
+    started_at: Optional[float]
+    finished_at: Optional[float]
+
+
+class RebuildStatsJob(BaseModel):
+    kind: Literal['rebuild_stats']
+    chunks: StrictInt = Field(default=256, ge=1, le=65536)
@@ -1,5 +1,7 @@
 from pydantic import BaseModel, Field, StrictInt, StrictFloat
 
+import uuid
+
 
 class Stats(BaseModel):
     impressions_count: StrictInt = Field(ge=0)
@@ -14,5 +16,15 @@ class DailyStats(Stats):
     date: StrictInt = Field(ge=0)
 
 
+class CampaignStats(Stats):
+    campaign_id: uuid.UUID
+
+
+class AdvertiserCampaignsStats(BaseModel):
+    total: Stats
+    campaigns_count: StrictInt = Field(ge=0)
+    campaigns: list[CampaignStats]
+
+
 class DateSetting(BaseModel):
     current_date: StrictInt = Field(ge=0)
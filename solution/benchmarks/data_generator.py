@@ -0,0 +1,116 @@
+import asyncio
+import random
+import string
+import uuid
+from typing import Optional
+
+import httpx
+
+
+GENDERS = ('MALE', 'FEMALE')
+TARGET_GENDERS = ('MALE', 'FEMALE', 'ALL', None)
+
+
+class Dataset:
+    def __init__(self):
+        self.clients: list[dict] = []
+        self.advertisers: list[dict] = []
+        self.campaigns: list[dict] = []
+        self.ml_scores: list[dict] = []
+        self.campaign_ids: list[str] = []
+        self.start_day = 0
+        self.horizon = 0
+
+
+def _word(rnd: random.Random, k: int):
+    return "".join(rnd.choices(string.ascii_uppercase + string.digits, k=k))
+
+
+def generate(clients: int, advertisers: int, campaigns: int, ml_scores_per_client: int,
+             locations: int = 20, horizon: int = 30, start_day: int = 0, seed: Optional[int] = None) -> Dataset:
+    rnd = random.Random(seed)
+    dataset = Dataset()
+    dataset.start_day = start_day
+    dataset.horizon = start_day + horizon
+    location_names = [f"City{i:03d}" for i in range(locations)]
+
+    for i in range(clients):
+        dataset.clients.append({"client_id": str(uuid.UUID(int=rnd.getrandbits(128))),
+                                "login": f"bench{i}_{_word(rnd, 6)}",
+                                "age": rnd.randint(14, 80),
+                                "location": rnd.choice(location_names),
+                                "gender": rnd.choice(GENDERS)})
+    for i in range(advertisers):
+        dataset.advertisers.append({"advertiser_id": str(uuid.UUID(int=rnd.getrandbits(128))),
+                                    "name": f"Advertiser {i} {_word(rnd, 4)}"})
+
+    for _ in range(campaigns):
+        start_date = start_day + rnd.randint(0, horizon // 2)
+        targeting = {}
+        gender = rnd.choice(TARGET_GENDERS)
+        if gender is not None:
+            targeting["gender"] = gender
+        if rnd.random() < 0.7:
+            targeting["location"] = rnd.choice(location_names)
+        if rnd.random() < 0.5:
+            age_from = rnd.randint(14, 60)
+            targeting["age_from"] = age_from
+            targeting["age_to"] = rnd.randint(age_from, 80)
+        dataset.campaigns.append({
+            "advertiser_id": rnd.choice(dataset.advertisers)["advertiser_id"],
+            "body": {"impressions_limit": rnd.randint(100, 10000),
+                     "clicks_limit": rnd.randint(10, 1000),
+                     "cost_per_impression": round(rnd.uniform(0.1, 5), 2),
+                     "cost_per_click": round(rnd.uniform(0.5, 20), 2),
+                     "ad_title": f"Ad {_word(rnd, 8)}",
+                     "ad_text": f"Text {_word(rnd, 16)}",
+                     "start_date": start_date,
+                     "end_date": rnd.randint(start_date, dataset.horizon),
+                     "targeting": targeting}})
+
+    for client in dataset.clients:
+        for advertiser in rnd.sample(dataset.advertisers, min(ml_scores_per_client, len(dataset.advertisers))):
+            dataset.ml_scores.append({"client_id": client["client_id"],
+                                      "advertiser_id": advertiser["advertiser_id"],
+                                      "score": rnd.randint(0, 1000)})
+    return dataset
+
+
+async def _post_all(http: httpx.AsyncClient, requests: list[tuple[str, object]], concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(url: str, body):
+        async with semaphore:
+            response = await http.post(url, json=body)
+            response.raise_for_status()
+            return response.json() if response.content else None
+
+    return await asyncio.gather(*(post(url, body) for url, body in requests))
+
+
+async def load(http: httpx.AsyncClient, dataset: Dataset, chunk_size: int = 500, concurrency: int = 20):
+    # campaigns can't start in the past; fails with 400 if the server is already past start_day
+    response = await http.post("/time/advance", json={"current_date": dataset.start_day})
+    response.raise_for_status()
+    await _post_all(http, [("/clients/bulk", dataset.clients[i:i + chunk_size])
+                           for i in range(0, len(dataset.clients), chunk_size)], concurrency)
+    await _post_all(http, [("/advertisers/bulk", dataset.advertisers[i:i + chunk_size])
+                           for i in range(0, len(dataset.advertisers), chunk_size)], concurrency)
+    created = await _post_all(http, [(f"/advertisers/{campaign['advertiser_id']}/campaigns", campaign["body"])
+                                     for campaign in dataset.campaigns], concurrency)
+    dataset.campaign_ids = [campaign["campaign_id"] for campaign in created]
+    await _post_all(http, [("/ml-scores", ml_score) for ml_score in dataset.ml_scores], concurrency)
+
+
+async def fetch_campaign_ids(http: httpx.AsyncClient, dataset: Dataset, concurrency: int = 20):
+    # for a data set that was loaded by an earlier run with the same seed
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(advertiser_id: str):
+        async with semaphore:
+            response = await http.get(f"/advertisers/{advertiser_id}/campaigns")
+            response.raise_for_status()
+            return [campaign["campaign_id"] for campaign in response.json()]
+
+    campaigns = await asyncio.gather(*(fetch(advertiser["advertiser_id"]) for advertiser in dataset.advertisers))
+    dataset.campaign_ids = [campaign_id for advertiser_campaigns in campaigns for campaign_id in advertiser_campaigns]
@@ -0,0 +1,109 @@
+import asyncio
+import random
+import time
+from typing import Optional
+
+import httpx
+
+from .data_generator import Dataset
+from .report import EndpointStats
+
+
+DEFAULT_MIX = {"ads": 80, "click": 10, "stats": 9, "advance": 1}
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        name, weight = part.split("=")
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"Unknown operation {name}, expected one of {', '.join(DEFAULT_MIX)}")
+        mix[name] = float(weight)
+    return mix
+
+
+class LoadDriver:
+    # Closed loop: `concurrency` workers send requests back to back until `duration` runs out.
+    # Clicks go to ads that were actually shown, so most of them pass the "seen before click" check.
+
+    def __init__(self, http: httpx.AsyncClient, dataset: Dataset, mix: dict[str, float],
+                 concurrency: int = 50, seed: Optional[int] = None):
+        self.http = http
+        self.dataset = dataset
+        self.concurrency = concurrency
+        self.stats: dict[str, EndpointStats] = {}
+        self.day = dataset.start_day
+        self._operations = list(mix)
+        self._weights = [mix[name] for name in self._operations]
+        self._random = random.Random(seed)
+        self._shown: list[tuple[str, str]] = []
+        self._advance_lock = asyncio.Lock()
+
+    async def run(self, duration: float, warmup: float = 0.0) -> float:
+        if warmup > 0:
+            await self._run_workers(warmup)
+            self.stats = {}
+        return await self._run_workers(duration)
+
+    async def _run_workers(self, duration: float) -> float:
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(*(self._worker(deadline) for _ in range(self.concurrency)))
+        return time.perf_counter() - started
+
+    async def _worker(self, deadline: float):
+        while time.perf_counter() < deadline:
+            operation = self._random.choices(self._operations, self._weights)[0]
+            await getattr(self, f"_{operation}")()
+
+    async def _request(self, endpoint: str, method: str, url: str, **kwargs) -> Optional[httpx.Response]:
+        started = time.perf_counter()
+        try:
+            response = await self.http.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            response = None
+        stats = self.stats.get(endpoint)
+        if stats is None:
+            stats = self.stats[endpoint] = EndpointStats()
+        stats.add(time.perf_counter() - started, response.status_code if response is not None else None)
+        return response
+
+    async def _ads(self):
+        client_id = self._random.choice(self.dataset.clients)["client_id"]
+        response = await self._request("GET /ads", "GET", "/ads", params={"client_id": client_id})
+        if response is not None and response.status_code == 200:
+            self._shown.append((client_id, response.json()["ad_id"]))
+            if len(self._shown) > 100000:
+                del self._shown[:50000]
+
+    async def _click(self):
+        if not self._shown:
+            return await self._ads()
+        client_id, ad_id = self._random.choice(self._shown)
+        await self._request("POST /ads/{ad_id}/click", "POST", f"/ads/{ad_id}/click", json={"client_id": client_id})
+
+    async def _stats(self):
+        kind = self._random.random()
+        if kind < 0.4:
+            campaign_id = self._random.choice(self.dataset.campaign_ids)
+            await self._request("GET /stats/campaigns/{campaign_id}", "GET", f"/stats/campaigns/{campaign_id}")
+        elif kind < 0.6:
+            campaign_id = self._random.choice(self.dataset.campaign_ids)
+            await self._request("GET /stats/campaigns/{campaign_id}/daily", "GET",
+                                f"/stats/campaigns/{campaign_id}/daily")
+        elif kind < 0.8:
+            advertiser_id = self._random.choice(self.dataset.advertisers)["advertiser_id"]
+            await self._request("GET /stats/advertisers/{advertiser_id}/campaigns", "GET",
+                                f"/stats/advertisers/{advertiser_id}/campaigns")
+        else:
+            advertiser_id = self._random.choice(self.dataset.advertisers)["advertiser_id"]
+            await self._request("GET /stats/advertisers/{advertiser_id}/campaigns/daily", "GET",
+                                f"/stats/advertisers/{advertiser_id}/campaigns/daily")
+
+    async def _advance(self):
+        # the day never goes past the generated campaigns, otherwise /ads would only return 404
+        if self.day >= self.dataset.horizon:
+            return await self._ads()
+        async with self._advance_lock:
+            self.day += 1
+            await self._request("POST /time/advance", "POST", "/time/advance", json={"current_date": self.day})
@@ -0,0 +1,77 @@
+import json
+import math
+from typing import Optional
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.statuses: dict[int, int] = {}
+        self.errors = 0
+
+    def add(self, latency: float, status: Optional[int]):
+        self.latencies.append(latency)
+        if status is None:
+            self.errors += 1
+        else:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+def percentile(values: list[float], p: float):
+    # nearest-rank, `values` must be sorted
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(stats: dict[str, EndpointStats], duration: float) -> dict:
+    result = {}
+    for endpoint, endpoint_stats in sorted(stats.items()):
+        latencies = sorted(endpoint_stats.latencies)
+        result[endpoint] = {"requests": len(latencies),
+                            "rps": len(latencies) / duration if duration else 0.0,
+                            "p50_ms": percentile(latencies, 50) * 1000,
+                            "p95_ms": percentile(latencies, 95) * 1000,
+                            "p99_ms": percentile(latencies, 99) * 1000,
+                            "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+                            "statuses": {str(status): count for status, count in sorted(endpoint_stats.statuses.items())},
+                            "errors": endpoint_stats.errors}
+    return result
+
+
+def format_table(summary: dict, duration: float) -> str:
+    header = f"{'endpoint':<55} {'requests':>9} {'rps':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  statuses"
+    lines = [header, "-" * len(header)]
+    total = 0
+    for endpoint, row in summary.items():
+        total += row["requests"]
+        statuses = " ".join(f"{status}:{count}" for status, count in row["statuses"].items())
+        if row["errors"]:
+            statuses += f" errors:{row['errors']}"
+        lines.append(f"{endpoint:<55} {row['requests']:>9} {row['rps']:>9.1f} {row['p50_ms']:>8.2f} "
+                     f"{row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f}  {statuses}")
+    lines.append("-" * len(header))
+    lines.append(f"{'total':<55} {total:>9} {total / duration if duration else 0.0:>9.1f}")
+    return "\n".join(lines)
+
+
+def compare(summary: dict, baseline: dict, max_regression: float) -> list[str]:
+    # endpoints whose p95 grew by more than `max_regression` (0.2 = +20%) against the baseline run
+    regressions = []
+    for endpoint, row in summary.items():
+        base = baseline.get(endpoint)
+        if base is None or base["p95_ms"] == 0:
+            continue
+        if row["p95_ms"] > base["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{endpoint}: p95 {base['p95_ms']:.2f} ms -> {row['p95_ms']:.2f} ms")
+    return regressions
+
+
+def save(summary: dict, path: str):
+    with open(path, "w") as file:
+        json.dump(summary, file, indent=2)
+
+
+def load(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import sys
+
+import httpx
+
+from . import report
+from .data_generator import generate, load, fetch_campaign_ids
+from .load_driver import LoadDriver, DEFAULT_MIX, parse_mix
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for the ad server")
+    parser.add_argument("--target", choices=("http", "inprocess"), default="http",
+                        help="a running server at --base-url, or the app started inside this process")
+    parser.add_argument("--base-url", default="http://localhost:8080")
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--advertisers", type=int, default=200)
+    parser.add_argument("--campaigns", type=int, default=2000)
+    parser.add_argument("--ml-scores-per-client", type=int, default=5)
+    parser.add_argument("--locations", type=int, default=20)
+    parser.add_argument("--start-day", type=int, default=0,
+                        help="first campaign start date; the server's day is advanced to it before loading")
+    parser.add_argument("--horizon", type=int, default=30, help="days from --start-day to the last campaign end date")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--skip-load", action="store_true",
+                        help="reuse the data set loaded by an earlier run with the same --seed")
+    parser.add_argument("--mix", type=parse_mix, default=dict(DEFAULT_MIX),
+                        help="operation weights, e.g. ads=80,click=10,stats=9,advance=1")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--json", dest="json_path", help="save the summary to this file")
+    parser.add_argument("--baseline", help="summary of an earlier run to compare p95 latencies with")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="allowed p95 growth against --baseline, 0.2 = +20%%")
+    return parser.parse_args(argv)
+
+
+async def run_benchmark(http: httpx.AsyncClient, args) -> dict:
+    dataset = generate(args.clients, args.advertisers, args.campaigns, args.ml_scores_per_client,
+                       locations=args.locations, horizon=args.horizon, start_day=args.start_day, seed=args.seed)
+    if args.skip_load:
+        await fetch_campaign_ids(http, dataset)
+    else:
+        print(f"Loading {len(dataset.clients)} clients, {len(dataset.advertisers)} advertisers, "
+              f"{len(dataset.campaigns)} campaigns, {len(dataset.ml_scores)} ML scores", file=sys.stderr)
+        await load(http, dataset)
+    driver = LoadDriver(http, dataset, args.mix, concurrency=args.concurrency, seed=args.seed)
+    print(f"Running for {args.duration}s with {args.concurrency} workers", file=sys.stderr)
+    duration = await driver.run(args.duration, warmup=args.warmup)
+    summary = report.summarize(driver.stats, duration)
+    print(report.format_table(summary, duration))
+    return summary
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if args.target == "inprocess":
+        from main import server_app
+
+        await server_app.router.startup()
+        try:
+            transport = httpx.ASGITransport(app=server_app, raise_app_exceptions=False)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=30) as http:
+                summary = await run_benchmark(http, args)
+        finally:
+            await server_app.router.shutdown()
+    else:
+        async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=30) as http:
+            summary = await run_benchmark(http, args)
+
+    if args.json_path:
+        report.save(summary, args.json_path)
+    if args.baseline:
+        regressions = report.compare(summary, report.load(args.baseline), args.max_regression)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
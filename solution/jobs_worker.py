@@ -0,0 +1,56 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
+from types import SimpleNamespace
+
+import dotenv
+
+import app.db.db_session
+from app.cache.campaign_sync import CampaignSync
+from app.cache.client_cache import ClientCache
+from app.cache.ml_score_cache import MLScoreCache
+from app.jobs.queue import JobQueue
+from app.jobs.worker import JobWorker
+from app.llm.ad_text import AdTextGenerator
+from app.redis.redis_client import init_redis
+
+
+# Runs background jobs (imports started with ?background=1, POST /jobs) outside of the server processes,
+# start the server with JOB_WORKERS=0 then. Cache invalidations of the jobs reach the server workers
+# through Redis.
+
+
+async def run(concurrency: int):
+    await app.db.db_session.global_init()
+    redis = await init_redis()
+    # the caches are only used to invalidate entries, they are never read here
+    state = SimpleNamespace(client_cache=ClientCache.from_env(redis), ml_score_cache=MLScoreCache.from_env(redis),
+                            campaign_sync=CampaignSync(redis), ad_text_generator=AdTextGenerator.from_env(redis))
+    worker = JobWorker(JobQueue.from_env(redis), state, concurrency)
+    stopped = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signal_number, stopped.set)
+    worker.start()
+    try:
+        # a running job is marked as failed when the worker stops
+        await stopped.wait()
+    finally:
+        await worker.stop()
+        await app.db.db_session.engine.dispose()
+        await redis.aclose()
+
+
+def main():
+    dotenv.load_dotenv()
+    parser = argparse.ArgumentParser(description="Run background jobs")
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('JOB_WORKERS', '1')) or 1,
+                        help="jobs run at the same time")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,33 @@
+import asyncio
 import os
 
 import dotenv
 import uvicorn
 
 from fastapi import FastAPI
+from prometheus_client import REGISTRY
 
 import app.db.db_session
+from app.db.action_partitions import DayCompactor, ensure_partition
+from app.db.action_writer import ActionWriter
 from app.redis.redis_client import init_redis, set_day
+from app.redis.day_cache import DayCache
+from app.redis.stats_cache import StatsCache
+from app.redis.campaign_counters import flush_counters, run_counters_flusher, run_counters_sync
+from app.cache.campaign_sync import CampaignSync
+from app.cache.client_cache import ClientCache
+from app.cache.ml_score_cache import MLScoreCache
+from app.engine.targeting_index import TargetingIndex
+from app.engine.scoring import ScoringEngine
+from app.jobs.queue import JobQueue
+from app.jobs.worker import JobWorker
+from app.llm.ad_text import AdTextGenerator
+from app.monitoring.metrics import CacheCollector
+from app.monitoring.middleware import MetricsMiddleware
+from app.monitoring.sql import QueryBudgetMiddleware
 
-from app.routers import (ads_router, advertisers_router, campaigns_router,
-                         client_router, stats_router)
+from app.routers import (ads_router, advertisers_router, cache_router, campaigns_router,
+                         client_router, jobs_router, metrics_router, stats_router)
 
 
 dotenv.load_dotenv()
@@ -17,20 +35,65 @@ dotenv.load_dotenv()
 server_app = FastAPI()
 server_app.include_router(ads_router.router)
 server_app.include_router(advertisers_router.router)
+server_app.include_router(cache_router.router)
 server_app.include_router(campaigns_router.router)
 server_app.include_router(client_router.router)
+server_app.include_router(jobs_router.router)
+server_app.include_router(metrics_router.router)
 server_app.include_router(stats_router.router)
+server_app.add_middleware(QueryBudgetMiddleware, budget=int(os.getenv('SQL_QUERY_BUDGET', '10')),
+                          debug_headers=os.getenv('SQL_DEBUG_HEADERS', '0') == '1')
+server_app.add_middleware(MetricsMiddleware)
+REGISTRY.register(CacheCollector(server_app.state, {'clients': 'client_cache', 'ml_scores': 'ml_score_cache'}))
 
 
 @server_app.on_event("startup")
 async def startup():
     await app.db.db_session.global_init()
     server_app.state.redis = await init_redis()
+    await ensure_partition(0)
     await set_day(server_app.state.redis, 0)
+    server_app.state.day_cache = DayCache.from_env(server_app.state.redis)
+    await server_app.state.day_cache.start()
+    server_app.state.client_cache = ClientCache.from_env(server_app.state.redis)
+    server_app.state.client_cache.start()
+    server_app.state.ml_score_cache = MLScoreCache.from_env(server_app.state.redis)
+    server_app.state.ml_score_cache.start()
+    server_app.state.targeting_index = TargetingIndex()
+    server_app.state.campaign_sync = CampaignSync(server_app.state.redis, server_app.state.targeting_index)
+    server_app.state.campaign_sync.start()
+    server_app.state.scoring_engine = ScoringEngine.from_env()
+    server_app.state.stats_cache = StatsCache.from_env(server_app.state.redis)
+    server_app.state.action_writer = ActionWriter.from_env()
+    server_app.state.action_writer.on_written = server_app.state.stats_cache.bump
+    server_app.state.action_writer.start()
+    server_app.state.day_compactor = DayCompactor.from_env()
+    server_app.state.day_compactor.action_writer = server_app.state.action_writer
+    server_app.state.day_compactor.start()
+    server_app.state.ad_text_generator = AdTextGenerator.from_env(server_app.state.redis)
+    server_app.state.job_queue = JobQueue.from_env(server_app.state.redis)
+    # JOB_WORKERS=0 leaves the jobs to jobs_worker.py
+    server_app.state.job_worker = JobWorker.from_env(server_app.state.job_queue, server_app.state)
+    server_app.state.job_worker.start()
+    server_app.state.counters_flusher = asyncio.create_task(
+        run_counters_flusher(server_app.state.redis, float(os.getenv('COUNTERS_FLUSH_INTERVAL', '1'))))
+    server_app.state.counters_sync = asyncio.create_task(
+        run_counters_sync(server_app.state.redis, server_app.state.targeting_index,
+                          float(os.getenv('COUNTERS_SYNC_INTERVAL', '0.2'))))
 
 
 @server_app.on_event("shutdown")
 async def shutdown():
+    await server_app.state.action_writer.stop()
+    await server_app.state.day_compactor.stop()
+    await server_app.state.job_worker.stop()
+    await server_app.state.day_cache.stop()
+    await server_app.state.client_cache.stop()
+    await server_app.state.ml_score_cache.stop()
+    await server_app.state.campaign_sync.stop()
+    server_app.state.counters_flusher.cancel()
+    server_app.state.counters_sync.cancel()
+    await flush_counters(server_app.state.redis)
     await app.db.db_session.engine.dispose()
     await server_app.state.redis.aclose()
 
@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import dotenv
+from sqlalchemy import func, select
+
+import app.db.db_session
+from app.db import action_day_model
+from app.db import stats_rollup
+
+
+# Rebuilds campaign_daily_stats from the actions table while the service keeps running.
+# The work is split into chunks by campaign_id range or by day; every chunk is recomputed inside Postgres
+# in its own transaction, so memory use does not depend on the size of actions. Finished chunks are
+# written to the state file and skipped when the command is started again.
+
+
+def day_chunks(first_day: int, last_day: int, days_per_chunk: int):
+    return [[day, min(day + days_per_chunk - 1, last_day)] for day in range(first_day, last_day + 1, days_per_chunk)]
+
+
+async def make_plan(args):
+    if args.by == 'campaign':
+        return {'by': 'campaign', 'chunks': stats_rollup.campaign_chunks(args.chunks), 'done': []}
+
+    first_day, last_day = args.from_day, args.to_day
+    if first_day is None or last_day is None:
+        async with app.db.db_session.session_factory() as session:
+            # every day that got actions has a partition; detached days cannot be rebuilt
+            days = action_day_model.ActionDay
+            result = await session.execute(select(func.min(days.day), func.max(days.day)).where(~days.detached))
+            min_day, max_day = result.one()
+        if min_day is None:
+            return {'by': 'day', 'chunks': [], 'done': []}
+        first_day = min_day if first_day is None else first_day
+        last_day = max_day if last_day is None else last_day
+    return {'by': 'day', 'chunks': day_chunks(first_day, last_day, args.days_per_chunk), 'done': []}
+
+
+def save_state(path: str, plan: dict):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(plan, f)
+    os.replace(path + '.tmp', path)
+
+
+async def rebuild_chunk(plan: dict, index: int, attempts: int = 3):
+    for attempt in range(attempts):
+        try:
+            async with app.db.db_session.session_factory() as session:
+                rows = await stats_rollup.rebuild_partition(session, plan['by'], plan['chunks'][index])
+                await session.commit()
+            return rows
+        except Exception as e:
+            # deadlocks with live writers are possible, though rare
+            if attempt == attempts - 1:
+                raise
+            print(f"chunk {index} failed ({e.__class__.__name__}), retrying", file=sys.stderr)
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+
+async def run(args):
+    await app.db.db_session.global_init()
+
+    plan = None
+    if os.path.exists(args.state) and not args.restart:
+        with open(args.state) as f:
+            plan = json.load(f)
+        print(f"Resuming from {args.state}: {len(plan['done'])}/{len(plan['chunks'])} chunks done, "
+              f"partitioned by {plan['by']}")
+    if plan is None:
+        plan = await make_plan(args)
+        save_state(args.state, plan)
+
+    done = set(plan['done'])
+    pending = asyncio.Queue()
+    for index in range(len(plan['chunks'])):
+        if index not in done:
+            pending.put_nowait(index)
+    total = len(plan['chunks'])
+    started = time.perf_counter()
+    processed = 0
+
+    async def worker():
+        # overlapping chunks wait for each other inside rebuild_partition, the chunks of one plan do not overlap
+        nonlocal processed
+        while not pending.empty():
+            index = pending.get_nowait()
+            chunk_started = time.perf_counter()
+            rows = await rebuild_chunk(plan, index)
+            plan['done'].append(index)
+            save_state(args.state, plan)
+
+            processed += 1
+            elapsed = time.perf_counter() - started
+            eta = elapsed / processed * (total - len(plan['done']))
+            print(f"[{len(plan['done'])}/{total}] {plan['by']} {plan['chunks'][index]}: {rows} rows corrected "
+                  f"in {time.perf_counter() - chunk_started:.1f}s, elapsed {elapsed:.0f}s, eta {eta:.0f}s")
+
+    try:
+        await asyncio.gather(*[worker() for _ in range(args.jobs)])
+    finally:
+        await app.db.db_session.engine.dispose()
+    os.remove(args.state)
+    print(f"Rebuilt {total} chunks in {time.perf_counter() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild campaign_daily_stats from the actions table")
+    parser.add_argument('--by', choices=('campaign', 'day'), default='campaign',
+                        help="partition the work by campaign_id range or by day")
+    parser.add_argument('--chunks', type=int, default=256, help="number of campaign_id ranges")
+    parser.add_argument('--from-day', type=int, help="first day to rebuild with --by day")
+    parser.add_argument('--to-day', type=int, help="last day to rebuild with --by day")
+    parser.add_argument('--days-per-chunk', type=int, default=1)
+    parser.add_argument('--jobs', type=int, default=4, help="chunks rebuilt in parallel")
+    parser.add_argument('--state', default='rebuild_stats.state.json',
+                        help="progress file, an existing one is resumed")
+    parser.add_argument('--restart', action='store_true', help="ignore the progress file and start over")
+    args = parser.parse_args()
+
+    dotenv.load_dotenv()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+import asyncio
+import os
+
+import pytest
+
+from app.db import db_session
+
+
+@pytest.fixture
+def run_with_database(monkeypatch):
+    # runs `test()` against the Postgres of DATABASE_URL with a fresh engine; the rows a test creates
+    # are its own to clean up
+    if not os.getenv('DATABASE_URL'):
+        pytest.skip("DATABASE_URL is not set")
+    monkeypatch.setattr(db_session, 'engine', None)
+    monkeypatch.setattr(db_session, 'session_factory', None)
+
+    def run(test):
+        async def main():
+            await db_session.global_init()
+            try:
+                await test()
+            finally:
+                await db_session.engine.dispose()
+        asyncio.run(main())
+    return run
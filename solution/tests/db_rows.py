@@ -0,0 +1,41 @@
+import uuid
+
+from sqlalchemy import delete, text
+
+from app.db import action_day_model
+from app.db import advertiser_model
+from app.db import campaign_model
+from app.db import client_model
+from app.db import db_session
+from app.db.action_partitions import partition_name
+
+
+# rows for the tests that run against the Postgres of DATABASE_URL (the run_with_database fixture)
+
+
+async def create_campaign_and_client():
+    advertiser_id, campaign_id, client_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    async with db_session.session_factory() as session:
+        session.add(advertiser_model.Advertiser(advertiser_id=advertiser_id, name='Test advertiser'))
+        await session.flush()
+        session.add(campaign_model.Campaign(campaign_id=campaign_id, advertiser_id=advertiser_id,
+                                            impressions_limit=10, clicks_limit=10, cost_per_impression=1.0,
+                                            cost_per_click=2.0, ad_title='Title', ad_text='Text', start_date=0,
+                                            end_date=5, targeting={}))
+        session.add(client_model.Client(client_id=client_id, login=uuid.uuid4().hex, age=30, location='Omsk'))
+        await session.commit()
+    return campaign_id, client_id
+
+
+async def clean_up(campaign_id, day: int):
+    async with db_session.session_factory() as session:
+        campaign = await session.get(campaign_model.Campaign, campaign_id)
+        await session.delete(campaign)
+        await session.execute(text(f'DROP TABLE IF EXISTS {partition_name(day)}'))
+        await session.execute(delete(action_day_model.ActionDay).where(action_day_model.ActionDay.day == day))
+        await session.commit()
+
+
+def unused_day():
+    # far past any simulated day, so that the test owns its partition
+    return 100000 + uuid.uuid4().int % 100000
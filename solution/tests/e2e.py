@@ -105,8 +105,10 @@ def test_ad_display_and_click():
                   json=[{"client_id": client_id,
                          "login": "".join(random.choices(string.ascii_uppercase + string.digits, k=10)),
                          "age": 25, "location": "Moscow", "gender": "MALE"}])
-    requests.post(f"{BASE_URL}/advertisers/bulk", json=[{"advertiser_id": advertiser_id, "name": "A"}])
-    requests.post(
+    response = requests.post(f"{BASE_URL}/advertisers/bulk",
+                             json=[{"advertiser_id": advertiser_id, "name": "Advertiser A"}])
+    assert response.status_code == 201
+    response = requests.post(
         f"{BASE_URL}/advertisers/{advertiser_id}/campaigns",
         json={
             "impressions_limit": 100,
@@ -120,10 +122,14 @@ def test_ad_display_and_click():
             "targeting": {"gender": "MALE"}
         }
     )
-    requests.post(f"{BASE_URL}/ml-scores", json={"client_id": client_id, "advertiser_id": advertiser_id, "score": 100})
+    assert response.status_code == 201
+    response = requests.post(f"{BASE_URL}/ml-scores",
+                             json={"client_id": client_id, "advertiser_id": advertiser_id, "score": 100})
+    assert response.status_code == 200
 
     # Установка текущего дня
-    requests.post(f"{BASE_URL}/time/advance", json={"current_date": 2})
+    response = requests.post(f"{BASE_URL}/time/advance", json={"current_date": 2})
+    assert response.status_code == 200
 
     # Запрос объявления
     response = requests.get(f"{BASE_URL}/ads?client_id={client_id}")
@@ -1,5 +1,6 @@
 import random
 import string
+import time
 
 import pytest
 import requests
@@ -9,6 +10,35 @@ import uuid
 BASE_URL = "http://REDACTED:8080"
 
 
+def set_day(day: int):
+    response = requests.post(f"{BASE_URL}/time/advance", json={"current_date": day})
+    assert response.status_code == 200
+
+
+def unique_location():
+    # campaigns target a location of their own, so that ads of other tests never match
+    return "".join(random.choices(string.ascii_uppercase, k=12))
+
+
+def random_login():
+    return "".join(random.choices(string.ascii_uppercase + string.digits, k=10))
+
+
+def create_clients(location: str, count: int = 1, age: int = 25, gender: str = "MALE"):
+    client_ids = [str(uuid.uuid4()) for _ in range(count)]
+    response = requests.post(f"{BASE_URL}/clients/bulk",
+                             json=[{"client_id": client_id, "login": random_login(), "age": age,
+                                    "location": location, "gender": gender} for client_id in client_ids])
+    assert response.status_code == 201
+    return client_ids
+
+
+def shown_ad(client_id: str):
+    response = requests.get(f"{BASE_URL}/ads?client_id={client_id}")
+    assert response.status_code in (200, 404)
+    return response.json()["ad_id"] if response.status_code == 200 else None
+
+
 # Фикстуры для создания тестовых данных
 @pytest.fixture
 def client_id():
@@ -29,7 +59,7 @@ def campaign_id():
 def test_client(client_id):
     client_data = {
         "client_id": client_id,
-        "login": "".join(random.choices(string.ascii_uppercase + string.digits, k=10)),
+        "login": random_login(),
         "age": random.randint(1, 100),
         "location": "Moscow",
         "gender": "MALE"
@@ -43,7 +73,7 @@ def test_client(client_id):
 def test_advertiser(advertiser_id):
     advertiser_data = {
         "advertiser_id": advertiser_id,
-        "name": "".join(random.choices(string.ascii_uppercase + string.digits, k=10))
+        "name": random_login()
     }
     response = requests.post(f"{BASE_URL}/advertisers/bulk", json=[advertiser_data])
     assert response.status_code == 201
@@ -51,29 +81,40 @@ def test_advertiser(advertiser_id):
 
 
 @pytest.fixture
-def test_campaign(test_advertiser, campaign_id):
-    campaign_data = {
-        "impressions_limit": 1000,
-        "clicks_limit": 100,
-        "cost_per_impression": 0.5,
-        "cost_per_click": 5.0,
-        "ad_title": "Test Campaign",
-        "ad_text": "Test Ad Text",
-        "start_date": 2,
-        "end_date": 7,
-        "targeting": {
-            "gender": "MALE",
-            "age_from": 20,
-            "age_to": 30,
-            "location": "Moscow"
+def create_campaign():
+    # campaigns created through here are deleted after the test
+    created = []
+
+    def create(advertiser_id: str, location: str, **fields):
+        campaign_data = {
+            "impressions_limit": 10,
+            "clicks_limit": 10,
+            "cost_per_impression": 1.0,
+            "cost_per_click": 2.0,
+            "ad_title": "Test Campaign",
+            "ad_text": "Test Ad Text",
+            "start_date": 2,
+            "end_date": 5,
+            "targeting": {"location": location},
+            **fields
         }
-    }
-    response = requests.post(
-        f"{BASE_URL}/advertisers/{test_advertiser}/campaigns",
-        json=campaign_data
-    )
-    assert response.status_code == 201
-    return response.json()["campaign_id"]
+        response = requests.post(f"{BASE_URL}/advertisers/{advertiser_id}/campaigns", json=campaign_data)
+        assert response.status_code == 201
+        created.append((advertiser_id, response.json()["campaign_id"]))
+        return response.json()["campaign_id"]
+
+    yield create
+    for advertiser_id, created_id in created:
+        response = requests.delete(f"{BASE_URL}/advertisers/{advertiser_id}/campaigns/{created_id}")
+        assert response.status_code in (204, 404)
+
+
+@pytest.fixture
+def test_campaign(test_advertiser, create_campaign):
+    location = unique_location()
+    return create_campaign(test_advertiser, location, impressions_limit=1000, clicks_limit=100,
+                           cost_per_impression=0.5, cost_per_click=5.0, end_date=7,
+                           targeting={"gender": "MALE", "age_from": 20, "age_to": 30, "location": location})
 
 
 # Тесты для клиентов и рекламодателей
@@ -100,6 +141,17 @@ def test_upsert_ml_score(test_client, test_advertiser):
     assert response.status_code == 200
 
 
+def test_bulk_ml_scores(test_client, test_advertiser):
+    scores = [{"client_id": test_client, "advertiser_id": test_advertiser, "score": 10},
+              {"client_id": str(uuid.uuid4()), "advertiser_id": test_advertiser, "score": 20},
+              {"client_id": test_client, "advertiser_id": test_advertiser, "score": 30}]
+    response = requests.post(f"{BASE_URL}/ml-scores/bulk", json=scores)
+    assert response.status_code == 200
+    report = response.json()
+    assert (report["rows"], report["imported"], report["errors_count"]) == (3, 1, 1)
+    assert report["errors"][0]["line"] == 2
+
+
 # Тесты для кампаний
 def test_get_campaign(test_advertiser, test_campaign):
     response = requests.get(
@@ -110,14 +162,18 @@ def test_get_campaign(test_advertiser, test_campaign):
 
 
 # Тесты для показа рекламы
-def test_get_ad(test_client):
+def test_get_ad(test_advertiser, create_campaign):
     # Устанавливаем текущий день в диапазон кампании
-    requests.post(f"{BASE_URL}/time/advance", json={"current_date": 1})
+    set_day(2)
+    location = unique_location()
+    client_id, = create_clients(location)
+    campaign_id = create_campaign(test_advertiser, location)
 
     response = requests.get(
-        f"{BASE_URL}/ads?client_id={test_client}"
+        f"{BASE_URL}/ads?client_id={client_id}"
     )
-    assert response.status_code in [200, 404]  # 404 если нет подходящих кампаний
+    assert response.status_code == 200
+    assert response.json()["ad_id"] == campaign_id
 
 
 # Тесты для статистики
@@ -129,6 +185,7 @@ def test_get_campaign_stats(test_campaign):
 
 # Тесты управления временем
 def test_advance_time():
+    # days only go forward, every test runs on day 2
     new_date = {"current_date": 2}
     response = requests.post(f"{BASE_URL}/time/advance", json=new_date)
     assert response.status_code == 200
@@ -149,3 +206,216 @@ def test_invalid_campaign_creation(test_advertiser):
         json=invalid_data
     )
     assert response.status_code == 422
+
+
+def test_ad_index_follows_campaign_changes(test_advertiser, create_campaign):
+    set_day(2)
+    location = unique_location()
+    client_id, = create_clients(location, age=40, gender="FEMALE")
+
+    campaign_id = create_campaign(test_advertiser, location, ad_title="Indexed", ad_text="Indexed text",
+                                  targeting={"gender": "ALL", "age_from": 30, "age_to": 50, "location": location})
+    assert shown_ad(client_id) == campaign_id
+
+    response = requests.delete(f"{BASE_URL}/advertisers/{test_advertiser}/campaigns/{campaign_id}")
+    assert response.status_code == 204
+    assert shown_ad(client_id) != campaign_id
+
+
+def test_get_ads_batch(test_advertiser, create_campaign):
+    set_day(2)
+    location = unique_location()
+    client_ids = create_clients(location, count=3)
+    campaign_id = create_campaign(test_advertiser, location, impressions_limit=2, ad_title="Batch",
+                                  ad_text="Batch text")
+    unknown_id = str(uuid.uuid4())
+
+    response = requests.post(f"{BASE_URL}/ads/batch", json={"client_ids": client_ids + [unknown_id]})
+    assert response.status_code == 200
+    items = response.json()
+    assert [item["client_id"] for item in items] == client_ids + [unknown_id]
+    assert [item["ad"]["ad_id"] if item["ad"] else None for item in items] == [campaign_id] * 3 + [None]
+
+    response = requests.get(f"{BASE_URL}/stats/campaigns/{campaign_id}")
+    assert response.json()["impressions_count"] == 2
+
+
+def test_ad_follows_ml_score_update(create_campaign):
+    set_day(2)
+    location = unique_location()
+    client_id, = create_clients(location)
+    advertiser_ids = [str(uuid.uuid4()) for _ in range(3)]
+    response = requests.post(f"{BASE_URL}/advertisers/bulk",
+                             json=[{"advertiser_id": advertiser_id, "name": random_login()}
+                                   for advertiser_id in advertiser_ids])
+    assert response.status_code == 201
+    campaign_advertisers = {create_campaign(advertiser_id, location, ad_title="ML ad", ad_text="ML text"):
+                            advertiser_id for advertiser_id in advertiser_ids}
+
+    # the first ad loads the client's (empty) scores into the cache
+    shown = shown_ad(client_id)
+    expected, other = [campaign for campaign in campaign_advertisers if campaign != shown]
+    for campaign, score in ((expected, 100), (other, 1)):
+        response = requests.post(f"{BASE_URL}/ml-scores",
+                                 json={"client_id": client_id, "advertiser_id": campaign_advertisers[campaign],
+                                       "score": score})
+        assert response.status_code == 200
+
+    assert shown_ad(client_id) == expected
+
+
+def test_get_client_after_update(test_client):
+    response = requests.get(f"{BASE_URL}/clients/{test_client}")
+    client_data = response.json()
+    client_data["age"] = client_data["age"] % 100 + 1
+    requests.post(f"{BASE_URL}/clients/bulk", json=[client_data])
+
+    response = requests.get(f"{BASE_URL}/clients/{test_client}")
+    assert response.status_code == 200
+    assert response.json() == client_data
+
+
+def test_login_taken_by_another_client(test_client):
+    login = requests.get(f"{BASE_URL}/clients/{test_client}").json()["login"]
+    other = {"client_id": str(uuid.uuid4()), "login": login, "age": 30, "location": "Moscow", "gender": "FEMALE"}
+    response = requests.post(f"{BASE_URL}/clients/bulk", json=[other])
+    assert response.status_code == 400
+    assert requests.get(f"{BASE_URL}/clients/{other['client_id']}").status_code == 404
+
+
+def test_import_clients_reports_bad_rows():
+    client_id = str(uuid.uuid4())
+    login = "".join(random.choices(string.ascii_uppercase + string.digits, k=10))
+    body = (f"client_id,login,age,location,gender\n"
+            f"{client_id},{login},25,Moscow,MALE\n"
+            f"{uuid.uuid4()},{login},30,Moscow,FEMALE\n"
+            f"{uuid.uuid4()},abc,old,Moscow,MALE\n")
+    response = requests.post(f"{BASE_URL}/clients/import", data=body, headers={"Content-Type": "text/csv"})
+    assert response.status_code == 200
+    report = response.json()
+    assert (report["rows"], report["imported"], report["errors_count"]) == (3, 1, 2)
+    assert [error["line"] for error in report["errors"]] == [3, 4]
+    assert requests.get(f"{BASE_URL}/clients/{client_id}").json()["login"] == login
+
+
+def test_background_import():
+    advertiser_id = str(uuid.uuid4())
+    response = requests.post(f"{BASE_URL}/advertisers/import?background=1",
+                             json=[{"advertiser_id": advertiser_id, "name": "Background"}])
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    for _ in range(50):
+        job = requests.get(f"{BASE_URL}/jobs/{job_id}").json()
+        if job["status"] not in ("queued", "running"):
+            break
+        time.sleep(0.1)
+    assert job["status"] == "done"
+    assert job["result"]["imported"] == 1
+    assert requests.get(f"{BASE_URL}/advertisers/{advertiser_id}").status_code == 200
+
+
+def test_campaign_with_async_llm_text(test_advertiser, create_campaign):
+    location = unique_location()
+    response = requests.post(
+        f"{BASE_URL}/advertisers/{test_advertiser}/campaigns?llm=1&llm_async=1",
+        json={
+            "impressions_limit": 10,
+            "clicks_limit": 10,
+            "cost_per_impression": 1.0,
+            "cost_per_click": 2.0,
+            "ad_title": "Async text",
+            "ad_text": "Placeholder",
+            "start_date": 3,
+            "end_date": 5,
+            "targeting": {"location": location}
+        }
+    )
+    assert response.status_code == 201
+    campaign_id = response.json()["campaign_id"]
+    assert response.json()["ad_text"] == "Placeholder"
+    job_id = response.headers['X-Job-Id']
+    for _ in range(50):
+        job = requests.get(f"{BASE_URL}/jobs/{job_id}").json()
+        if job["status"] not in ("queued", "running"):
+            break
+        time.sleep(0.1)
+    assert job["status"] == "done"
+    response = requests.get(f"{BASE_URL}/advertisers/{test_advertiser}/campaigns/{campaign_id}")
+    assert response.json()["ad_text"] != "Placeholder"
+
+    response = requests.delete(f"{BASE_URL}/advertisers/{test_advertiser}/campaigns/{campaign_id}")
+    assert response.status_code == 204
+
+
+def test_stats_after_impression_and_click(test_advertiser, create_campaign):
+    set_day(2)
+    location = unique_location()
+    client_id, = create_clients(location)
+    campaign_id = create_campaign(test_advertiser, location, cost_per_impression=1.5, cost_per_click=4.0,
+                                  ad_title="Stats", ad_text="Stats text")
+    assert shown_ad(client_id) == campaign_id
+    # impressions are written to the database in the background
+    for _ in range(20):
+        stats = requests.get(f"{BASE_URL}/stats/campaigns/{campaign_id}").json()
+        if stats["spent_impressions"] > 0:
+            break
+        time.sleep(0.1)
+    # the cached response has to be invalidated by the click
+    assert stats["clicks_count"] == 0
+    response = requests.post(f"{BASE_URL}/ads/{campaign_id}/click", json={"client_id": client_id})
+    assert response.status_code == 204
+
+    expected = {"impressions_count": 1, "clicks_count": 1, "conversion": 1.0,
+                "spent_impressions": 1.5, "spent_clicks": 4.0, "spent_total": 5.5}
+    assert requests.get(f"{BASE_URL}/stats/campaigns/{campaign_id}/daily").json() == [dict(expected, date=2)]
+    assert requests.get(f"{BASE_URL}/stats/campaigns/{campaign_id}").json() == expected
+    assert requests.get(f"{BASE_URL}/stats/advertisers/{test_advertiser}/campaigns").json() == expected
+    assert requests.get(f"{BASE_URL}/stats/advertisers/{test_advertiser}/campaigns/daily").json() == [
+        dict(expected, date=2)]
+    assert requests.get(f"{BASE_URL}/stats/advertisers/{test_advertiser}/campaigns/breakdown").json() == {
+        "total": expected, "campaigns_count": 1, "campaigns": [dict(expected, campaign_id=campaign_id)]}
+
+    response = requests.get(f"{BASE_URL}/stats/campaigns/{campaign_id}/daily?from_day=1&to_day=2")
+    assert response.json() == [dict(expected, date=2)]
+    response = requests.get(f"{BASE_URL}/stats/advertisers/{test_advertiser}/campaigns/daily?from_day=3")
+    assert response.json() == []
+    response = requests.get(f"{BASE_URL}/stats/campaigns/{campaign_id}/daily?from_day=3&to_day=2")
+    assert response.status_code == 400
+
+
+def test_per_campaign_stats_for_advertiser(test_advertiser, test_campaign):
+    response = requests.get(f"{BASE_URL}/stats/advertisers/{test_advertiser}/campaigns/breakdown")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["campaigns_count"] == 1
+    assert [campaign["campaign_id"] for campaign in data["campaigns"]] == [test_campaign]
+    assert data["total"]["impressions_count"] == data["campaigns"][0]["impressions_count"]
+
+    response = requests.get(f"{BASE_URL}/stats/advertisers/{test_advertiser}/campaigns/breakdown?size=1&page=2")
+    assert response.json()["campaigns"] == []
+    assert response.json()["campaigns_count"] == 1
+
+
+def test_breakdown_adds_up_to_the_advertiser_total(test_advertiser, create_campaign):
+    set_day(2)
+    location = unique_location()
+    campaign_ids = [create_campaign(test_advertiser, location, impressions_limit=100, clicks_limit=100,
+                                    cost_per_impression=cost, cost_per_click=1.0, ad_title="Breakdown",
+                                    ad_text="Breakdown text")
+                    for cost in (1.0, 2.0, 3.0)]
+    client_ids = create_clients(location, count=5, age=30, gender="FEMALE")
+
+    served = []
+    for client_id in client_ids * 2:
+        ad_id = shown_ad(client_id)
+        assert ad_id is not None
+        served.append(ad_id)
+
+    # read right away: the counts must not wait for the impressions to reach the rollup
+    breakdown = requests.get(f"{BASE_URL}/stats/advertisers/{test_advertiser}/campaigns/breakdown").json()
+    total = requests.get(f"{BASE_URL}/stats/advertisers/{test_advertiser}/campaigns").json()
+    assert breakdown["total"]["impressions_count"] == total["impressions_count"] == len(served)
+    assert {campaign["campaign_id"]: campaign["impressions_count"] for campaign in breakdown["campaigns"]} == \
+        {campaign_id: served.count(campaign_id) for campaign_id in campaign_ids}
+    for name in ("impressions_count", "clicks_count", "spent_impressions", "spent_clicks"):
+        assert sum(campaign[name] for campaign in breakdown["campaigns"]) == pytest.approx(breakdown["total"][name])
@@ -0,0 +1,110 @@
+import asyncio
+from types import SimpleNamespace
+
+from sqlalchemy import insert, select, text
+
+from app.db import __all_models  # noqa: F401, the mappers need every model
+from app.db import action_model
+from app.db import campaign_stats_model
+from app.db import db_session
+from app.db.action_partitions import ActionDay, DayCompactor, archive_name, ensure_partition, partition_name
+from db_rows import clean_up, create_campaign_and_client, unused_day
+
+
+class DaysSession:
+    # answers the day queries of compact() in order
+    def __init__(self, results: list):
+        self._results = results
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, statement):
+        days = self._results.pop(0)
+        return SimpleNamespace(scalars=lambda: SimpleNamespace(all=lambda: days))
+
+
+def recording_compactor(monkeypatch, results: list, **kwargs):
+    events = []
+    monkeypatch.setattr(db_session, 'session_factory', lambda: DaysSession(results), raising=False)
+    compactor = DayCompactor(**kwargs)
+
+    async def seal(day):
+        events.append(('seal', day))
+
+    async def detach(day):
+        events.append(('detach', day))
+
+    class Writer:
+        async def flushed(self, day):
+            await asyncio.sleep(0)
+            events.append(('flushed', day))
+
+    compactor._seal, compactor._detach, compactor.action_writer = seal, detach, Writer()
+    return compactor, events
+
+
+def test_days_are_sealed_after_the_writer_flushed_them(monkeypatch):
+    compactor, events = recording_compactor(monkeypatch, [[3, 4, 5]])
+    asyncio.run(compactor.compact(6))
+    assert events == [('flushed', 5), ('seal', 3), ('seal', 4), ('seal', 5)]
+
+    compactor, events = recording_compactor(monkeypatch, [[]])
+    asyncio.run(compactor.compact(6))
+    assert events == []
+
+
+def test_old_days_are_detached_with_retention(monkeypatch):
+    compactor, events = recording_compactor(monkeypatch, [[5], [1, 2]], retention_days=3)
+    asyncio.run(compactor.compact(6))
+    assert events == [('flushed', 5), ('seal', 5), ('detach', 1), ('detach', 2)]
+
+
+def test_partition_names():
+    assert partition_name(12) == 'actions_d12'
+    assert archive_name(12) == 'actions_archive_d12'
+
+
+def test_sealed_day_is_recomputed_and_archived(run_with_database):
+    rollup = campaign_stats_model.CampaignDailyStats
+
+    async def test():
+        day = unused_day()
+        await ensure_partition(day)
+        campaign_id, client_id = await create_campaign_and_client()
+        try:
+            async with db_session.session_factory() as session:
+                await session.execute(insert(action_model.Action).values(
+                    client_id=client_id, campaign_id=campaign_id, cost=2.0, action='impression', day=day))
+                await session.execute(insert(rollup).values(
+                    campaign_id=campaign_id, day=day, impressions_count=3, clicks_count=0,
+                    spent_impressions=6.0, spent_clicks=0.0))
+                await session.commit()
+
+            compactor = DayCompactor()
+            await compactor._seal(day)
+            await compactor._detach(day)
+            async with db_session.session_factory() as session:
+                action_day = await session.get(ActionDay, day)
+                assert (action_day.sealed, action_day.detached) == (True, True)
+                stats = await session.execute(select(rollup.impressions_count, rollup.spent_impressions)
+                                              .where(rollup.campaign_id == campaign_id))
+                assert stats.all() == [(1, 2.0)]
+                archived = await session.execute(text(f'SELECT count(*) FROM {archive_name(day)}'))
+                assert archived.scalar() == 1
+
+            # the day gets a fresh partition, unsealed
+            await ensure_partition(day)
+            async with db_session.session_factory() as session:
+                action_day = await session.get(ActionDay, day)
+                assert (action_day.sealed, action_day.detached) == (False, False)
+        finally:
+            async with db_session.session_factory() as session:
+                await session.execute(text(f'DROP TABLE IF EXISTS {archive_name(day)}'))
+                await session.commit()
+            await clean_up(campaign_id, day)
+
+    run_with_database(test)
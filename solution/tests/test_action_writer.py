@@ -0,0 +1,150 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.dml import Insert
+
+from app.db import action_writer
+from app.db.action_writer import ActionQueueFull, ActionWriter
+from app.monitoring.metrics import ACTION_WRITE_FAILURES, ACTIONS_LATE
+
+
+def new_actions(count: int, day: int = 0):
+    return [ActionWriter.new_action(uuid.uuid4(), uuid.uuid4(), 1.0, 'impression', day) for _ in range(count)]
+
+
+class RecordingWriter(ActionWriter):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+
+    async def _write(self, batch: list[dict], attempts: int = 3):
+        self.batches.append(batch)
+
+
+def test_put_many_is_all_or_nothing():
+    async def run():
+        writer = ActionWriter(queue_size=5, put_timeout=0.05)
+        await writer.put_many(new_actions(3))
+        with pytest.raises(ActionQueueFull):
+            await writer.put_many(new_actions(3))
+        assert writer._queue.qsize() == 3
+        await writer.put_many(new_actions(2))
+        assert writer._queue.qsize() == 5
+
+        with pytest.raises(ActionQueueFull):
+            await ActionWriter(queue_size=5, put_timeout=1).put_many(new_actions(6))
+
+    asyncio.run(run())
+
+
+def test_put_many_waits_for_the_writer():
+    async def run():
+        writer = RecordingWriter(flush_interval=0.05, batch_size=2, queue_size=4, put_timeout=1)
+        await writer.put_many(new_actions(4))
+        writer.start()
+        # room for 3 more rows appears once the writer has taken its first batches
+        await writer.put_many(new_actions(3))
+        await writer.stop()
+        assert sum(len(batch) for batch in writer.batches) == 7
+        assert all(len(batch) <= 2 for batch in writer.batches)
+
+    asyncio.run(run())
+
+
+def test_flushed_waits_for_the_rows_of_the_day():
+    async def run():
+        release = asyncio.Event()
+
+        class SlowWriter(RecordingWriter):
+            async def _write(self, batch: list[dict], attempts: int = 3):
+                await release.wait()
+                await super()._write(batch)
+
+        writer = SlowWriter(flush_interval=0.01)
+        writer.start()
+        await writer.put_many(new_actions(2, day=1) + new_actions(1, day=3))
+        await writer.flushed(0)
+
+        flushed = asyncio.create_task(writer.flushed(1))
+        await asyncio.sleep(0.05)
+        assert not flushed.done()
+        release.set()
+        await asyncio.wait_for(flushed, timeout=1)
+        assert sum(len(batch) for batch in writer.batches) == 3
+        await writer.stop()
+
+    asyncio.run(run())
+
+
+class FailingSession:
+    # fails the INSERT with the given SQLSTATEs, one per session, then lets it through; `sealed` are
+    # the days the lookup of sealed days returns
+    def __init__(self, errors: list, written: list, sealed: list = ()):
+        self._errors = errors
+        self._written = written
+        self._sealed = list(sealed)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, statement, rows=None):
+        if not isinstance(statement, Insert):
+            # the day locks and the sealed days
+            return SimpleNamespace(scalars=lambda: SimpleNamespace(all=lambda: self._sealed))
+        if self._errors:
+            raise IntegrityError('INSERT', rows, SimpleNamespace(sqlstate=self._errors.pop(0)))
+        self._written.append(rows)
+        return SimpleNamespace(all=lambda: [])
+
+    async def commit(self):
+        pass
+
+
+def write_with_errors(monkeypatch, errors: list, batch: list = None, sealed: list = ()):
+    written, dropped = [], []
+    monkeypatch.setattr(action_writer.db_session, 'session_factory',
+                        lambda: FailingSession(errors, written, sealed), raising=False)
+    sleep = asyncio.sleep
+    monkeypatch.setattr(action_writer.asyncio, 'sleep', lambda delay: sleep(0))
+
+    async def drop_orphans(batch):
+        dropped.extend(batch)
+        return batch[1:]
+
+    writer = ActionWriter()
+    writer._drop_orphans = drop_orphans
+    batch = batch or new_actions(3)
+    asyncio.run(writer._write(batch))
+    return batch, written, dropped
+
+
+def test_other_integrity_errors_hold_the_batch(monkeypatch):
+    failures = ACTION_WRITE_FAILURES.labels('IntegrityError')
+    before = failures._value.get()
+    batch, written, dropped = write_with_errors(monkeypatch, ['23514'] * 5)
+    assert written == [batch]
+    assert dropped == []
+    assert failures._value.get() == before + 5
+
+
+def test_foreign_key_violations_drop_orphans(monkeypatch):
+    batch, written, dropped = write_with_errors(monkeypatch, ['23503'])
+    assert dropped == batch
+    assert written == [batch[1:]]
+
+
+def test_rows_of_sealed_days_are_rejected(monkeypatch):
+    before = ACTIONS_LATE._value.get()
+    late, current = new_actions(2, day=1), new_actions(3, day=2)
+    _, written, _ = write_with_errors(monkeypatch, [], late + current, sealed=[1])
+    assert written == [current]
+    assert ACTIONS_LATE._value.get() == before + 2
+
+    _, written, _ = write_with_errors(monkeypatch, [], late, sealed=[1])
+    assert written == []
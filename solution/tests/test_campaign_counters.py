@@ -0,0 +1,125 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import fakeredis
+
+from app.db import __all_models  # noqa: F401, the mappers need every model
+from app.redis import campaign_counters
+from app.redis.campaign_counters import DIRTY_KEY
+
+
+def make_campaign(impressions_limit=3, current_impressions=0, current_clicks=0):
+    return SimpleNamespace(campaign_id=uuid.uuid4(), impressions_limit=impressions_limit,
+                           current_impressions=current_impressions, current_clicks=current_clicks)
+
+
+class UpdateSession:
+    # records the parameters of the executemany UPDATE of flush_counters
+    def __init__(self, updates: list, fail: bool = False):
+        self._updates = updates
+        self._fail = fail
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, statement, params):
+        if self._fail:
+            raise ConnectionError("Postgres went away")
+        self._updates.extend(params)
+
+    async def commit(self):
+        pass
+
+
+def test_impressions_stop_at_the_limit():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis()
+        campaign = make_campaign(impressions_limit=3, current_impressions=1)
+        # the missing counter starts from the campaign row
+        assert [await campaign_counters.reserve_impression(redis, campaign) for _ in range(3)] == [True, True, False]
+        await campaign_counters.release_impression(redis, campaign)
+        assert await campaign_counters.reserve_impression(redis, campaign)
+        assert await campaign_counters.get_counters(redis, [campaign]) == [(3, 0)]
+        assert await redis.smembers(DIRTY_KEY) == {str(campaign.campaign_id).encode()}
+
+    asyncio.run(run())
+
+
+def test_untouched_counters_fall_back_to_the_campaign():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis()
+        touched, untouched = make_campaign(), make_campaign(current_impressions=7, current_clicks=2)
+        await campaign_counters.reserve_impression(redis, touched)
+        assert await campaign_counters.get_counters(redis, [touched, untouched]) == [(1, 0), (7, 2)]
+        assert await campaign_counters.get_counters(redis, []) == []
+
+    asyncio.run(run())
+
+
+def test_flush_writes_the_dirty_counters(monkeypatch):
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis()
+        campaigns = [make_campaign(impressions_limit=10) for _ in range(5)]
+        for campaign in campaigns:
+            await campaign_counters.reserve_impression(redis, campaign)
+        deleted = campaigns[0]
+        await campaign_counters.delete_counters(redis, deleted.campaign_id)
+
+        updates = []
+        monkeypatch.setattr(campaign_counters.db_session, 'session_factory',
+                            lambda: UpdateSession(updates, fail=True), raising=False)
+        try:
+            await campaign_counters.flush_counters(redis, batch_size=2)
+        except ConnectionError:
+            pass
+        # a failed batch stays dirty
+        assert await redis.scard(DIRTY_KEY) == 4
+
+        monkeypatch.setattr(campaign_counters.db_session, 'session_factory', lambda: UpdateSession(updates),
+                            raising=False)
+        await campaign_counters.flush_counters(redis, batch_size=2)
+        assert sorted(updates, key=lambda row: str(row['b_campaign_id'])) == sorted(
+            ({'b_campaign_id': campaign.campaign_id, 'b_impressions': 1, 'b_clicks': None}
+             for campaign in campaigns[1:]), key=lambda row: str(row['b_campaign_id']))
+        assert await redis.scard(DIRTY_KEY) == 0
+
+    asyncio.run(run())
+
+
+class CountSession:
+    def __init__(self, clicks: int, queries: list):
+        self._clicks = clicks
+        self._queries = queries
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def scalar(self, statement):
+        self._queries.append(statement)
+        return self._clicks
+
+
+def test_missing_click_counter_is_set_from_the_clicks_table(monkeypatch):
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis()
+        campaign = make_campaign(current_clicks=2)
+        queries = []
+        monkeypatch.setattr(campaign_counters.db_session, 'session_factory', lambda: CountSession(5, queries),
+                            raising=False)
+
+        # current_clicks lags behind, the clicks table already has this click
+        await campaign_counters.add_click(redis, campaign.campaign_id)
+        assert await campaign_counters.get_counters(redis, [campaign]) == [(0, 5)]
+        await campaign_counters.add_click(redis, campaign.campaign_id)
+        assert await campaign_counters.get_counters(redis, [campaign]) == [(0, 6)]
+        assert len(queries) == 1
+        assert await redis.sismember(DIRTY_KEY, str(campaign.campaign_id))
+
+    asyncio.run(run())
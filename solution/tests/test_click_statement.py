@@ -0,0 +1,69 @@
+import uuid
+
+from sqlalchemy import select, update
+
+from app.db import action_day_model
+from app.db import action_model
+from app.db import click_model
+from app.db import db_session
+from app.db.action_partitions import DayCompactor, ensure_partition
+from app.routers.ads_router import click_statement
+from db_rows import clean_up, create_campaign_and_client, unused_day
+
+
+async def click(campaign_id, client_id, day: int, allowed: bool = True):
+    async with db_session.session_factory() as session:
+        result = await session.execute(click_statement(campaign_id, client_id, day, allowed))
+        row = result.one()
+        await session.commit()
+    return row
+
+
+def test_a_click_is_counted_once_even_after_its_actions_are_gone(run_with_database):
+    async def test():
+        day = unused_day()
+        await ensure_partition(day)
+        campaign_id, client_id = await create_campaign_and_client()
+        try:
+            campaign_exists, client_exists, clicked, day_sealed, _ = await click(campaign_id, client_id, day)
+            assert (campaign_exists, client_exists, clicked, day_sealed) == (True, True, True, False)
+            assert not (await click(campaign_id, client_id, day)).clicked
+
+            # the click action leaves with the partition, the row in clicks stays
+            await DayCompactor(drop_detached=True)._detach(day)
+            await ensure_partition(day)
+            assert not (await click(campaign_id, client_id, day)).clicked
+            async with db_session.session_factory() as session:
+                actions = await session.execute(select(action_model.Action)
+                                                .where(action_model.Action.campaign_id == campaign_id))
+                assert actions.all() == []
+                clicks = await session.execute(select(click_model.Click.day)
+                                               .where(click_model.Click.campaign_id == campaign_id))
+                assert clicks.scalars().all() == [day]
+        finally:
+            await clean_up(campaign_id, day)
+
+    run_with_database(test)
+
+
+def test_no_click_is_recorded_when_not_allowed_or_on_a_sealed_day(run_with_database):
+    async def test():
+        day = unused_day()
+        await ensure_partition(day)
+        campaign_id, client_id = await create_campaign_and_client()
+        try:
+            assert not (await click(campaign_id, client_id, day, allowed=False)).clicked
+
+            async with db_session.session_factory() as session:
+                await session.execute(update(action_day_model.ActionDay)
+                                      .where(action_day_model.ActionDay.day == day).values(sealed=True))
+                await session.commit()
+            row = await click(campaign_id, client_id, day)
+            assert (row.clicked, row.day_sealed) == (False, True)
+
+            row = await click(uuid.uuid4(), client_id, day)
+            assert (row.campaign_exists, row.clicked) == (False, False)
+        finally:
+            await clean_up(campaign_id, day)
+
+    run_with_database(test)
@@ -0,0 +1,58 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import fakeredis
+
+from app.db import __all_models  # noqa: F401, the mappers need every model
+from app.redis import client_actions
+
+
+class RowsSession:
+    # answers every query with the (campaign_id, action) rows of the client it was asked about
+    def __init__(self, rows: dict):
+        self._rows = rows
+        self.queries = 0
+
+    async def execute(self, statement):
+        self.queries += 1
+        client_id = next(value for value in statement.compile().params.values() if value in self._rows)
+        return SimpleNamespace(all=lambda: self._rows[client_id])
+
+
+def test_sets_are_hydrated_once_per_client():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis()
+        client_id, other_id = uuid.uuid4(), uuid.uuid4()
+        seen, clicked, unknown = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        session = RowsSession({client_id: [(seen, 'impression'), (clicked, 'impression'), (clicked, 'click')],
+                               other_id: []})
+
+        result = await client_actions.get_seen_campaigns_many(
+            redis, session, {client_id: [seen, clicked, unknown], other_id: [seen]})
+        assert result == {client_id: ({seen, clicked}, {clicked}), other_id: (set(), set())}
+        assert session.queries == 2
+
+        # a client without any action is remembered as loaded too
+        assert await client_actions.get_client_actions_many(redis, session, [client_id, other_id]) == \
+            {client_id: ({seen, clicked}, {clicked}), other_id: (set(), set())}
+        assert session.queries == 2
+
+    asyncio.run(run())
+
+
+def test_added_actions_are_seen_without_the_database():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis()
+        client_id = uuid.uuid4()
+        first, second = uuid.uuid4(), uuid.uuid4()
+        session = RowsSession({client_id: []})
+        await client_actions.get_seen_campaigns(redis, session, client_id, [first])
+
+        await client_actions.add_actions(redis, [(client_id, first, 'impression'), (client_id, second, 'impression')])
+        await client_actions.add_action(redis, client_id, first, 'click')
+        assert await client_actions.get_seen_campaigns(redis, session, client_id, [first, second]) == \
+            ({first, second}, {first})
+        assert session.queries == 1
+
+    asyncio.run(run())
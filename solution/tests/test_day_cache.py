@@ -0,0 +1,83 @@
+import asyncio
+
+import fakeredis
+
+from app.redis import redis_client
+from app.redis.day_cache import DayCache
+
+
+async def wait_for_day(day_cache: DayCache, day: int):
+    for _ in range(100):
+        if await day_cache.get() == day:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"the cache still has day {await day_cache.get()}, expected {day}")
+
+
+def test_day_is_read_lazily():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis()
+        await redis.set('day', 4)
+        day_cache = DayCache(redis)
+        assert await day_cache.get() == 4
+        # no re-read until an update or a refresh
+        await redis.set('day', 5)
+        assert await day_cache.get() == 4
+
+    asyncio.run(run())
+
+
+def test_set_day_reaches_every_cache():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis()
+        await redis.set('day', 1)
+        day_caches = [DayCache(redis, ttl=60) for _ in range(2)]
+        for day_cache in day_caches:
+            await day_cache.start()
+        try:
+            assert [await day_cache.get() for day_cache in day_caches] == [1, 1]
+            await redis_client.set_day(redis, 2)
+            for day_cache in day_caches:
+                await wait_for_day(day_cache, 2)
+        finally:
+            for day_cache in day_caches:
+                await day_cache.stop()
+
+    asyncio.run(run())
+
+
+def test_missed_message_is_picked_up_by_the_periodic_refresh():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis()
+        await redis.set('day', 1)
+        day_cache = DayCache(redis, ttl=0.05)
+        await day_cache.start()
+        try:
+            await redis.set('day', 3)
+            await wait_for_day(day_cache, 3)
+        finally:
+            await day_cache.stop()
+
+    asyncio.run(run())
+
+
+def test_refresh_older_than_an_update_is_dropped(monkeypatch):
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis()
+        day_cache = DayCache(redis)
+        read_started, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_get_day(_):
+            read_started.set()
+            await release.wait()
+            return 3
+
+        monkeypatch.setattr(redis_client, 'get_day', slow_get_day)
+        refresh = asyncio.create_task(day_cache.refresh())
+        await read_started.wait()
+        day_cache.set_local(4)
+        release.set()
+        await refresh
+        assert await day_cache.get() == 4
+
+    asyncio.run(run())
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import time
+import uuid
+
+import fakeredis
+
+from app.jobs import queue as job_queue
+from app.jobs.queue import CANCELLED, DONE, FAILED, QUEUED, RUNNING, JobQueue
+from app.jobs.worker import JobWorker
+
+
+def make_queue(tmp_path, **kwargs):
+    return JobQueue(fakeredis.aioredis.FakeRedis(), payload_dir=str(tmp_path), **kwargs)
+
+
+async def chunks(*pieces):
+    for piece in pieces:
+        yield piece
+
+
+def expire_leases(monkeypatch, seconds: float):
+    now = time.time() + seconds
+    monkeypatch.setattr(job_queue.time, 'time', lambda: now)
+
+
+def test_expired_lease_is_requeued_and_fences_the_old_worker(tmp_path, monkeypatch):
+    async def run():
+        queue = make_queue(tmp_path, lease=10, max_attempts=2)
+        job = await queue.enqueue('rebuild_stats', {'chunks': 4})
+        job_id, _, _, attempt = await queue.next_job()
+        assert attempt == 1
+        assert await queue.renew(job_id, attempt)
+        assert await queue.requeue_expired() == 0
+
+        expire_leases(monkeypatch, 11)
+        assert await queue.requeue_expired() == 1
+        assert (await queue.get(job['job_id']))['status'] == QUEUED
+        assert not await queue.renew(job_id, attempt)
+
+        _, _, _, retry = await queue.next_job()
+        assert retry == 2
+        # the first worker comes back too late
+        assert not await queue.finish(job_id, attempt, DONE, {'rows': 1})
+        assert (await queue.get(job_id))['status'] == RUNNING
+        assert await queue.finish(job_id, retry, DONE, {'rows': 2})
+        assert (await queue.get(job_id))['result'] == {'rows': 2}
+
+    asyncio.run(run())
+
+
+def test_out_of_attempts_or_cancelled_jobs_are_not_requeued(tmp_path, monkeypatch):
+    async def run():
+        queue = make_queue(tmp_path, lease=10, max_attempts=1)
+        failed = await queue.enqueue('rebuild_stats')
+        await queue.next_job()
+        cancelled = await queue.enqueue('rebuild_stats')
+        await queue.next_job()
+        assert await queue.cancel(cancelled['job_id']) == RUNNING
+
+        expire_leases(monkeypatch, 11)
+        assert await queue.requeue_expired() == 0
+        assert (await queue.get(failed['job_id']))['status'] == FAILED
+        assert (await queue.get(cancelled['job_id']))['status'] == CANCELLED
+        assert await queue.next_job(timeout=0.01) is None
+
+    asyncio.run(run())
+
+
+def test_payload_goes_to_a_file_and_is_removed_when_finished(tmp_path):
+    async def run():
+        queue = make_queue(tmp_path)
+        job_id = uuid.uuid4()
+        path = await queue.store_payload(job_id, chunks(b'a,b\n', b'1,2\n'))
+        await queue.enqueue('import_clients', {'format': 'csv', 'payload': path}, job_id)
+        assert not await queue._redis.keys(f'job:{job_id}:*')
+
+        _, _, params, attempt = await queue.next_job()
+        assert b''.join([piece async for piece in queue.read_payload(params['payload'])]) == b'a,b\n1,2\n'
+        await queue.finish(job_id, attempt, DONE)
+        assert not os.path.exists(path)
+
+        cancelled = uuid.uuid4()
+        path = await queue.store_payload(cancelled, chunks(b'x'))
+        await queue.enqueue('import_clients', {'format': 'csv', 'payload': path}, cancelled)
+        assert await queue.cancel(cancelled) == CANCELLED
+        assert not os.path.exists(path)
+
+    asyncio.run(run())
+
+
+def test_bookkeeping_errors_do_not_stop_the_worker(tmp_path, caplog):
+    async def run():
+        queue = make_queue(tmp_path)
+        finish = queue.finish
+        calls = []
+
+        async def flaky_finish(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise ConnectionError("Redis went away")
+            return await finish(*args, **kwargs)
+
+        queue.finish = flaky_finish
+        worker = JobWorker(queue, None)
+        first = await queue.enqueue('unknown_kind')
+        second = await queue.enqueue('unknown_kind')
+        worker.start()
+        for _ in range(100):
+            if (await queue.get(second['job_id']))['status'] != QUEUED and len(calls) == 2:
+                break
+            await asyncio.sleep(0.02)
+        await worker.stop()
+        assert (await queue.get(second['job_id']))['status'] == FAILED
+        # the first job keeps its lease until the reaper takes it back
+        assert (await queue.get(first['job_id']))['status'] == RUNNING
+
+    asyncio.run(run())
+    assert "Failed to run job" in caplog.text
+
+
+def test_lost_lease_stops_the_job(tmp_path):
+    async def run():
+        queue = make_queue(tmp_path, lease=0.06)
+        started, stopped = asyncio.Event(), asyncio.Event()
+
+        class Worker(JobWorker):
+            async def _rebuild_stats(self, job_id, params):
+                started.set()
+                try:
+                    await asyncio.sleep(10)
+                finally:
+                    stopped.set()
+
+        job = await queue.enqueue('rebuild_stats')
+        job_id, kind, params, attempt = await queue.next_job()
+        execution = asyncio.create_task(Worker(queue, None)._execute(job_id, kind, params, attempt))
+        await started.wait()
+        # another worker's reaper gave the job away
+        await queue._redis.hset(f'job:{job_id}', 'attempt', attempt + 1)
+        await asyncio.wait_for(execution, timeout=1)
+        assert stopped.is_set()
+        assert (await queue.get(job['job_id']))['status'] == RUNNING
+
+    asyncio.run(run())
@@ -0,0 +1,89 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from prometheus_client import CollectorRegistry, REGISTRY
+
+from app.monitoring.metrics import CacheCollector, stage
+from app.monitoring.middleware import MetricsMiddleware
+
+
+def request_count(method: str, route: str, status: int):
+    return REGISTRY.get_sample_value('http_request_duration_seconds_count',
+                                     {'method': method, 'route': route, 'status': str(status)}) or 0
+
+
+def call(app, scope):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return messages
+
+
+def http_scope(path: str, route=None):
+    scope = {'type': 'http', 'method': 'GET', 'path': path}
+    if route is not None:
+        scope['route'] = SimpleNamespace(path=route)
+    return scope
+
+
+def test_stage_observes_the_time_spent():
+    labels = {'handler': 'test', 'stage': 'sleep'}
+    before = REGISTRY.get_sample_value('handler_stage_duration_seconds_count', labels) or 0
+    with stage('test', 'sleep'):
+        pass
+    with stage('test', 'sleep'):
+        pass
+    assert REGISTRY.get_sample_value('handler_stage_duration_seconds_count', labels) == before + 2
+
+
+def test_requests_are_labelled_with_the_route_template():
+    async def app(scope, receive, send):
+        # the router sets the matched route on the scope
+        scope['route'] = SimpleNamespace(path='/clients/{client_id}')
+        await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    before = request_count('GET', '/clients/{client_id}', 404)
+    messages = call(MetricsMiddleware(app), http_scope('/clients/123'))
+    assert [message['type'] for message in messages] == ['http.response.start', 'http.response.body']
+    assert request_count('GET', '/clients/{client_id}', 404) == before + 1
+
+
+def test_failed_and_unmatched_requests_are_counted():
+    async def app(scope, receive, send):
+        raise RuntimeError('boom')
+
+    before = request_count('GET', 'other', 500)
+    with pytest.raises(RuntimeError):
+        call(MetricsMiddleware(app), http_scope('/nowhere'))
+    assert request_count('GET', 'other', 500) == before + 1
+
+
+def test_other_scopes_pass_through():
+    calls = []
+
+    async def app(scope, receive, send):
+        calls.append(scope['type'])
+
+    call(MetricsMiddleware(app), {'type': 'lifespan'})
+    assert calls == ['lifespan']
+
+
+def test_cache_collector_skips_missing_caches():
+    cache = SimpleNamespace(stats=lambda: {'hits': 5, 'misses': 2, 'evictions': 1, 'size': 10})
+    registry = CollectorRegistry()
+    registry.register(CacheCollector(SimpleNamespace(client_cache=cache),
+                                     {'clients': 'client_cache', 'campaigns': 'campaign_cache'}))
+
+    assert registry.get_sample_value('cache_hits_total', {'cache': 'clients'}) == 5
+    assert registry.get_sample_value('cache_misses_total', {'cache': 'clients'}) == 2
+    assert registry.get_sample_value('cache_evictions_total', {'cache': 'clients'}) == 1
+    assert registry.get_sample_value('cache_size', {'cache': 'clients'}) == 10
+    assert registry.get_sample_value('cache_hits_total', {'cache': 'campaigns'}) is None
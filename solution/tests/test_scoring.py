@@ -0,0 +1,85 @@
+import random
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from app.engine.scoring import ScoringEngine, campaign_profit
+
+
+def make_campaign(advertiser_id=None, cost_per_impression=1.0, cost_per_click=1.0, impressions=0, clicks=0):
+    return SimpleNamespace(campaign_id=uuid.uuid4(), advertiser_id=advertiser_id or uuid.uuid4(),
+                           cost_per_impression=cost_per_impression, cost_per_click=cost_per_click,
+                           current_impressions=impressions, current_clicks=clicks)
+
+
+def test_best_of_nothing():
+    engine = ScoringEngine()
+    assert engine.best([], {}) is None
+    assert engine.top_k([], {}, 5) == []
+
+
+def test_ties_keep_the_input_order():
+    engine = ScoringEngine()
+    campaigns = [make_campaign() for _ in range(5)]
+    assert engine.best(campaigns, {}) is campaigns[0]
+    assert [c for c, _ in engine.top_k(campaigns, {}, 3)] == campaigns[:3]
+
+
+def test_ties_on_the_kth_score_go_by_position():
+    engine = ScoringEngine()
+    low, high = make_campaign(cost_per_impression=0.5), make_campaign(cost_per_impression=2.0)
+    tied = [make_campaign() for _ in range(4)]
+    campaigns = [tied[0], low, tied[1], high, tied[2], tied[3]]
+    assert [c for c, _ in engine.top_k(campaigns, {}, 3)] == [high, tied[0], tied[1]]
+
+
+def test_zero_or_missing_ml_scores_leave_only_profit():
+    engine = ScoringEngine(alpha=0.8, beta=0.2)
+    advertiser_id = uuid.uuid4()
+    campaigns = [make_campaign(advertiser_id, cost_per_impression=cost) for cost in (1.0, 3.0, 2.0)]
+    expected = [0.8 * campaign_profit(c) / campaign_profit(campaigns[1]) for c in campaigns]
+
+    for ml_scores in ({}, {advertiser_id: 0}, {uuid.uuid4(): 50}):
+        assert engine.scores(campaigns, ml_scores).tolist() == pytest.approx(expected)
+        assert engine.best(campaigns, ml_scores) is campaigns[1]
+
+
+def test_zero_profit_leaves_only_ml():
+    engine = ScoringEngine(alpha=0.8, beta=0.2)
+    campaigns = [make_campaign(cost_per_impression=0.0, cost_per_click=0.0) for _ in range(3)]
+    ml_scores = {campaigns[0].advertiser_id: 10, campaigns[2].advertiser_id: 40}
+    assert engine.scores(campaigns, ml_scores).tolist() == pytest.approx([0.05, 0.0, 0.2])
+    assert engine.best(campaigns, ml_scores) is campaigns[2]
+
+
+def test_combine_weights_both_terms():
+    engine = ScoringEngine(alpha=0.6, beta=0.4)
+    advertiser_ids = [uuid.uuid4(), uuid.uuid4()]
+    campaigns = [make_campaign(advertiser_ids[0], cost_per_impression=1.0, cost_per_click=2.0, impressions=8, clicks=3),
+                 make_campaign(advertiser_ids[1], cost_per_impression=2.0, cost_per_click=0.0)]
+    profits = [campaign_profit(c) for c in campaigns]
+    scores = engine.scores(campaigns, {advertiser_ids[0]: 100, advertiser_ids[1]: 25})
+    assert scores.tolist() == pytest.approx([0.6 * profits[0] / max(profits) + 0.4,
+                                             0.6 * profits[1] / max(profits) + 0.1])
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_top_k_matches_a_full_sort(seed):
+    rng = random.Random(seed)
+    engine = ScoringEngine()
+    advertiser_ids = [uuid.uuid4() for _ in range(5)]
+    # few distinct costs, so that many scores tie
+    campaigns = [make_campaign(rng.choice(advertiser_ids), cost_per_impression=rng.choice((0.0, 1.0, 2.0)),
+                               cost_per_click=rng.choice((0.0, 4.0)), impressions=rng.choice((0, 2)),
+                               clicks=rng.choice((0, 1)))
+                 for _ in range(rng.randint(1, 60))]
+    ml_scores = {advertiser_id: rng.choice((0, 10, 20)) for advertiser_id in advertiser_ids}
+    scores = engine.scores(campaigns, ml_scores)
+
+    for k in (1, 3, 10, len(campaigns), len(campaigns) + 5):
+        expected = sorted(range(len(campaigns)), key=lambda i: -scores[i])[:k]
+        result = engine.top_k(campaigns, ml_scores, k)
+        assert [c for c, _ in result] == [campaigns[i] for i in expected]
+        assert [score for _, score in result] == [float(scores[i]) for i in expected]
+    assert engine.best(campaigns, ml_scores) is campaigns[max(range(len(campaigns)), key=lambda i: scores[i])]
@@ -0,0 +1,95 @@
+import asyncio
+from types import SimpleNamespace
+
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, text
+
+from app.monitoring import sql
+from app.monitoring.sql import QueryBudgetMiddleware, instrument_engine, request_query_stats
+
+
+def budget_exceeded(route: str):
+    return REGISTRY.get_sample_value('db_query_budget_exceeded_total', {'route': route}) or 0
+
+
+def app_running_queries(count: int):
+    async def app(scope, receive, send):
+        scope['route'] = SimpleNamespace(path='/test/queries')
+        for _ in range(count):
+            stats = request_query_stats.get()
+            stats.count += 1
+            stats.duration += 0.001
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b''})
+    return app
+
+
+def call(app):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app({'type': 'http', 'method': 'GET', 'path': '/test/queries'}, receive, send))
+    return messages
+
+
+def test_requests_over_the_budget_are_counted():
+    before = budget_exceeded('/test/queries')
+    call(QueryBudgetMiddleware(app_running_queries(3), budget=3))
+    assert budget_exceeded('/test/queries') == before
+    call(QueryBudgetMiddleware(app_running_queries(4), budget=3))
+    assert budget_exceeded('/test/queries') == before + 1
+    # a budget of 0 turns the check off
+    call(QueryBudgetMiddleware(app_running_queries(4), budget=0))
+    assert budget_exceeded('/test/queries') == before + 1
+    assert request_query_stats.get() is None
+
+
+def test_debug_headers():
+    start = call(QueryBudgetMiddleware(app_running_queries(2), debug_headers=True))[0]
+    assert start['headers'] == [(b'content-type', b'text/plain'), (b'x-db-queries', b'2'), (b'x-db-time-ms', b'2.00')]
+
+    start = call(QueryBudgetMiddleware(app_running_queries(2)))[0]
+    assert start['headers'] == [(b'content-type', b'text/plain')]
+
+
+def test_statements_are_counted_for_the_current_request_only():
+    engine = create_engine('sqlite://')
+    instrument_engine(SimpleNamespace(sync_engine=engine), slow_query_ms=1000, explain=False)
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+        stats = sql.QueryStats()
+        token = request_query_stats.set(stats)
+        try:
+            connection.execute(text('SELECT 1'))
+            connection.execute(text('SELECT 2'))
+        finally:
+            request_query_stats.reset(token)
+        connection.execute(text('SELECT 3'))
+    assert stats.count == 2
+    assert stats.duration > 0
+
+
+def test_slow_queries_are_logged_with_their_parameters(caplog):
+    engine = create_engine('sqlite://')
+    instrument_engine(SimpleNamespace(sync_engine=engine), slow_query_ms=0, explain=False)
+    before = REGISTRY.get_sample_value('db_slow_queries_total') or 0
+    with engine.connect() as connection:
+        connection.execute(text('SELECT :value'), {'value': 42})
+    assert REGISTRY.get_sample_value('db_slow_queries_total') == before + 1
+    assert 'SELECT ?' in caplog.text
+    assert 'Parameters: (42,)' in caplog.text
+
+
+def test_parameters_are_shortened():
+    assert sql._format_parameters({'id': 1}, executemany=False) == "{'id': 1}"
+    assert sql._format_parameters([(1, 'a'), (2, 'b')], executemany=True) == "2 rows, first: (1, 'a')"
+    assert sql._format_parameters([], executemany=True) == "0 rows"
+
+    text = sql._format_parameters(['x' * 5000], executemany=False)
+    assert len(text) == sql._PARAMETERS_LOG_LIMIT + 3
+    assert text.endswith('...')
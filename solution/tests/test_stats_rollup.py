@@ -0,0 +1,143 @@
+import asyncio
+import json
+import random
+import uuid
+
+from sqlalchemy import insert, select
+
+import rebuild_stats
+from app.db import __all_models  # noqa: F401, the mappers need every model
+from app.db import action_model
+from app.db import campaign_stats_model
+from app.db import db_session
+from app.db import stats_rollup
+from app.db.action_partitions import ensure_partition
+from db_rows import clean_up, create_campaign_and_client, unused_day
+
+
+class LockSession:
+    def __init__(self):
+        self.locks = []
+
+    async def execute(self, statement, params):
+        self.locks.append((str(statement).split('(')[1], params))
+
+
+def containing(chunks: list, campaign_id: uuid.UUID):
+    return [chunk for chunk in chunks
+            if (chunk[0] is None or campaign_id >= uuid.UUID(chunk[0]))
+            and (chunk[1] is None or campaign_id < uuid.UUID(chunk[1]))]
+
+
+def locked(by: str, chunk: list):
+    session = LockSession()
+    asyncio.run(stats_rollup._lock_partition(session, by, chunk))
+    return [(lock, params['class'], params['first'], params['last']) for lock, params in session.locks]
+
+
+def test_campaign_chunks_cover_every_id_once():
+    rng = random.Random(0)
+    chunks = stats_rollup.campaign_chunks(7)
+    assert len(chunks) == 7
+    assert chunks[0][0] is None and chunks[-1][1] is None
+    assert all(chunks[i][1] == chunks[i + 1][0] for i in range(6))
+
+    for campaign_id in [uuid.UUID(int=0), uuid.UUID(int=2 ** 128 - 1)] + [uuid.UUID(int=rng.getrandbits(128))
+                                                                          for _ in range(1000)]:
+        assert len(containing(chunks, campaign_id)) == 1
+
+
+def test_campaign_ranges_lock_their_stripes():
+    stripes = stats_rollup.REBUILD_STRIPES
+    chunks = stats_rollup.campaign_chunks(stripes)
+    assert locked('campaign', chunks[0]) == [('pg_advisory_xact_lock', stats_rollup._STRIPES_LOCK_CLASS, 0, 0)]
+    assert locked('campaign', chunks[17]) == [('pg_advisory_xact_lock', stats_rollup._STRIPES_LOCK_CLASS, 17, 17)]
+    assert locked('campaign', chunks[-1])[0][2:] == (stripes - 1, stripes - 1)
+
+    # coarser chunks lock consecutive stripes, finer ones share a stripe
+    assert [locked('campaign', chunk)[0][2:] for chunk in stats_rollup.campaign_chunks(4)] == \
+        [(i * stripes // 4, (i + 1) * stripes // 4 - 1) for i in range(4)]
+    assert {locked('campaign', chunk)[0][2:] for chunk in stats_rollup.campaign_chunks(stripes * 2)[:2]} == {(0, 0)}
+
+
+def test_day_ranges_share_the_stripes_and_lock_their_days():
+    assert locked('day', [3, 5]) == [
+        ('pg_advisory_xact_lock_shared', stats_rollup._STRIPES_LOCK_CLASS, 0, stats_rollup.REBUILD_STRIPES - 1),
+        ('pg_advisory_xact_lock', stats_rollup._DAYS_LOCK_CLASS, 3, 5)]
+
+
+def test_aggregate_sums_per_campaign_and_day_in_key_order():
+    first, second = sorted(uuid.uuid4() for _ in range(2))
+    rows = stats_rollup.aggregate([(second, 1, 'impression', 1.0), (first, 2, 'click', 3.0),
+                                   (second, 1, 'click', 2.5), (first, 1, 'impression', 0.5),
+                                   (second, 1, 'impression', 1.0)])
+    assert rows == [
+        {'campaign_id': first, 'day': 1, 'impressions_count': 1, 'clicks_count': 0,
+         'spent_impressions': 0.5, 'spent_clicks': 0.0},
+        {'campaign_id': first, 'day': 2, 'impressions_count': 0, 'clicks_count': 1,
+         'spent_impressions': 0.0, 'spent_clicks': 3.0},
+        {'campaign_id': second, 'day': 1, 'impressions_count': 2, 'clicks_count': 1,
+         'spent_impressions': 2.0, 'spent_clicks': 2.5}]
+
+
+def test_day_chunks():
+    assert rebuild_stats.day_chunks(0, 6, 3) == [[0, 2], [3, 5], [6, 6]]
+    assert rebuild_stats.day_chunks(4, 4, 1) == [[4, 4]]
+    assert rebuild_stats.day_chunks(5, 4, 1) == []
+
+
+def test_save_state_replaces_the_file(tmp_path):
+    path = str(tmp_path / 'state.json')
+    plan = {'by': 'day', 'chunks': [[0, 1]], 'done': []}
+    rebuild_stats.save_state(path, plan)
+    plan['done'].append(0)
+    rebuild_stats.save_state(path, plan)
+    with open(path) as f:
+        assert json.load(f) == plan
+    assert [p.name for p in tmp_path.iterdir()] == ['state.json']
+
+
+def test_rebuild_corrects_the_rollup_of_a_partition(run_with_database):
+    rollup = campaign_stats_model.CampaignDailyStats
+
+    async def rollup_rows(campaign_id):
+        async with db_session.session_factory() as session:
+            result = await session.execute(select(rollup.day, rollup.impressions_count, rollup.clicks_count,
+                                                  rollup.spent_impressions, rollup.spent_clicks)
+                                           .where(rollup.campaign_id == campaign_id).order_by(rollup.day))
+            return [tuple(row) for row in result]
+
+    async def test():
+        day = unused_day()
+        await ensure_partition(day)
+        campaign_id, client_id = await create_campaign_and_client()
+        try:
+            async with db_session.session_factory() as session:
+                await session.execute(insert(action_model.Action), [
+                    {'client_id': client_id, 'campaign_id': campaign_id, 'cost': 1.5, 'action': 'impression',
+                     'day': day},
+                    {'client_id': client_id, 'campaign_id': campaign_id, 'cost': 4.0, 'action': 'click', 'day': day}])
+                # a wrong row for the day and one for a day without actions
+                await session.execute(insert(rollup), [
+                    {'campaign_id': campaign_id, 'day': day, 'impressions_count': 5, 'clicks_count': 0,
+                     'spent_impressions': 7.5, 'spent_clicks': 0.0},
+                    {'campaign_id': campaign_id, 'day': day + 1, 'impressions_count': 1, 'clicks_count': 0,
+                     'spent_impressions': 1.0, 'spent_clicks': 0.0}])
+                await session.commit()
+
+            async with db_session.session_factory() as session:
+                rows = await stats_rollup.rebuild_partition(session, 'day', [day, day + 1])
+                await session.commit()
+            assert rows == 2
+            assert await rollup_rows(campaign_id) == [(day, 1, 1, 1.5, 4.0)]
+
+            # the rows are right now, rebuilding the campaign range leaves them as they are
+            [chunk] = containing(stats_rollup.campaign_chunks(256), campaign_id)
+            async with db_session.session_factory() as session:
+                await stats_rollup.rebuild_partition(session, 'campaign', chunk)
+                await session.commit()
+            assert await rollup_rows(campaign_id) == [(day, 1, 1, 1.5, 4.0)]
+        finally:
+            await clean_up(campaign_id, day)
+
+    run_with_database(test)
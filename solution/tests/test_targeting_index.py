@@ -0,0 +1,116 @@
+import random
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from app.engine.scoring import ScoringEngine
+from app.engine.targeting_index import ProfitOrder, TargetingIndex
+
+
+LOCATIONS = ('Moscow', 'Kazan', None)
+GENDERS = ('MALE', 'FEMALE', 'ALL', None)
+
+
+def make_campaign(rng: random.Random, advertiser_ids: list):
+    age_from = rng.choice((None, rng.randint(0, 60)))
+    age_to = rng.choice((None, rng.randint(age_from or 0, 100)))
+    return SimpleNamespace(
+        campaign_id=uuid.uuid4(), advertiser_id=rng.choice(advertiser_ids),
+        targeting={'gender': rng.choice(GENDERS), 'location': rng.choice(LOCATIONS),
+                   'age_from': age_from, 'age_to': age_to},
+        start_date=0, end_date=10, impressions_limit=rng.randint(1, 50), clicks_limit=rng.randint(1, 20),
+        cost_per_impression=rng.uniform(0, 5), cost_per_click=rng.uniform(0, 20), ad_title='Title', ad_text='Text',
+        current_impressions=rng.randint(0, 40), current_clicks=rng.randint(0, 15))
+
+
+def index_with_campaigns(rng: random.Random, count: int, advertiser_ids: list):
+    index = TargetingIndex()
+    index.day = 0
+    for _ in range(count):
+        index.upsert(make_campaign(rng, advertiser_ids))
+    return index
+
+
+def brute_force(engine: ScoringEngine, index: TargetingIndex, profile: tuple, excluded: set, ml_scores: dict):
+    pool = [c for c in index.campaigns()
+            if c.matches(*profile) and c.has_limits_left() and c.campaign_id not in excluded]
+    scores = engine.scores(pool, ml_scores)
+    order = sorted(range(len(pool)), key=lambda i: (-scores[i], pool[i].rank_key))
+    return pool, [pool[i] for i in order]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_ranked_segment_matches_full_scoring(seed):
+    rng = random.Random(seed)
+    advertiser_ids = [uuid.uuid4() for _ in range(8)]
+    index = index_with_campaigns(rng, 300, advertiser_ids)
+    engine = ScoringEngine()
+
+    for _ in range(50):
+        profile = (rng.choice(('MALE', 'FEMALE')), rng.choice(('Moscow', 'Kazan', 'Omsk')), rng.randint(0, 100))
+        ml_scores = {advertiser_id: rng.choice((0, rng.randint(1, 100))) for advertiser_id in advertiser_ids}
+        excluded = {c.campaign_id for c in rng.sample(index.campaigns(), 30)}
+
+        pool, expected = brute_force(engine, index, profile, excluded, ml_scores)
+        ranked = list(engine.ranked_segment(index.segment(*profile), excluded, ml_scores))
+        assert ranked == expected
+        if pool:
+            assert ranked[0] is engine.best(pool, ml_scores)
+
+        # counters move campaigns in and out of the profit orders
+        for campaign in rng.sample(index.campaigns(), 20):
+            index.set_counters(campaign, rng.randint(0, 50), rng.randint(0, 20))
+
+
+def test_segment_walk_is_a_snapshot():
+    rng = random.Random(0)
+    index = index_with_campaigns(rng, 200, [uuid.uuid4()])
+    segment = index.segment('MALE', 'Moscow', 30)
+    walk = iter(segment)
+    expected = list(segment)
+
+    for campaign in index.campaigns():
+        index.set_counters(campaign, campaign.current_impressions + 1, campaign.current_clicks)
+    assert list(walk) == expected
+
+
+def test_segment_candidates_follow_changes():
+    rng = random.Random(1)
+    index = index_with_campaigns(rng, 100, [uuid.uuid4()])
+    profile = ('FEMALE', 'Kazan', 40)
+    expected = {c.campaign_id for c in index.campaigns() if c.matches(*profile)}
+    assert {c.campaign_id for c in index.segment(*profile).candidates()} == expected
+
+    removed = next(iter(expected))
+    index.remove(removed)
+    assert {c.campaign_id for c in index.segment(*profile).candidates()} == expected - {removed}
+    assert removed not in {c.campaign_id for c in index.segment(*profile)}
+    assert index.segment('FEMALE', 'Nowhere', 200).is_empty()
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('node_size', (4, ProfitOrder.NODE_SIZE))
+def test_profit_orders_stay_sorted_after_many_updates(monkeypatch, seed, node_size):
+    # small nodes make the trees a few levels deep
+    monkeypatch.setattr(ProfitOrder, 'NODE_SIZE', node_size)
+    rng = random.Random(seed)
+    advertiser_ids = [uuid.uuid4() for _ in range(4)]
+    index = index_with_campaigns(rng, 2000, advertiser_ids)
+
+    for step in range(20000):
+        campaign = rng.choice(index.campaigns())
+        if step % 100 == 0:
+            index.remove(campaign.campaign_id)
+            index.upsert(make_campaign(rng, advertiser_ids))
+        else:
+            index.set_counters(campaign, rng.randint(0, 50), rng.randint(0, 20))
+
+    for profile in (('MALE', 'Moscow', 30), ('FEMALE', 'Kazan', 70), ('MALE', 'Omsk', 5)):
+        expected = sorted((c for c in index.campaigns() if c.matches(*profile) and c.has_limits_left()),
+                          key=lambda c: c.rank_key)
+        segment = index.segment(*profile)
+        assert list(segment) == expected
+        for advertiser_id in advertiser_ids:
+            assert list(segment.for_advertiser(advertiser_id)) == \
+                [c for c in expected if c.advertiser_id == advertiser_id]